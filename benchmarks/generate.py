@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Writes synthetic World Development Indicators databases, with the same
+Countries, Indicators and CountryIndicators tables as the real one, of any
+number of countries, years and indicators.
+
+    python -m benchmarks.generate bench.sqlite3 --countries 200 --years 50 --indicators 100
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+
+import numpy as np
+
+from utils import config
+
+# Zones of config.exclude_list added to the countries, so that the
+# benchmarks also exercise their filtering.
+AGGREGATES = ['World', 'Euro area']
+
+
+def _country_codes(n_countries):
+    width = max(3, len(str(n_countries - 1)))
+    return [f'C{i:0{width}d}' for i in range(n_countries)]
+
+
+def _indicator_codes(n_indicators):
+    width = len(str(n_indicators - 1))
+    return [f'SYN.IND.{i:0{width}d}' for i in range(n_indicators)]
+
+
+def generate(path, n_countries=200, n_years=50, n_indicators=100, missing=0.2,
+             informative=0.1, last_year=None, seed=0, chunk_values=2000000):
+    """Writes a synthetic database to path.
+
+    The response (config.PREDICTED_INDICATOR) of each country follows an
+    AR(1) process around a country random effect. A share informative of
+    the indicators is a noisy linear function of the response of the same
+    year, the others are pure noise. Each value is missing with probability
+    missing, and each country starts reporting at a random year within the
+    first fifth of the period, as in the real database.
+
+    Parameters
+    ----------
+    path: File of the database, must not exist.
+    n_countries: Number of countries.
+    n_years: Number of years, ending at last_year.
+    n_indicators: Number of indicators, besides the response.
+    missing: Probability of each value of an indicator to be missing.
+    informative: Share of the indicators related to the response.
+    last_year: Last year of the data. Per default: config.DB_YEAR_MAX.
+    seed: Seed of the random generator.
+    chunk_values: Approximate number of values generated and written at once.
+
+    Returns
+    -------
+    summary
+        Dictionary with the size of the generated database."""
+    last_year = config.DB_YEAR_MAX if last_year is None else last_year
+    first_year = last_year - n_years + 1
+    rng = np.random.default_rng(seed)
+    codes = _country_codes(n_countries)
+    names = [f'Country {i}' for i in range(n_countries)]
+    codes += [f'A{i:02d}' for i in range(len(AGGREGATES))]
+    names += AGGREGATES
+    indicators = _indicator_codes(n_indicators)
+    n_informative = int(round(informative * n_indicators))
+    loadings = np.zeros(n_indicators)
+    loadings[:n_informative] = rng.normal(0, 1, n_informative)
+    offsets = rng.normal(0, 10, n_indicators)
+    years = np.arange(first_year, last_year + 1)
+    chunk_countries = max(1, chunk_values // (n_years * (n_indicators + 1)))
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(path)
+    n_values = 0
+    try:
+        conn.execute('PRAGMA journal_mode=OFF;')
+        conn.execute('PRAGMA synchronous=OFF;')
+        conn.execute('CREATE TABLE Countries (CountryCode TEXT, ShortName TEXT, '
+                     'LongName TEXT, Region TEXT, IncomeGroup TEXT);')
+        conn.execute('CREATE TABLE Indicators (IndicatorName TEXT, IndicatorCode TEXT);')
+        conn.execute('CREATE TABLE CountryIndicators (CountryName TEXT, CountryCode TEXT, '
+                     'IndicatorName TEXT, IndicatorCode TEXT, Year INTEGER, Value REAL);')
+        income_groups = ['Low income', 'Lower middle income',
+                         'Upper middle income', 'High income']
+        conn.executemany('INSERT INTO Countries VALUES (?, ?, ?, ?, ?);',
+                         [(code, name, name, f'Region {i % 7}',
+                           income_groups[i % len(income_groups)])
+                          for i, (code, name) in enumerate(zip(codes, names))])
+        conn.executemany('INSERT INTO Indicators VALUES (?, ?);',
+                         [(code, code) for code in indicators + [config.PREDICTED_INDICATOR]])
+
+        all_codes = indicators + [config.PREDICTED_INDICATOR]
+        for first in range(0, len(codes), chunk_countries):
+            chunk_codes = codes[first:first + chunk_countries]
+            chunk_names = names[first:first + chunk_countries]
+            n_chunk = len(chunk_codes)
+            effects = rng.normal(2, 2, n_chunk)
+            growth = np.empty((n_chunk, n_years))
+            level = effects.copy()
+            for t in range(n_years):
+                level = 0.4 * level + 0.6 * effects + rng.normal(0, 2, n_chunk)
+                growth[:, t] = level
+            # (country, year, indicator) cube of the chunk
+            values = (offsets + growth[:, :, None] * loadings
+                      + rng.normal(0, 1, (n_chunk, n_years, n_indicators)))
+            values = np.concatenate([values, growth[:, :, None]], axis=2)
+            keep = rng.random(values.shape) >= missing
+            keep[:, :, -1] = True
+            starts = rng.integers(0, max(1, n_years // 5), n_chunk)
+            keep &= (np.arange(n_years)[None, :] >= starts[:, None])[:, :, None]
+            country_pos, year_pos, indicator_pos = np.nonzero(keep)
+            rows = zip([chunk_names[i] for i in country_pos],
+                       [chunk_codes[i] for i in country_pos],
+                       [all_codes[i] for i in indicator_pos],
+                       [all_codes[i] for i in indicator_pos],
+                       years[year_pos].tolist(),
+                       values[keep].tolist())
+            with conn:
+                conn.executemany('INSERT INTO CountryIndicators VALUES (?, ?, ?, ?, ?, ?);',
+                                 rows)
+            n_values += len(country_pos)
+    finally:
+        conn.close()
+    summary = {
+        'countries': n_countries,
+        'aggregates': len(AGGREGATES),
+        'years': n_years,
+        'first_year': int(first_year),
+        'last_year': int(last_year),
+        'indicators': n_indicators,
+        'informative': n_informative,
+        'missing': missing,
+        'values': n_values,
+        'seconds': time.perf_counter() - start,
+    }
+    logging.info(f'Synthetic database {path}: {summary}')
+    return summary
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("path", help="File of the database")
+parser.add_argument("--countries", type=int, default=200, help="Number of countries")
+parser.add_argument("--years", type=int, default=50, help="Number of years")
+parser.add_argument("--indicators", type=int, default=100, help="Number of indicators")
+parser.add_argument("--missing", type=float, default=0.2,
+                    help="Probability of each value to be missing")
+parser.add_argument("--informative", type=float, default=0.1,
+                    help="Share of indicators related to the response")
+parser.add_argument("--last-year", type=int, default=None, help="Last year of the data")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(generate(args.path, args.countries, args.years, args.indicators, args.missing,
+                   args.informative, args.last_year, args.seed))
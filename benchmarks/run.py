@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""Times and memory-profiles each stage of the pipeline on a synthetic
+database (see benchmarks.generate) or on an existing one, and writes the
+results as JSON, to be compared across commits.
+
+    python -m benchmarks.run --countries 200 --years 50 --indicators 100
+    python -m benchmarks.run --database db.sqlite3 --compare benchmarks/results/former.json
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks import generate
+from utils import config
+from utils import feature_selection
+from utils import feature_store
+from utils import fingerprint
+from utils import forecasting
+from utils import instrumentation
+from utils import io
+from utils import models
+from utils import query
+from utils import read_database as rd
+from utils.encoding import CountryEncoder
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+@contextlib.contextmanager
+def stage(name, stages, trace_memory=True):
+    """Measures the enclosed stage and appends it to stages.
+    The yielded dictionary can be filled with the sizes processed by the
+    stage (rows, columns, rounds...)."""
+    sizes = {}
+    if trace_memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield sizes
+    finally:
+        record = {
+            'stage': name,
+            'wall_s': time.perf_counter() - wall,
+            'cpu_s': time.process_time() - cpu,
+            'max_rss_mb': _max_rss_mb(),
+        }
+        if trace_memory:
+            record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        record.update(sizes)
+        stages.append(record)
+        line = f"{name:<16} {record['wall_s']:9.3f}s wall {record['cpu_s']:9.3f}s cpu"
+        if trace_memory:
+            line += f" {record['peak_traced_mb']:9.1f}MB peak"
+        print(line, flush=True)
+
+
+# Paths of the caches and of the model store, redirected to the work
+# directory by isolated: (module, attribute, path in the work directory).
+_ISOLATED_PATHS = [
+    (config, 'CACHE_PATH', 'cache'),
+    (config, 'MODELS_PATH', 'models'),
+    (config, 'SELECTION_PATH', 'selected_variables.json'),
+    (config, 'BEST_PARAMS_PATH', os.path.join('models', 'best_params.json')),
+    (config, 'ENSEMBLE_PATH', os.path.join('models', 'ensembles')),
+    (config, 'PANEL_SPILL_PATH', os.path.join('cache', 'spill')),
+    (config, 'PREDICTION_CACHE_PATH', os.path.join('cache', 'predictions')),
+    (config, 'DATASET_CACHE_PATH', os.path.join('cache', 'datasets')),
+    (config, 'RESULTS_PATH', 'results.sqlite3'),
+    (feature_store, 'STORE_PATH', os.path.join('cache', 'feature_store')),
+    (feature_selection, 'SCORES_CACHE_PATH', os.path.join('cache', 'feature_scores.json')),
+    (fingerprint, '_DIGESTS_FILE', os.path.join('cache', 'digests.json')),
+]
+
+
+@contextlib.contextmanager
+def isolated(work_dir):
+    """Points the caches, the selection artifacts, the tuned parameters and
+    the model store at work_dir while the pipeline runs, so that every
+    stage starts from scratch with the default parameters of config and
+    the files of the repository are left untouched."""
+    former = [(module, name, getattr(module, name)) for module, name, _ in _ISOLATED_PATHS]
+    for module, name, path in _ISOLATED_PATHS:
+        setattr(module, name, os.path.join(work_dir, path))
+    try:
+        yield
+    finally:
+        for module, name, path in former:
+            setattr(module, name, path)
+
+
+class _SpanEvents(logging.Handler):
+    """Collects the events of the spans of the pipeline (see
+    instrumentation.span) to break the stages down."""
+
+    def __init__(self):
+        super().__init__()
+        self.spans = []
+
+    def emit(self, record):
+        self.spans.append(json.loads(record.getMessage()))
+
+    def wall(self, name):
+        return sum(span['wall_s'] for span in self.spans if span['name'] == name)
+
+
+def run_pipeline(database_path, num_features=50, horizon=10, workers=1,
+                 trace_memory=True, work_dir=None):
+    """Runs every stage of the pipeline on the database and measures it.
+    The stages are the functions run by cli.py predict. The caches, the
+    selection, the tuned parameters and the model store of the repository
+    are neither read nor written (see isolated): every stage is run from
+    scratch, with the default parameters of config.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    num_features: Number of selected variables.
+    horizon: Number of years forecast after config.DB_YEAR_MAX.
+    workers: Number of processes scoring the variables.
+    trace_memory: Trace the peak memory allocated by each stage.
+    work_dir: Directory of the caches and of the temporary files.
+
+    Returns
+    -------
+    stages
+        List with the measures of each stage."""
+    events = _SpanEvents()
+    level = instrumentation.events.level
+    instrumentation.events.addHandler(events)
+    instrumentation.events.setLevel(logging.INFO)
+    try:
+        with isolated(work_dir):
+            return _run_stages(database_path, num_features, horizon, workers, trace_memory,
+                               events)
+    finally:
+        instrumentation.events.removeHandler(events)
+        instrumentation.events.setLevel(level)
+
+
+def _run_stages(database_path, num_features, horizon, workers, trace_memory, events):
+    stages = []
+    with stage('read_long', stages, trace_memory) as sizes:
+        long = query.read_long(database_path, config.exclude_list)
+        sizes['rows'] = len(long)
+    del long
+
+    with stage('feature_store', stages, trace_memory) as sizes:
+        wide = feature_store.load(database_path, config.exclude_list)
+        sizes['rows'], sizes['columns'] = wide.n_rows, len(wide.columns)
+        sizes['sparse'] = len(wide.sparse)
+        sizes['panel_mb'] = wide.nbytes / 2 ** 20
+
+    encoder = CountryEncoder.from_database(database_path)
+    with stage('residuals', stages, trace_memory) as sizes:
+        df1, groups = rd.panel_data(wide, config.PREDICTED_INDICATOR, encoder)
+        sizes['rows'], sizes['columns'] = df1.shape
+    del wide
+
+    with stage('clean_data', stages, trace_memory) as sizes:
+        df_fewNA = rd.clean_data(df1)
+        sizes['rows'], sizes['columns'] = df_fewNA.shape
+
+    with stage('select_data', stages, trace_memory) as sizes:
+        selected = rd.select_data(df_fewNA, num_features, workers=workers,
+                                  PREDICTED_INDICATOR=config.PREDICTED_INDICATOR)
+        sizes['columns'] = df_fewNA.shape[1] - 2
+        sizes['selected'] = len(selected)
+    del df1, df_fewNA
+
+    with stage('training_data', stages, trace_memory) as sizes:
+        X, X_train, y_train, groups_train, encoder = io.retrieve_training_data(
+            database_path, config.exclude_list, config.PREDICTED_INDICATOR, encoder)
+        sizes['rows'], sizes['columns'] = X_train.shape
+
+    # Binning of the data, cross-validation of the number of rounds and training
+    with stage('train', stages, trace_memory) as sizes:
+        model = models.GDPGrowthPredictor().train(X_train, y_train, groups_train, encoder,
+                                                  predicted_indicator=config.PREDICTED_INDICATOR)
+        sizes['rows'] = len(X_train)
+        sizes['rounds'] = int(model.num_boost_round)
+        sizes['cv_s'] = events.wall('cv')
+
+    with stage('forecast', stages, trace_memory) as sizes:
+        years = list(range(config.DB_YEAR_MAX + 1, config.DB_YEAR_MAX + horizon + 1))
+        predictions = forecasting.forecast(io.prediction_dataset(X), model, years, encoder,
+                                           cache=False)
+        sizes['rows'] = len(predictions)
+        sizes['horizon'] = horizon
+    return stages
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, former):
+    """Prints the ratio of the wall time and the peak memory of each stage
+    to those of former results."""
+    former_stages = {record['stage']: record for record in former['stages']}
+    print(f"\nCompared with {former.get('commit')} ({former.get('created')}):")
+    for record in results['stages']:
+        base = former_stages.get(record['stage'])
+        if base is None:
+            continue
+        line = f"{record['stage']:<16} wall x{record['wall_s'] / max(base['wall_s'], 1e-9):6.2f}"
+        if 'peak_traced_mb' in record and 'peak_traced_mb' in base:
+            line += f"  peak x{record['peak_traced_mb'] / max(base['peak_traced_mb'], 1e-9):6.2f}"
+        print(line)
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--database", help="Existing database, a synthetic one is generated if None")
+parser.add_argument("--countries", type=int, default=200, help="Number of countries")
+parser.add_argument("--years", type=int, default=50, help="Number of years")
+parser.add_argument("--indicators", type=int, default=100, help="Number of indicators")
+parser.add_argument("--missing", type=float, default=0.2,
+                    help="Probability of each value to be missing")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+parser.add_argument("--features", type=int, default=50, help="Number of selected variables")
+parser.add_argument("--horizon", type=int, default=10, help="Number of years forecast")
+parser.add_argument("--workers", type=int, default=1,
+                    help="Number of processes scoring the variables")
+parser.add_argument("--no-memory", action="store_true",
+                    help="Do not trace the memory allocations, which slows the stages down")
+parser.add_argument("--output", default=None,
+                    help="JSON file of the results. Per default, in benchmarks/results")
+parser.add_argument("--compare", default=None, help="JSON results to compare with")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(asctime)s - [%(levelname)s] - %(message)s")
+    with tempfile.TemporaryDirectory() as work_dir:
+        database_path = args.database
+        if database_path is None:
+            database_path = os.path.join(work_dir, 'bench.sqlite3')
+            dataset = generate.generate(database_path, args.countries, args.years,
+                                        args.indicators, args.missing, seed=args.seed)
+            print(f"Generated {dataset['values']} values in {dataset['seconds']:.1f}s")
+        else:
+            dataset = {'database': os.path.abspath(database_path)}
+        stages = run_pipeline(database_path, args.features, args.horizon, args.workers,
+                              not args.no_memory, work_dir)
+    results = {
+        'commit': _commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'dataset': dataset,
+        'parameters': {'features': args.features, 'horizon': args.horizon,
+                       'workers': args.workers},
+        'stages': stages,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_PATH, exist_ok=True)
+        output = os.path.join(RESULTS_PATH, datetime.now().strftime('%Y%m%d_%H%M%S')
+                              + f"_{results['commit'] or 'nocommit'}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Measures the startup time of the command line and the import time of the
+modules of utils, each in a fresh interpreter, and checks that none of them
+loads a heavy dependency it does not need. Exits with status 1 on a
+regression, so it can guard the startup time in CI.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 10 --max-help-seconds 0.3
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencies that each module must not load when imported. The stages
+# that need them import them when they run.
+FORBIDDEN = {
+    'cli': ['numpy', 'pandas', 'gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.io': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.read_database': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.models': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.service': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.tuning': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.scenarios': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.backtest': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.ingest': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.prediction_cache': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+    'utils.ensemble': ['gpboost', 'sklearn', 'scipy', 'statsmodels'],
+}
+
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                   'loaded': [name for name in {forbidden!r} if name in sys.modules]}}))
+'''
+
+
+def import_time(module, runs=5):
+    """Median import time of module in a fresh interpreter and the
+    forbidden dependencies it loaded (see FORBIDDEN)."""
+    probe = _PROBE.format(module=module, forbidden=FORBIDDEN.get(module, []))
+    measures = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', probe], capture_output=True,
+                                text=True, check=True, cwd=BASE_DIR).stdout
+        measures.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'seconds': statistics.median(measure['seconds'] for measure in measures),
+        'loaded': measures[-1]['loaded'],
+    }
+
+
+def help_time(runs=5):
+    """Median wall time of python cli.py --help, interpreter startup included."""
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'cli.py', '--help'], capture_output=True,
+                       check=True, cwd=BASE_DIR)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--runs", type=int, default=5, help="Number of runs of each measure")
+parser.add_argument("--max-help-seconds", type=float, default=0.5,
+                    help="Maximum wall time of cli.py --help")
+parser.add_argument("--output", default=None, help="JSON file of the results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    failures = []
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'imports': {},
+    }
+    results['help_s'] = help_time(args.runs)
+    print(f"{'cli.py --help':<28} {results['help_s']:7.3f}s")
+    if results['help_s'] > args.max_help_seconds:
+        failures.append(f"cli.py --help took {results['help_s']:.3f}s, "
+                        f"more than {args.max_help_seconds}s")
+    for module in FORBIDDEN:
+        measure = import_time(module, args.runs)
+        results['imports'][module] = measure
+        print(f"{'import ' + module:<28} {measure['seconds']:7.3f}s"
+              + (f"  loads {', '.join(measure['loaded'])}" if measure['loaded'] else ''))
+        if measure['loaded']:
+            failures.append(f"{module} loads {', '.join(measure['loaded'])} at import")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    sys.exit(1 if failures else 0)
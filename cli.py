@@ -1,26 +1,18 @@
 #!/usr/bin/env python
-import os
 import logging
 import argparse
-import gpboost as gpb
-from datetime import datetime
-import pandas as pd
-import sqlite3
 
-from utils import config, io, models
-from utils import io_aux_train as training
-from utils import io_aux_test as testing
-
-logging.basicConfig(
-    filename=os.path.join(config.LOGS_PATH, datetime.now().strftime('cli_%Y-%m-%d_%H:%M:%S.log')),
-    format="%(asctime)s - [%(levelname)s] - %(message)s",
-    level=logging.INFO,
-)
+# Only the light modules are imported here, the stages of each task are
+# imported when it runs (see run), so that the heavy dependencies (pandas,
+# gpboost, sklearn, scipy) are only loaded by the tasks that need them.
+from utils import config
+from utils import instrumentation
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "task",
-    choices=["predict"],
+    choices=["predict", "tune", "select", "update", "serve", "scenarios", "backtest", "ingest",
+             "ensemble", "index"],
     help="Task to be performed",
 )
 
@@ -30,30 +22,259 @@ parser.add_argument(
     help="Year of prediction",
     default=2011
 )
+
+parser.add_argument(
+    "--years",
+    help="Years of prediction, e.g. 2011-2030 or 2011,2015. Overrides --year",
+    default=None
+)
+
+parser.add_argument(
+    "--workers",
+    type=int,
+    help="Number of worker processes of the tuning, the selection and the indicators "
+         "predicted. Per default, one per core",
+    default=None
+)
+
+parser.add_argument(
+    "--targets",
+    help="Comma-separated indicators to select and predict. "
+         "Per default: config.PREDICTED_INDICATORS",
+    default=None
+)
+
+parser.add_argument(
+    "--search",
+    choices=["grid", "random"],
+    help="Search strategy of the tuning",
+    default="grid"
+)
+
+parser.add_argument(
+    "--candidates",
+    type=int,
+    help="Number of configurations evaluated by the random search",
+    default=20
+)
+
+parser.add_argument(
+    "--check",
+    action="store_true",
+    help="Compare the updated model with a full training and keep the best one",
+)
+
+parser.add_argument(
+    "--host",
+    help="Host name of the prediction service",
+    default=config.SERVE_HOST
+)
+
+parser.add_argument(
+    "--port",
+    type=int,
+    help="Port of the prediction service",
+    default=config.SERVE_PORT
+)
+
+parser.add_argument(
+    "--results",
+    help="Database where the predictions are written",
+    default=config.RESULTS_PATH
+)
+
+parser.add_argument(
+    "--scenarios",
+    type=int,
+    help="Number of Monte Carlo paths per country of the scenarios",
+    default=config.SCENARIO_COUNT
+)
+
+parser.add_argument(
+    "--spec",
+    help="JSON perturbation spec of the scenarios (see scenarios.read_spec). "
+         "Per default: config.SCENARIO_SPEC",
+    default=None
+)
+
+parser.add_argument(
+    "--origins",
+    help="Origin years of the backtest, such as 1975-2009. Per default: config.BACKTEST_ORIGINS",
+    default=config.BACKTEST_ORIGINS
+)
+
+parser.add_argument(
+    "--horizons",
+    type=int,
+    help="Years predicted after each origin of the backtest",
+    default=config.BACKTEST_HORIZONS
+)
+
+parser.add_argument(
+    "--data",
+    help="WDI CSV file of the values to ingest (WDIData.csv or Indicators.csv)",
+    default=None
+)
+
+parser.add_argument(
+    "--countries",
+    help="WDI CSV file of the countries to ingest (WDICountry.csv or Country.csv)",
+    default=None
+)
+
+parser.add_argument(
+    "--series",
+    help="WDI CSV file of the indicators to ingest (WDISeries.csv or Series.csv)",
+    default=None
+)
+
+parser.add_argument(
+    "--members",
+    type=int,
+    help="Number of models of the ensemble",
+    default=config.ENSEMBLE_MEMBERS
+)
+
+parser.add_argument(
+    "--resampling",
+    choices=["bootstrap", "country"],
+    help="Resampling of the training data of each model of the ensemble",
+    default=config.ENSEMBLE_RESAMPLING
+)
+
+parser.add_argument(
+    "--memory-budget",
+    type=float,
+    help="Memory budget in MB of the wide panel of the indicators, and of the "
+         "training workers of the ensemble. Per default, no limit",
+    default=config.PANEL_MEMORY_BUDGET
+)
+
+parser.add_argument(
+    "--no-spill",
+    action="store_true",
+    help="Fail instead of spilling to disk a panel over the memory budget",
+)
+
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Write cProfile and tracemalloc reports of the slowest stage to the logs",
+)
+
+
+def retrieve_training_data():
+    """Covariable-cleaned dataset, the training data derived from it and
+    the country encoder of the groups (see io.retrieve_training_data)."""
+    from utils import io
+    return io.retrieve_training_data(config.DATABASE_PATH, config.exclude_list,
+                                     config.PREDICTED_INDICATOR)
     
 
+def run(args):
+    """Runs the task of the command line arguments."""
+    if args.task == "predict":
+        from utils import forecasting, targets
+        years = forecasting.parse_years(args.years) if args.years else [int(args.year)]
+        logging.info('Starting the train and the prediction')
+        targets.predict(config.DATABASE_PATH, config.exclude_list,
+                        targets.parse_targets(args.targets), years, args.workers, args.results)
+    elif args.task == "tune":
+        from utils import tuning
+        X, X_train, y_train, groups_train, encoder = retrieve_training_data()
+        logging.info('Starting the hyperparameter search')
+        best = tuning.tune(X_train, y_train, groups_train, search=args.search,
+                           n_candidates=args.candidates, workers=args.workers)
+        logging.info(f"Best configuration: {best['params']}, {best['gp_optim_params']}")
+    elif args.task == "select":
+        from utils import targets
+        logging.info("Selecting relevant covariables")
+        targets.select(config.DATABASE_PATH, config.exclude_list,
+                       targets.parse_targets(args.targets), workers=args.workers)
+    elif args.task == "update":
+        from utils import feature_store, models
+        logging.info("Updating the feature store with the new rows of the database")
+        added = feature_store.added_rows(config.DATABASE_PATH, config.exclude_list)
+        X, X_train, y_train, groups_train, encoder = retrieve_training_data()
+        logging.info('Updating the model')
+        models.update_or_train(X_train, y_train, groups_train, config.DATABASE_PATH,
+                               added, encoder, check=args.check)
+    elif args.task == "scenarios":
+        import os
+        from datetime import datetime
+        from utils import forecasting, io, models, scenarios
+        X, X_train, y_train, groups_train, encoder = retrieve_training_data()
+        model = models.load_or_train(X_train, y_train, groups_train, config.DATABASE_PATH,
+                                     encoder)
+        years = (forecasting.parse_years(args.years) if args.years
+                 else [config.DB_YEAR_MAX + 1])
+        summary = scenarios.simulate(io.prediction_dataset(X), model, years, encoder,
+                                     scenarios.read_spec(args.spec), args.scenarios)
+        os.makedirs(config.SCENARIOS_PATH, exist_ok=True)
+        fname = os.path.join(config.SCENARIOS_PATH,
+                             datetime.now().strftime('scenarios_%Y-%m-%d_%H:%M:%S.csv'))
+        summary.to_csv(fname, index=False)
+        logging.info(f'Quantiles of {args.scenarios} scenarios written to {fname}')
+    elif args.task == "backtest":
+        import os
+        from datetime import datetime
+        from utils import backtest, forecasting
+        table, seconds = backtest.backtest(config.DATABASE_PATH, config.exclude_list,
+                                           config.PREDICTED_INDICATOR,
+                                           forecasting.parse_years(args.origins),
+                                           args.horizons, args.workers)
+        os.makedirs(config.BACKTEST_PATH, exist_ok=True)
+        fname = os.path.join(config.BACKTEST_PATH,
+                             datetime.now().strftime('backtest_%Y-%m-%d_%H:%M:%S.csv'))
+        table.to_csv(fname, index=False)
+        summary = table.groupby(['Horizon', 'Group'])[['RMSE', 'MAE']].mean()
+        logging.info(f'Mean errors over the origins:\n{summary}')
+        logging.info(f'Backtest written to {fname} in {seconds:.1f}s')
+    elif args.task == "ingest":
+        from utils import ingest
+        if args.data is None:
+            parser.error("the task ingest requires --data")
+        logging.info(f'Building the database from {args.data}')
+        ingest.ingest(args.data, args.countries, args.series, results_path=args.results)
+    elif args.task == "ensemble":
+        import os
+        from datetime import datetime
+        from utils import ensemble, forecasting, io
+        X, X_train, y_train, groups_train, encoder = retrieve_training_data()
+        members = ensemble.train(X_train, y_train, groups_train, config.DATABASE_PATH,
+                                 encoder, args.members, args.resampling, args.workers,
+                                 args.memory_budget)
+        years = forecasting.parse_years(args.years) if args.years else [int(args.year)]
+        intervals = ensemble.forecast(io.prediction_dataset(X), members, years, encoder)
+        os.makedirs(config.INTERVALS_PATH, exist_ok=True)
+        fname = os.path.join(config.INTERVALS_PATH,
+                             datetime.now().strftime('intervals_%Y-%m-%d_%H:%M:%S.csv'))
+        intervals.to_csv(fname, index=False)
+        logging.info(f'Intervals of {len(members)} models written to {fname}')
+    elif args.task == "index":
+        import sqlite3
+        from utils import query
+        logging.info(f'Creating the indexes of {config.DATABASE_PATH}')
+        conn = sqlite3.connect(config.DATABASE_PATH)
+        try:
+            query.ensure_indexes(conn)
+        finally:
+            conn.close()
+    elif args.task == "serve":
+        from utils import service
+        service.serve(args.host, args.port)
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
-    if args.task == "predict":
-    	logging.info("Determining relevant covariables")
-    	X  = io.retrieve_clean_dataset(database_path=config.DATABASE_PATH, exclude_list=config.exclude_list, PREDICTED_INDICATOR=config.PREDICTED_INDICATOR)
-    	logging.info('Starting the train')
-    	X.columns = X.columns.str.replace(".","_")
-    	X = X.reset_index(drop=True)
-    	pred_ind  = config.PREDICTED_INDICATOR.replace(".","_")
-    	(X_train, y_train, data_train, groups_train) = training.retrieve_training_dataset(X, 
-    	predicted_indicator=pred_ind)
-    	(gp_model, params, opt_num_boost_rounds) = training.get_booster_model(data_train, groups_train)
-    	bst = gpb.train(params=params, train_set=data_train, gp_model=gp_model, num_boost_round=opt_num_boost_rounds)
-    	logging.info('Starting the prediction')
-    	X = X.set_index("Time")
-    	X["Time"] = X.index.get_level_values(0)      
-    	X_test, group_test = testing.retrieve_test_data(X, bst, int(args.year))
-    	pred = bst.predict(data=X_test, group_data_pred=group_test)
-    	y_pred = pred['fixed_effect'] + pred['random_effect_mean']
-    	prediction_pd = pd.DataFrame(data={'y_pred':y_pred,'Country': pd.unique(X['Country']),'Year': args.year})
-    	conn = sqlite3.connect("db.sqlite3")
-    	#c = conn.cursor()
-    	#c.execute('CREATE TABLE EstimatedGDPGrowth (y_pred number, Country text, Year text)')
-    	#conn.commit()
-    	prediction_pd.to_sql('EstimatedGDPGrowth', conn, if_exists='replace', index=False)
+    config.PANEL_MEMORY_BUDGET = args.memory_budget
+    config.PANEL_SPILL = not args.no_spill
+    instrumentation.setup_logging()
+    if args.profile:
+        instrumentation.enable_profiling()
+    try:
+        with instrumentation.span(args.task):
+            run(args)
+    finally:
+        if args.profile:
+            instrumentation.write_profile()
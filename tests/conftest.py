@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# The modules are imported as in cli.py, from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    """Points the database, the caches, the selection, the tuned parameters,
+    the model store and the results database at a temporary directory,
+    which is also the working directory (see io.selection_file)."""
+    from utils import config
+    from utils import feature_selection
+    from utils import feature_store
+    from utils import fingerprint
+    from utils import prediction_cache
+    paths = [
+        (config, 'DATABASE_PATH', 'db.sqlite3'),
+        (config, 'CACHE_PATH', 'cache'),
+        (config, 'MODELS_PATH', 'models'),
+        (config, 'SELECTION_PATH', 'selected_variables.json'),
+        (config, 'BEST_PARAMS_PATH', os.path.join('models', 'best_params.json')),
+        (config, 'ENSEMBLE_PATH', os.path.join('models', 'ensembles')),
+        (config, 'PANEL_SPILL_PATH', os.path.join('cache', 'spill')),
+        (config, 'PREDICTION_CACHE_PATH', os.path.join('cache', 'predictions')),
+        (config, 'DATASET_CACHE_PATH', os.path.join('cache', 'datasets')),
+        (config, 'RESULTS_PATH', 'results.sqlite3'),
+        (feature_store, 'STORE_PATH', os.path.join('cache', 'feature_store')),
+        (feature_selection, 'SCORES_CACHE_PATH', os.path.join('cache', 'feature_scores.json')),
+        (fingerprint, '_DIGESTS_FILE', os.path.join('cache', 'digests.json')),
+    ]
+    for module, name, path in paths:
+        monkeypatch.setattr(module, name, str(tmp_path / path))
+    monkeypatch.setattr(config, 'SELECTION_WORKERS', 1)
+    monkeypatch.setattr(prediction_cache, '_default', None)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
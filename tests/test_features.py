@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import config
+from utils import features
+
+INDICATOR = 'NY.GDP.MKTP.KD.ZG'
+COVARIATE = 'SP.POP.TOTL'
+
+
+@pytest.fixture
+def feature_config(monkeypatch):
+    monkeypatch.setattr(config, 'PREDICTED_INDICATOR', INDICATOR)
+    monkeypatch.setattr(config, 'FEATURE_INDICATORS', [COVARIATE])
+    monkeypatch.setattr(config, 'FEATURE_LAGS', [1, 2])
+    monkeypatch.setattr(config, 'FEATURE_DIFFS', [1])
+    monkeypatch.setattr(config, 'FEATURE_WINDOWS', [3])
+    return features.specs()
+
+
+def panel(n_countries=5, first=2001, last=2010, seed=0):
+    """Panel of the response and of the covariate, with its features."""
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([[f'C{i}' for i in range(n_countries)],
+                                        range(first, last + 1)])
+    frame = pd.DataFrame({INDICATOR: rng.normal(3., 2., len(index)),
+                          COVARIATE: rng.normal(10., 1., len(index))}, index=index)
+    return frame
+
+
+def test_advance_matches_features_of_the_extended_panel(feature_config):
+    """Every step of the chain has the features that compute gives on the
+    panel extended with the predictions and the covariates of the chain."""
+    frame = panel()
+    generated = features.generate(frame, feature_config)
+    data = pd.concat([frame, generated], axis=1)
+    data.columns = data.columns.str.replace('.', '_', regex=False)
+    columns = list(data.columns)
+    start = data.xs(2010, level=1)
+    values = start.to_numpy(dtype=np.float64)
+    history = features.history(data.index.get_level_values(0), data.index.get_level_values(1),
+                               features.indicator_columns(data, feature_config), 2010,
+                               features.depth(feature_config))
+    rng = np.random.default_rng(1)
+    extended = frame.copy()
+    for year in range(2011, 2015):
+        y_pred = rng.normal(3., 2., len(values))
+        # Covariate of the year predicted, changed by the caller as in scenarios
+        values[:, columns.index(COVARIATE.replace('.', '_'))] += rng.normal(0., 1., len(values))
+        history = features.advance(values, columns, history, y_pred)
+        step = pd.DataFrame(values[:, :2], columns=[INDICATOR, COVARIATE],
+                            index=pd.MultiIndex.from_product([start.index, [year]]))
+        extended = pd.concat([extended, step]).sort_index()
+        expected = features.generate(extended, feature_config).xs(year, level=1)
+        np.testing.assert_allclose(values[:, 2:], expected.to_numpy(), rtol=1e-5)
+
+
+def test_advance_keeps_the_features_of_an_indicator_without_column(feature_config):
+    frame = panel()
+    generated = features.generate(frame, feature_config)
+    data = pd.concat([frame[[INDICATOR]], generated], axis=1)
+    data.columns = data.columns.str.replace('.', '_', regex=False)
+    columns = list(data.columns)
+    values = data.xs(2010, level=1).to_numpy(dtype=np.float64)
+    history = features.history(data.index.get_level_values(0), data.index.get_level_values(1),
+                               features.indicator_columns(data, feature_config), 2010,
+                               features.depth(feature_config))
+    covariate = [j for j, name in enumerate(columns) if name.startswith('SP_POP_TOTL_')]
+    before = values[:, covariate].copy()
+    features.advance(values, columns, history, np.zeros(len(values)))
+    np.testing.assert_array_equal(values[:, covariate], before)
+    np.testing.assert_array_equal(values[:, columns.index('lag1')],
+                                  data.xs(2010, level=1)[INDICATOR.replace('.', '_')])
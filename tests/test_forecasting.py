@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+from benchmarks import generate
+from utils import config
+from utils import forecasting
+from utils import io
+from utils import models
+from utils import io_aux_test as testing
+from utils.prediction_cache import PredictionCache
+
+
+@pytest.fixture
+def stored_model(work_dir):
+    """Prediction data of a small synthetic database and a model of the
+    model store, whose forecasts are cached."""
+    generate.generate(config.DATABASE_PATH, n_countries=20, n_years=20, n_indicators=8,
+                      last_year=config.DB_YEAR_MAX, seed=0)
+    X, X_train, y_train, groups_train, encoder = io.retrieve_training_data(
+        config.DATABASE_PATH, config.exclude_list, config.PREDICTED_INDICATOR)
+    model = models.load_or_train(X_train, y_train, groups_train, config.DATABASE_PATH, encoder)
+    return io.prediction_dataset(X), model, encoder
+
+
+def counted(monkeypatch):
+    """Counts the calls to the model."""
+    calls = []
+    predict = testing.predict
+
+    def count(*args, **kwargs):
+        calls.append(1)
+        return predict(*args, **kwargs)
+
+    monkeypatch.setattr(testing, 'predict', count)
+    return calls
+
+
+def test_cached_forecast_is_not_computed_again(stored_model, work_dir, monkeypatch):
+    X, model, encoder = stored_model
+    years = list(range(config.DB_YEAR_MAX - 2, config.DB_YEAR_MAX + 4))
+    expected = forecasting.forecast(X, model, years, encoder, cache=False)
+    first = forecasting.forecast(X, model, years, encoder, cache=PredictionCache())
+    pd.testing.assert_frame_equal(first, expected)
+
+    def recompute(*args, **kwargs):
+        raise AssertionError('The model was called again')
+
+    monkeypatch.setattr(testing, 'predict', recompute)
+    # A new cache reads the entries written to disk by the former one
+    pd.testing.assert_frame_equal(
+        forecasting.forecast(X, model, years, encoder, cache=PredictionCache()), expected)
+
+
+def test_longer_horizon_resumes_the_chain(stored_model, work_dir, monkeypatch):
+    X, model, encoder = stored_model
+    years = list(range(config.DB_YEAR_MAX + 1, config.DB_YEAR_MAX + 6))
+    expected = forecasting.forecast(X, model, years, encoder, cache=False)
+    cache = PredictionCache()
+    forecasting.forecast(X, model, years[:2], encoder, cache=cache)
+    calls = counted(monkeypatch)
+    resumed = forecasting.forecast(X, model, years, encoder, cache=cache)
+    assert len(calls) == 3
+    pd.testing.assert_frame_equal(resumed, expected)
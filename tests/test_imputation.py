@@ -0,0 +1,63 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import read_database as rd
+
+
+def reference_clean_data(df, threshold=0.3):
+    """clean_data before the vectorized imputation, with a groupby lambda."""
+    df_fewNA = df[df.columns[(df.isnull().sum(axis=0)/df.shape[0]<=threshold)]]
+    country2 = df_fewNA['Country']
+    df_fewNA = df_fewNA.groupby(country2).transform(lambda x: x.fillna(x.ffill().bfill()))
+    df_fewNA = df_fewNA.fillna(df.mean())
+    df_fewNA["Country"] = country2
+    return df_fewNA
+
+
+def panel(seed, n_countries=12, n_years=15, n_columns=30):
+    """Output of linear_model: shuffled rows of the countries, columns with
+    random NaN ratios and columns without any value for whole countries."""
+    rng = np.random.default_rng(seed)
+    country = np.repeat(np.arange(n_countries), n_years)
+    values = rng.normal(size=(len(country), n_columns))
+    ratios = rng.uniform(0., 0.6, n_columns)
+    values[rng.uniform(size=values.shape) < ratios] = np.nan
+    for j in rng.choice(n_columns, n_columns // 3, replace=False):
+        values[country == rng.integers(n_countries), j] = np.nan
+    df = pd.DataFrame(values, columns=[f'X_{j}' for j in range(n_columns)])
+    df['residuals'] = rng.normal(size=len(country))
+    df['Country'] = country
+    return df.sample(frac=1., random_state=seed)
+
+
+def compare(df, threshold=0.3, **kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = reference_clean_data(df.copy(), threshold)
+    result = rd.clean_data(df.copy(), threshold, **kwargs)
+    assert sorted(result.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_same_results_as_the_groupby_imputation(seed):
+    compare(panel(seed))
+
+
+@pytest.mark.parametrize('chunk_size, workers', [(1, 1), (4, 1), (7, 3), (128, 4)])
+def test_chunks_and_workers(chunk_size, workers):
+    compare(panel(100), chunk_size=chunk_size, workers=workers)
+
+
+def test_threshold_edge():
+    # 100 rows: a column with 30 NaN is kept, one with 31 is rejected
+    df = panel(200, n_countries=10, n_years=10, n_columns=4).sort_index()
+    df[['X_0', 'X_1']] = df[['X_0', 'X_1']].fillna(0.)
+    df.loc[:29, 'X_0'] = np.nan
+    df.loc[:30, 'X_1'] = np.nan
+    result = rd.clean_data(df.copy(), 0.3)
+    assert 'X_0' in result.columns and 'X_1' not in result.columns
+    compare(df)
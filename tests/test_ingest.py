@@ -0,0 +1,53 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from utils import ingest
+
+GDP = ('GDP growth (annual %)', 'NY.GDP.MKTP.KD.ZG')
+POP = ('Population, total', 'SP.POP.TOTL')
+
+
+def long_file(path):
+    """Indicators.csv layout, one row per value. The last row repeats a
+    value of the first one."""
+    rows = [('France', 'FRA', *GDP, 2000, 1.), ('France', 'FRA', *GDP, 2001, 2.),
+            ('Germany', 'DEU', *GDP, 2000, 3.), ('Germany', 'DEU', *POP, 2000, 80.),
+            ('France', 'FRA', *GDP, 2000, 1.5)]
+    pd.DataFrame(rows, columns=ingest.VALUE_COLUMNS).to_csv(path, index=False)
+
+
+def wide_file(path):
+    """WDIData.csv layout, one column per year. The last row repeats the
+    values of the first one, with a missing year."""
+    rows = [('France', 'FRA', *GDP, 1., 2.), ('Germany', 'DEU', *GDP, 3., None),
+            ('Germany', 'DEU', *POP, 80., None), ('France', 'FRA', *GDP, 1.5, None)]
+    pd.DataFrame(rows, columns=['Country Name', 'Country Code', 'Indicator Name',
+                                'Indicator Code', '2000', '2001']).to_csv(path, index=False)
+
+
+def values(path):
+    conn = sqlite3.connect(path)
+    try:
+        return pd.read_sql('SELECT CountryCode, IndicatorCode, Year, Value '
+                           'FROM CountryIndicators;', conn)
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('layout', [long_file, wide_file])
+@pytest.mark.parametrize('chunksize', [2, 100])
+def test_both_layouts_keep_the_last_repeated_value(tmp_path, layout, chunksize):
+    data_path = str(tmp_path / 'data.csv')
+    database_path = str(tmp_path / 'db.sqlite3')
+    layout(data_path)
+    summary = ingest.ingest(data_path, database_path=database_path, chunksize=chunksize,
+                            transaction_rows=2, results_path=str(tmp_path / 'results.sqlite3'))
+    assert summary['duplicates'] == 1
+    assert summary['values'] == 4
+    assert summary['countries'] == 2 and summary['indicators'] == 2
+    stored = values(database_path).set_index(['CountryCode', 'IndicatorCode', 'Year'])['Value']
+    assert stored.index.is_unique
+    assert stored.to_dict() == {('FRA', GDP[1], 2000): 1.5, ('FRA', GDP[1], 2001): 2.,
+                                ('DEU', GDP[1], 2000): 3., ('DEU', POP[1], 2000): 80.}
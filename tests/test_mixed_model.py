@@ -0,0 +1,66 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import config
+from utils import mixed_model
+
+INDICATOR = 'NY_GDP_MKTP_KD_ZG'
+
+
+def panel(n_countries=40, n_years=30, sigma_group=1.5, seed=0):
+    """Panel of y ~ 1 + lag1 with a random intercept per country of
+    standard deviation sigma_group."""
+    rng = np.random.default_rng(seed)
+    groups = np.repeat(np.arange(n_countries), n_years)
+    lag1 = rng.normal(3., 2., len(groups))
+    intercept = rng.normal(0., sigma_group, n_countries)[groups]
+    y = 1. + 0.4 * lag1 + intercept + rng.normal(0., 1., len(groups))
+    return pd.DataFrame({INDICATOR: y, 'lag1': lag1}), groups
+
+
+def max_difference(df, groups):
+    fast = mixed_model.residuals(df, INDICATOR, groups, backend='numpy')
+    with warnings.catch_warnings():
+        # statsmodels warns when the variance of the groups is on the boundary
+        warnings.simplefilter('ignore')
+        reference = mixed_model.residuals(df, INDICATOR, groups, backend='statsmodels')
+    return np.max(np.abs(fast - reference))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_residuals_match_statsmodels(seed):
+    df, groups = panel(seed=seed)
+    assert max_difference(df, groups) < config.RESIDUALS_TOLERANCE
+
+
+def test_residuals_match_statsmodels_unbalanced():
+    df, groups = panel(seed=2)
+    keep = np.random.default_rng(2).random(len(groups)) < 0.7
+    assert max_difference(df[keep].reset_index(drop=True), groups[keep]) \
+        < config.RESIDUALS_TOLERANCE
+
+
+def test_residuals_match_statsmodels_zero_group_variance():
+    df, groups = panel(sigma_group=0., seed=3)
+    # Noise of mean 0 in every country: the estimated variance of the groups is 0
+    noise = df[INDICATOR] - 1. - 0.4 * df['lag1']
+    df[INDICATOR] -= noise.groupby(groups).transform('mean')
+    fit = mixed_model.fit_random_intercept(df[INDICATOR], df['lag1'], groups)
+    assert fit['sigma2_group'] == 0.
+    assert max_difference(df, groups) < config.RESIDUALS_TOLERANCE
+
+
+def test_verify_backend():
+    df, groups = panel(seed=4)
+    np.testing.assert_allclose(
+        mixed_model.residuals(df, INDICATOR, groups, backend='verify'),
+        mixed_model.residuals(df, INDICATOR, groups, backend='numpy'))
+
+
+def test_unknown_backend():
+    df, groups = panel(n_countries=5, n_years=5)
+    with pytest.raises(ValueError):
+        mixed_model.residuals(df, INDICATOR, groups, backend='scipy')
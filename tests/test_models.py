@@ -0,0 +1,52 @@
+import numpy as np
+
+from benchmarks import generate
+from utils import config
+from utils import io
+from utils import io_aux_train as training
+from utils import models
+from utils import tuning
+
+
+def test_loaded_model_predicts_as_the_trained_one(work_dir):
+    generate.generate(config.DATABASE_PATH, n_countries=30, n_years=20, n_indicators=8,
+                      last_year=2009, seed=0)
+    X, X_train, y_train, groups_train, encoder = io.retrieve_training_data(
+        config.DATABASE_PATH, config.exclude_list, config.PREDICTED_INDICATOR)
+    trained = models.GDPGrowthPredictor().train(X_train, y_train, groups_train, encoder,
+                                                predicted_indicator=config.PREDICTED_INDICATOR)
+    trained.save(str(work_dir / 'model'))
+    loaded = models.GDPGrowthPredictor.load(str(work_dir / 'model'))
+    assert loaded.feature_names == trained.feature_names
+    assert loaded.num_boost_round == trained.num_boost_round
+    expected = trained.predict(X_train, groups_train)
+    pred = loaded.predict(X_train, groups_train)
+    np.testing.assert_allclose(pred['fixed_effect'], expected['fixed_effect'])
+    np.testing.assert_allclose(pred['random_effect_mean'], expected['random_effect_mean'],
+                               rtol=1e-6, atol=1e-9)
+    # Group without training data
+    unseen = np.full(len(X_train), np.max(groups_train) + 1)
+    pred = loaded.predict(X_train, unseen)
+    np.testing.assert_allclose(pred['fixed_effect'], expected['fixed_effect'])
+    np.testing.assert_array_equal(pred['random_effect_mean'], 0.)
+
+
+def test_tuned_rounds_skip_the_cross_validation(work_dir, monkeypatch):
+    generate.generate(config.DATABASE_PATH, n_countries=20, n_years=20, n_indicators=8,
+                      last_year=2009, seed=0)
+    X, X_train, y_train, groups_train, encoder = io.retrieve_training_data(
+        config.DATABASE_PATH, config.exclude_list, config.PREDICTED_INDICATOR)
+    untuned = models.training_fingerprint(config.DATABASE_PATH, X_train, y_train, groups_train)
+    tuning.save_best_params({'params': dict(config.BOOSTER_PARAMS),
+                             'gp_optim_params': dict(config.GP_OPTIM_PARAMS),
+                             'num_boost_round': 7},
+                            training.best_params_path())
+
+    def cross_validate(*args, **kwargs):
+        raise AssertionError('The number of rounds was cross-validated')
+
+    monkeypatch.setattr(training, 'get_booster_model', cross_validate)
+    predictor = models.load_or_train(X_train, y_train, groups_train, config.DATABASE_PATH,
+                                     encoder)
+    assert predictor.num_boost_round == 7
+    assert predictor.fingerprint != untuned
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+
+import pandas as pd
+
+from utils import config
+from utils import results
+
+
+def legacy_database(path):
+    """Database with the table of predictions replaced at every run."""
+    conn = sqlite3.connect(path)
+    conn.execute(f'CREATE TABLE {results.TABLE} (y_pred REAL, Country TEXT, Year TEXT);')
+    conn.executemany(f'INSERT INTO {results.TABLE} VALUES (?, ?, ?);',
+                     [(1.5, 'FRA', '2011'), (2.5, 'DEU', '2011')])
+    conn.commit()
+    conn.close()
+
+
+def test_reading_does_not_write(tmp_path):
+    path = str(tmp_path / 'results.sqlite3')
+    legacy_database(path)
+    with open(path, 'rb') as f:
+        before = f.read()
+    predictions = results.read_predictions(path)
+    assert list(predictions.columns) == results.COLUMNS
+    assert sorted(predictions['Country']) == ['DEU', 'FRA']
+    assert (predictions['model_version'] == results.LEGACY_VERSION).all()
+    assert (predictions['Indicator'] == config.PREDICTED_INDICATOR).all()
+    with open(path, 'rb') as f:
+        assert f.read() == before
+    assert not os.path.exists(path + '-wal')
+
+
+def test_reading_a_missing_database(tmp_path):
+    path = str(tmp_path / 'results.sqlite3')
+    assert results.read_predictions(path).empty
+    assert not os.path.exists(path)
+
+
+def test_writing_again_updates_the_predictions(tmp_path):
+    path = str(tmp_path / 'results.sqlite3')
+    first = pd.DataFrame({'y_pred': [1., 2.], 'Country': ['FRA', 'DEU'], 'Year': [2011, 2011]})
+    results.write_predictions(first, 'v1', path, run_id='a')
+    results.write_predictions(first.assign(y_pred=[3., 4.]), 'v1', path, run_id='b')
+    # Same key for another version and another indicator
+    results.write_predictions(first, 'v2', path, run_id='c')
+    results.write_predictions(first, 'v1', path, run_id='d', indicator='FP.CPI.TOTL.ZG')
+    predictions = results.read_predictions(path, model_version='v1',
+                                           indicator=config.PREDICTED_INDICATOR)
+    assert len(predictions) == 2
+    assert predictions.set_index('Country')['y_pred'].to_dict() == {'FRA': 3., 'DEU': 4.}
+    assert (predictions['run_id'] == 'b').all()
+    assert len(results.read_predictions(path)) == 6
+
+
+def test_legacy_table_is_migrated(tmp_path):
+    path = str(tmp_path / 'results.sqlite3')
+    legacy_database(path)
+    results.connect(path).close()
+    conn = sqlite3.connect(path)
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({results.TABLE});')]
+    conn.close()
+    assert columns == results.COLUMNS
+    predictions = results.read_predictions(path)
+    assert predictions.set_index('Country')['y_pred'].to_dict() == {'FRA': 1.5, 'DEU': 2.5}
+    assert (predictions['Year'] == 2011).all()
+    assert (predictions['model_version'] == results.LEGACY_VERSION).all()
+    # The migrated predictions are updated as the ones of a current table
+    results.write_predictions(pd.DataFrame({'y_pred': [0.5], 'Country': ['FRA'], 'Year': [2011]}),
+                              results.LEGACY_VERSION, path)
+    predictions = results.read_predictions(path, countries=['FRA'])
+    assert predictions['y_pred'].tolist() == [0.5]
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from utils import io_aux_train as training
+
+INDICATOR = 'NY_GDP_MKTP_KD_ZG'
+
+
+def dataset(countries=('A', 'B', 'C'), first=2005, last=2008, seed=0):
+    """Covariable-cleaned dataset of the countries and years, shuffled."""
+    rng = np.random.default_rng(seed)
+    country = np.repeat(countries, last - first + 1)
+    year = np.tile(np.arange(first, last + 1), len(countries))
+    X = pd.DataFrame({INDICATOR: rng.normal(size=len(year)), 'x': rng.normal(size=len(year)),
+                      'Country': country, 'Time': year})
+    return X.sample(frac=1., random_state=seed).reset_index(drop=True)
+
+
+def test_rows_are_paired_with_the_next_year_of_their_country():
+    X = dataset()
+    X_train, y_train, groups_train = training.prepare_training_dataset(X, X[[INDICATOR]])
+    assert len(X_train) == len(y_train) == len(groups_train) == 3 * 3
+    assert X_train['Time'].max() == 2007
+    values = X.set_index(['Country', 'Time'])[INDICATOR]
+    countries = X.loc[X_train.index, 'Country']
+    expected = values.reindex(pd.MultiIndex.from_arrays([countries, X_train['Time'] + 1]))
+    np.testing.assert_array_equal(np.ravel(y_train), expected.to_numpy())
+
+
+def test_missing_years_have_no_label():
+    X = dataset()
+    X = X[~((X['Country'] == 'A') & (X['Time'] == 2006))].reset_index(drop=True)
+    X.loc[(X['Country'] == 'B') & (X['Time'] == 2008), INDICATOR] = np.nan
+    X_train, y_train, groups_train = training.prepare_training_dataset(X, X[[INDICATOR]])
+    pairs = set(zip(X.loc[X_train.index, 'Country'], X_train['Time']))
+    assert ('A', 2005) not in pairs and ('B', 2007) not in pairs
+    assert len(X_train) == len(y_train) == 1 + 2 + 3
+    assert not np.isnan(np.ravel(y_train)).any()
+
+
+def test_sizes_around_the_year_range():
+    # Row counts between the first and the last year of the database, where
+    # dropping the rows labelled with a year removed a single row of y
+    for n_countries in (2, 40, 41):
+        X = dataset([f'C{i}' for i in range(n_countries)], 1961, 2010)
+        X_train, y_train, groups_train = training.prepare_training_dataset(X, X[[INDICATOR]])
+        assert X_train.shape[0] == len(y_train) == n_countries * 49
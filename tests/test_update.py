@@ -0,0 +1,72 @@
+import os
+import sqlite3
+
+import pytest
+
+from benchmarks import generate
+from utils import config
+from utils import feature_store
+from utils import io
+from utils import models
+
+
+@pytest.fixture
+def database(work_dir):
+    """Small synthetic database until 2009, with a stored model."""
+    generate.generate(config.DATABASE_PATH, n_countries=30, n_years=20, n_indicators=8,
+                      last_year=2009, seed=0)
+    X, X_train, y_train, groups_train, encoder = training_data()
+    base = models.load_or_train(X_train, y_train, groups_train, config.DATABASE_PATH, encoder)
+    return base
+
+
+def training_data():
+    return io.retrieve_training_data(config.DATABASE_PATH, config.exclude_list,
+                                     config.PREDICTED_INDICATOR)
+
+
+def append_year(year=2010):
+    """Appends the values of a new year, derived from the former one."""
+    conn = sqlite3.connect(config.DATABASE_PATH)
+    with conn:
+        conn.execute('INSERT INTO CountryIndicators SELECT CountryName, CountryCode, '
+                     'IndicatorName, IndicatorCode, ?, 0.8 * Value + 0.5 '
+                     'FROM CountryIndicators WHERE Year = ?;', (year, year - 1))
+    conn.close()
+
+
+def update(monkeypatch, check=True):
+    append_year()
+
+    def rebuild(*args, **kwargs):
+        raise AssertionError('The feature store was built again')
+
+    monkeypatch.setattr(feature_store, 'build', rebuild)
+    added = feature_store.added_rows(config.DATABASE_PATH, config.exclude_list)
+    X, X_train, y_train, groups_train, encoder = training_data()
+    return added, models.update_or_train(X_train, y_train, groups_train,
+                                         config.DATABASE_PATH, added, encoder, check=check)
+
+
+def test_update_extends_the_stored_model(database, monkeypatch):
+    monkeypatch.setattr(config, 'UPDATE_TOLERANCE', float('inf'))
+    added, predictor = update(monkeypatch)
+    assert set(added.get_level_values(1)) == {2010}
+    index = feature_store._read_index(feature_store.extend(config.DATABASE_PATH,
+                                                           config.exclude_list))
+    assert 'extended_from' in index
+    assert predictor.warm_started_from == database.fingerprint
+    assert predictor.num_boost_round > database.num_boost_round
+    assert predictor.bst.num_trees() > database.bst.num_trees()
+    assert os.path.isfile(os.path.join(models.model_path(predictor.fingerprint),
+                                       models.META_FNAME))
+
+
+def test_update_falls_back_to_a_full_training(database, monkeypatch):
+    # Error of the warm start, then of the full training, on the held out year
+    errors = iter([2., 1.])
+    monkeypatch.setattr(models, '_rmse', lambda *args: next(errors))
+    added, predictor = update(monkeypatch)
+    assert next(errors, None) is None
+    assert predictor.warm_started_from is None
+    assert predictor.fingerprint != database.fingerprint
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+import itertools
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import feature_store
+from utils import features
+from utils import instrumentation
+from utils import io_aux_test as testing
+from utils import io_aux_train as training
+from utils import models
+from utils import read_database as rd
+from utils import tuning
+from utils.encoding import CountryEncoder
+
+# Shared panel of the backtest, attached once per worker (see _init_worker)
+_shared = {}
+
+
+def country_groups(database_path, countries, column=None):
+    """Group of each country in the Countries table, such as its income
+    group or its region.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    countries: Country codes.
+    column: Column of the Countries table. Per default: config.BACKTEST_GROUP.
+
+    Returns
+    -------
+    groups
+        Array with the group of each country, 'Unknown' for the countries
+        without one."""
+    column = config.BACKTEST_GROUP if column is None else column
+    conn = sqlite3.connect(database_path)
+    try:
+        names = [row[1] for row in conn.execute('PRAGMA table_info(Countries);')]
+        if column not in names:
+            raise ValueError(f"Unknown column {column} of the table Countries")
+        mapping = dict(conn.execute(f'SELECT CountryCode, "{column}" FROM Countries;'))
+    finally:
+        conn.close()
+    return np.array([mapping.get(country) or 'Unknown' for country in countries],
+                    dtype=object)
+
+
+def _init_worker(specs, columns, position, indicator):
+    """Attaches the worker to the shared panel."""
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared[key + '_block'] = block
+        _shared[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _shared['columns'] = columns
+    _shared['position'] = position
+    _shared['indicator'] = indicator
+
+
+def _run_origin(origin, horizons, kept):
+    """Trains on the rows up to origin and predicts the next horizons.
+    The row of a country and year is paired with the response of the next
+    year (see io_aux_train.next_year_labels), as in the training of
+    cli.py predict, so only the rows whose next year is at most origin are
+    trained on. They are selected with masks on the shared panel, and only
+    the columns kept for the origin (the variables selected on the years up
+    to origin, see select_origins) are used. The chain of predictions is
+    built as in forecasting.forecast from the data of origin, the response
+    and the features of every indicator being moved forward at every step.
+
+    Returns
+    -------
+    errors
+        Dataframe with the columns Origin, Horizon, Year, Country (position
+        of the country in the panel), y_true and y_pred.
+    seconds
+        Wall time of the origin."""
+    start = time.perf_counter()
+    X, groups, years = _shared['X'], _shared['groups'], _shared['years']
+    rows, label = _shared['rows'], _shared['label']
+    y = X[:, _shared['position']]
+    columns = [_shared['columns'][j] for j in kept]
+    indicator = _shared['indicator']
+    with instrumentation.span('origin', origin=int(origin), columns=len(kept)):
+        train = (years + 1 <= origin) & ~np.isnan(label)
+        predictor = models.GDPGrowthPredictor().train(
+            pd.DataFrame(X[np.ix_(train, kept)], columns=columns), label[train], groups[train],
+            predicted_indicator=indicator, cache=False)
+        first = rows[:, origin - config.DB_YEAR_MIN]
+        countries = np.flatnonzero(first >= 0)
+        values = X[np.ix_(first[countries], kept)]
+        group_chain = groups[first[countries]]
+        feature_specs = features.specs(indicator.replace('.', '_'))
+        n_years = features.depth(feature_specs)
+        years_back = np.arange(origin - n_years + 1, origin + 1) - config.DB_YEAR_MIN
+        back = rows[countries][:, np.clip(years_back, 0, None)]
+        observed = (back >= 0) & (years_back >= 0)
+        # History of every indicator with features, NaN for those not in the panel
+        history = np.full((len(countries), len(features.indicators(feature_specs)), n_years),
+                          np.nan)
+        for i, name in enumerate(features.indicators(feature_specs)):
+            name = name.replace('.', '_')
+            if name in _shared['columns']:
+                history[:, i] = np.where(observed, X[back, _shared['columns'].index(name)],
+                                         np.nan)
+        errors = []
+        for horizon in range(1, horizons + 1):
+            year = origin + horizon
+            y_pred = testing.predict(values, predictor, group_chain)
+            history = features.advance(values, columns, history, y_pred,
+                                       indicator.replace('.', '_'))
+            if year > config.DB_YEAR_MAX:
+                break
+            target = rows[countries, year - config.DB_YEAR_MIN]
+            y_true = np.where(target >= 0, y[target], np.nan)
+            errors.append(pd.DataFrame({'Origin': origin, 'Horizon': horizon, 'Year': year,
+                                        'Country': countries, 'y_true': y_true,
+                                        'y_pred': y_pred}))
+    errors = pd.concat(errors, ignore_index=True)
+    return errors.dropna(subset=['y_true']), time.perf_counter() - start
+
+
+@instrumentation.traced('select_origins')
+def select_origins(panel, predicted_indicator, origins, encoder=None, num_features=50,
+                   workers=None):
+    """Variables selected for every origin as by cli.py select, the residual
+    model, the imputation (see read_database.clean_data) and the scores
+    only seeing the years up to the origin.
+
+    Parameters
+    ----------
+    panel: panel.Panel of the database (see feature_store.load).
+    predicted_indicator: Variable predicted.
+    origins: Years of the last training data.
+    encoder: encoding.CountryEncoder of the groups.
+    num_features: Maximum number of selected variables (see read_database.select_data).
+    workers: Number of processes scoring the variables.
+
+    Returns
+    -------
+    selected
+        Dictionary with the names of the variables selected for each origin."""
+    selected = {}
+    for origin in origins:
+        df1, groups = rd.panel_data(panel, predicted_indicator, encoder, last_year=origin)
+        df_fewNA = rd.clean_data(df1)
+        selected[origin] = list(rd.rank_variables(df_fewNA, num_features, workers,
+                                                  predicted_indicator)['name'])
+    return selected
+
+
+def error_table(errors, group_names):
+    """RMSE and MAE of every origin, horizon and country group.
+
+    Parameters
+    ----------
+    errors: Predictions of the origins (see _run_origin).
+    group_names: Group of each country of the panel (see country_groups).
+
+    Returns
+    -------
+    table
+        Dataframe with the columns Origin, Horizon, Group, Countries, RMSE
+        and MAE, the group 'All' gathering all the countries."""
+    errors = errors.assign(Group=group_names[errors['Country'].to_numpy()],
+                           squared=(errors['y_true'] - errors['y_pred']) ** 2,
+                           absolute=(errors['y_true'] - errors['y_pred']).abs())
+    table = pd.concat([errors, errors.assign(Group='All')], ignore_index=True)
+    table = table.groupby(['Origin', 'Horizon', 'Group']).agg(
+        Countries=('Country', 'size'), RMSE=('squared', 'mean'),
+        MAE=('absolute', 'mean')).reset_index()
+    table['RMSE'] = np.sqrt(table['RMSE'])
+    return table
+
+
+@instrumentation.traced('backtest')
+def backtest(database_path, exclude_list, predicted_indicator, origins, horizons=None,
+             workers=None, encoder=None, group_column=None):
+    """Rolling-origin evaluation of the forecasts.
+    For every origin year, the variables are selected and a model is
+    trained on the data up to that year (see select_origins), and the next
+    horizons are predicted recursively as in forecasting.forecast, then
+    compared with the data of the database.
+    The panel of all the selected variables is copied once into shared
+    memory and the origins run in a process pool, each of them selecting
+    its training rows, its columns and its chain with masks instead of
+    copies of the dataset.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    predicted_indicator: Variable predicted.
+    origins: Years of the last training data, before config.DB_YEAR_MAX.
+    horizons: Number of years predicted after each origin.
+        Per default: config.BACKTEST_HORIZONS.
+    workers: Number of worker processes, of the origins and of the scoring
+        of the variables. Per default: os.cpu_count().
+        With a single worker, the origins are run in this process.
+    encoder: encoding.CountryEncoder of the groups.
+        Per default, the one of the database.
+    group_column: Column of the Countries table grouping the errors
+        (see country_groups). Per default: config.BACKTEST_GROUP.
+
+    Returns
+    -------
+    table
+        Errors of every origin, horizon and country group (see error_table).
+    seconds
+        Total wall time of the backtest."""
+    start = time.perf_counter()
+    horizons = config.BACKTEST_HORIZONS if horizons is None else horizons
+    origins = sorted(set(int(origin) for origin in origins))
+    if not origins or origins[0] <= config.DB_YEAR_MIN or origins[-1] >= config.DB_YEAR_MAX:
+        raise ValueError(f"The origins have to be between {config.DB_YEAR_MIN + 1} "
+                         f"and {config.DB_YEAR_MAX - 1}")
+    indicator = predicted_indicator
+    predicted_indicator = predicted_indicator.replace(".", "_")
+    if encoder is None:
+        encoder = CountryEncoder.from_database(database_path)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+
+    selected = select_origins(feature_store.load(database_path, exclude_list), indicator,
+                              origins, encoder, workers=workers)
+    names = list(dict.fromkeys(name for origin in origins for name in selected[origin]))
+    X = rd.select_columns(database_path, exclude_list, indicator, names)
+    X.columns = X.columns.str.replace(".", "_", regex=False)
+    X = X.reset_index(drop=True)
+    X_model, groups = training.handle_country_groups(X, encoder)
+    columns = list(X_model.columns)
+    # Columns of each origin: its selected variables and the columns that
+    # are not selected variables (response, features, time)
+    variables = {name.replace('.', '_') for name in names}
+    kept = {origin: np.array([j for j, name in enumerate(columns)
+                              if name not in variables
+                              or name in {variable.replace('.', '_')
+                                          for variable in selected[origin]}])
+            for origin in origins}
+    values = np.ascontiguousarray(X_model.to_numpy(dtype=np.float64))
+    years = X['Time'].to_numpy(dtype=np.int64)
+    # Row of each country (position in the panel) and year, -1 if missing
+    countries, country = np.unique(X['Country'].to_numpy(), return_inverse=True)
+    rows = np.full((len(countries), config.DB_YEAR_MAX - config.DB_YEAR_MIN + 1), -1,
+                   dtype=np.int64)
+    inside = (years >= config.DB_YEAR_MIN) & (years <= config.DB_YEAR_MAX)
+    rows[country[inside], years[inside] - config.DB_YEAR_MIN] = np.flatnonzero(inside)
+    position = columns.index(predicted_indicator)
+    # Label of each row, as in the training of cli.py predict
+    label = training.next_year_labels(X['Country'], years, values[:, position])
+    arrays = {'X': values, 'groups': np.asarray(groups), 'years': years, 'rows': rows,
+              'label': label}
+    workers = min(workers, len(origins))
+    logging.info(f'Backtesting {len(origins)} origins from {origins[0]} to {origins[-1]}, '
+                 f'{horizons} horizons, with {workers} workers')
+
+    outputs = []
+    if workers <= 1:
+        _shared.update(arrays, columns=columns, position=position, indicator=indicator)
+        try:
+            outputs = [_run_origin(origin, horizons, kept[origin]) for origin in origins]
+        finally:
+            _shared.clear()
+    else:
+        blocks = []
+        specs = {}
+        for key, array in arrays.items():
+            block, specs[key] = tuning.share_array(array)
+            blocks.append(block)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(specs, columns, position,
+                                               indicator)) as executor:
+                outputs = list(executor.map(_run_origin, origins,
+                                            itertools.repeat(horizons),
+                                            [kept[origin] for origin in origins]))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    for origin, (_, seconds) in zip(origins, outputs):
+        logging.info(f'Origin {origin} done in {seconds:.1f}s')
+    errors = pd.concat([errors for errors, _ in outputs], ignore_index=True)
+    table = error_table(errors, country_groups(database_path, countries, group_column))
+    seconds = time.perf_counter() - start
+    instrumentation.current().set(origins=len(origins), rows=len(errors))
+    logging.info(f'Backtest of {len(origins)} origins done in {seconds:.1f}s')
+    return table, seconds
@@ -8,8 +8,21 @@ MODELS_PATH = os.path.join(BASE_DIR, "models")
 
 LOGS_PATH = os.path.join(BASE_DIR, "logs")
 
+CACHE_PATH = os.path.join(BASE_DIR, "cache")
+
+# Database of the predictions (see results) and seconds a connection waits
+# for a lock held by another one. The predictions are kept out of the input
+# database, whose digest identifies the models (see fingerprint).
+RESULTS_PATH = os.path.join(BASE_DIR, "results.sqlite3")
+
+RESULTS_TIMEOUT = 30
+
 PREDICTED_INDICATOR = 'NY.GDP.MKTP.KD.ZG'
 
+# Indicators predicted by cli.py predict and select (see targets), e.g. the
+# GDP per capita growth NY.GDP.PCAP.KD.ZG or the sector growth NV.*.KD.ZG.
+PREDICTED_INDICATORS = [PREDICTED_INDICATOR]
+
 exclude_list = ['Arab World', 'Caribbean small states', 'Central Europe and the Baltics',
  'East Asia & Pacific \(all income levels',
  'East Asia & Pacific \(developing only', 'Euro area',
@@ -31,4 +44,165 @@ exclude_list = ['Arab World', 'Caribbean small states', 'Central Europe and the
  
 DB_YEAR_MIN = 1960
 
+# Last year of the database, the origin of the forecasts. Set by hand, it is
+# not moved by the years appended to the database (see models.update_or_train).
 DB_YEAR_MAX = 2010
+
+# Features of the model computed per country (see features.specs): other
+# indicators than the predicted one with features, lags, differences and
+# rolling windows (mean and standard deviation) in years.
+FEATURE_INDICATORS = []
+
+FEATURE_LAGS = [1]
+
+FEATURE_DIFFS = []
+
+FEATURE_WINDOWS = []
+
+# Wide panel of the indicators (see panel.Panel): share of missing rows
+# over which an indicator is stored sparse, memory budget in MB (no limit if
+# None) and whether a panel over the budget is memory-mapped to temporary
+# files of PANEL_SPILL_PATH instead of failing.
+PANEL_SPARSE_THRESHOLD = 0.5
+
+PANEL_MEMORY_BUDGET = None
+
+PANEL_SPILL = True
+
+PANEL_SPILL_PATH = os.path.join(CACHE_PATH, "spill")
+
+# Columns imputed at once and threads of the imputation (see imputation.impute).
+IMPUTATION_CHUNK_SIZE = 128
+
+IMPUTATION_WORKERS = 1
+
+# Fit of the residual model Y ~ lag1 (see mixed_model.residuals):
+# 'numpy', 'statsmodels' or 'verify'.
+RESIDUALS_BACKEND = 'numpy'
+
+RESIDUALS_TOLERANCE = 1e-4
+
+# Selection of the most relevant variables (see feature_selection).
+SELECTION_PATH = os.path.join(BASE_DIR, "utils", "selected_variables.json")
+
+SELECTION_WORKERS = None
+
+SELECTION_CHUNK_SIZE = 32
+
+SELECTION_RANDOM_STATE = 0
+
+SELECTION_CACHE_SIZE = 50000
+
+# Boosting parameters and covariance optimizer of the GPBoost model.
+BOOSTER_PARAMS = {
+    'objective': 'regression_l2',
+    'learning_rate': 0.05,
+    'max_depth': 6,
+    'min_data_in_leaf': 5,
+    'verbose': 0
+}
+
+GP_OPTIM_PARAMS = {"optimizer_cov": "fisher_scoring"}
+
+# Cross-validation used to find the optimal number of boosting rounds.
+CV_PARAMS = {
+    'num_boost_round': 300,
+    'early_stopping_rounds': 5,
+    'nfold': 3,
+    'seed': 1
+}
+
+# Search space of the hyperparameter tuning (cli.py tune).
+TUNING_SPACE = {
+    'learning_rate': [0.01, 0.05, 0.1],
+    'max_depth': [3, 6, 9],
+    'min_data_in_leaf': [5, 20, 50],
+    'optimizer_cov': ['fisher_scoring', 'gradient_descent'],
+}
+
+# Maximum relative increase of the error of a warm-started model over a
+# full training before the latter is kept (cli.py update --check).
+UPDATE_TOLERANCE = 0.05
+
+# Best configuration found by the tuning, reused by cli.py predict. The other
+# indicators than PREDICTED_INDICATOR have their own, best_params_<indicator>.json.
+BEST_PARAMS_PATH = os.path.join(MODELS_PATH, 'best_params.json')
+
+# Prediction service (cli.py serve): address, micro-batching of the
+# concurrent queries and seconds between two checks for a new model.
+SERVE_HOST = '127.0.0.1'
+
+SERVE_PORT = 8000
+
+SERVE_BATCH_WINDOW = 0.005
+
+SERVE_MAX_BATCH = 256
+
+SERVE_RELOAD_INTERVAL = 30
+
+# Monte Carlo scenarios (cli.py scenarios, see scenarios.simulate):
+# perturbations of the covariates and of the residuals, number of paths per
+# country, rows predicted at once, reported quantiles and output directory.
+SCENARIO_SPEC = {
+    'covariates': {'default': {'kind': 'random_walk', 'scale': 1.0}},
+    'residuals': {'kind': 'normal', 'scale': 1.0},
+}
+
+SCENARIO_COUNT = 1000
+
+SCENARIO_BATCH_ROWS = 200000
+
+SCENARIO_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+SCENARIOS_PATH = os.path.join(BASE_DIR, "scenarios")
+
+# Rolling-origin backtest (cli.py backtest, see backtest.backtest): years of
+# the last training data, years predicted after each of them, column of the
+# table Countries grouping the errors and output directory.
+BACKTEST_ORIGINS = '1975-2009'
+
+BACKTEST_HORIZONS = 3
+
+BACKTEST_GROUP = 'IncomeGroup'
+
+BACKTEST_PATH = os.path.join(BASE_DIR, "backtests")
+
+# Ingestion of WDI CSV exports (cli.py ingest, see ingest.ingest): lines of
+# the data file read at once and values inserted per transaction.
+INGEST_CHUNK_ROWS = 20000
+
+INGEST_TRANSACTION_ROWS = 1000000
+
+# Cache of the forecasts (see prediction_cache.PredictionCache): directory
+# and size limit in MB, of the files and of the entries kept in memory.
+# 0 disables it.
+PREDICTION_CACHE_PATH = os.path.join(CACHE_PATH, "predictions")
+
+PREDICTION_CACHE_MB = 64
+
+# Ensemble of models trained on resamplings of the training data (cli.py
+# ensemble, see ensemble.train): number of models, 'bootstrap' of the rows
+# or 'country' blocks, seed, memory budget in MB of the training workers
+# (no limit if None), residual draws per model and quantiles of the
+# intervals, and directories of the stored ensembles and of the intervals.
+ENSEMBLE_MEMBERS = 20
+
+ENSEMBLE_RESAMPLING = 'country'
+
+ENSEMBLE_SEED = 1
+
+ENSEMBLE_MEMORY_BUDGET = None
+
+ENSEMBLE_DRAWS = 50
+
+ENSEMBLE_QUANTILES = [0.05, 0.95]
+
+ENSEMBLE_PATH = os.path.join(MODELS_PATH, "ensembles")
+
+INTERVALS_PATH = os.path.join(BASE_DIR, "intervals")
+
+# Binned training datasets of gpboost (see io_aux_train.build_dataset):
+# directory and number of datasets kept, 0 to not save them.
+DATASET_CACHE_PATH = os.path.join(CACHE_PATH, "datasets")
+
+DATASET_CACHE_SIZE = 50
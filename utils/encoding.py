@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+class CountryEncoder:
+    """Maps country codes to int32 group ids.
+    The ids only depend on the list of countries the encoder is built from,
+    so the training and the test data get the same id for each country no
+    matter which countries or rows each of them contains. The lookup is a
+    single vectorized hash lookup over the whole column.
+    """
+
+    def __init__(self, countries):
+        self.index = pd.Index(sorted(pd.unique(np.asarray(countries))))
+
+    @classmethod
+    def from_database(cls, database_path):
+        """Encoder of all the countries of the Countries table."""
+        conn = sqlite3.connect(database_path)
+        try:
+            countries = [row[0] for row in
+                         conn.execute('SELECT CountryCode FROM Countries;')]
+        finally:
+            conn.close()
+        return cls(countries)
+
+    @property
+    def countries(self):
+        return self.index.tolist()
+
+    def transform(self, countries):
+        """Group ids of countries.
+
+        Parameters
+        ----------
+        countries: Country codes.
+
+        Returns
+        -------
+        ids
+            int32 array with the group id of each country."""
+        ids = self.index.get_indexer(np.asarray(countries))
+        if (ids < 0).any():
+            unknown = pd.unique(np.asarray(countries)[ids < 0])
+            raise ValueError(f"Countries not known by the encoder: {list(unknown)}")
+        return ids.astype(np.int32)
+
+    def inverse_transform(self, ids):
+        """Country codes of the group ids."""
+        return self.index.to_numpy()[np.asarray(ids)]
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.countries, f)
+
+    @staticmethod
+    def load(filename):
+        with open(filename) as f:
+            return CountryEncoder(json.load(f))
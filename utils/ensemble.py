@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import fingerprint
+from utils import forecasting
+from utils import instrumentation
+from utils import models
+from utils import tuning
+
+RESAMPLINGS = ('bootstrap', 'country')
+
+META_FNAME = 'ensemble.json'
+
+# Version of the training of the members, part of the key of the stored
+# ensembles: 2 gives each drawn copy of a country its own group.
+TRAINING_VERSION = 2
+
+# Estimated peak memory of a training worker, in copies of the training
+# matrix: the resampled rows, the gpboost dataset and the stored train data.
+WORKER_COPIES = 4
+
+# Shared training data, attached once per worker (see _init_worker)
+_shared = {}
+
+
+def resample(groups, resampling, rng):
+    """Rows of a resampled training set and their groups.
+
+    Parameters
+    ----------
+    groups: Group index of every row.
+    resampling: 'bootstrap' to draw rows with replacement, 'country' to
+        draw countries with replacement and keep all the rows of each, so
+        the years of a country stay together.
+    rng: numpy random Generator.
+
+    Returns
+    -------
+    rows
+        Positions of the rows, with repetitions.
+    resampled_groups
+        Group of each drawn row. With 'country', every drawn copy of a
+        country is a group of its own, numbered in the order of the draws:
+        a country drawn twice would otherwise be one group with every year
+        twice, which understates the variance of the random effects."""
+    groups = np.asarray(groups)
+    if resampling == 'bootstrap':
+        rows = np.sort(rng.integers(0, len(groups), len(groups)))
+        return rows, groups[rows]
+    if resampling == 'country':
+        order = np.argsort(groups, kind='stable')
+        countries, starts, counts = np.unique(groups[order], return_index=True,
+                                              return_counts=True)
+        chosen = np.sort(rng.integers(0, len(countries), len(countries)))
+        rows = np.concatenate([order[starts[c]:starts[c] + counts[c]] for c in chosen])
+        return rows, np.repeat(np.arange(len(chosen)), counts[chosen])
+    raise ValueError(f"Unknown resampling {resampling}, expected one of "
+                     f"{', '.join(RESAMPLINGS)}")
+
+
+def ensemble_key(model_key, n_members, resampling, seed):
+    """Key of the ensemble of the model stored under model_key."""
+    return fingerprint.hash_values(model_key, n_members, resampling, seed, TRAINING_VERSION)
+
+
+def ensemble_path(key):
+    """OS path of the ensemble stored under key."""
+    return os.path.join(config.ENSEMBLE_PATH, key)
+
+
+def _init_worker(specs):
+    """Attaches the worker to the shared training data."""
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared[key + '_block'] = block
+        _shared[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _noise_variance(predictor, X, y, groups, rows):
+    """Variance of the observations around the forecasts of a member,
+    estimated on the rows it was not trained on: the variance of the
+    training residuals of the booster is far too optimistic. The random
+    effects of the countries left out are unknown to the member, so the
+    residuals are taken around the mean of each country."""
+    out = np.ones(len(y), dtype=bool)
+    out[rows] = False
+    pred = predictor.predict(X[out], groups[out])
+    residuals = y[out] - pred['fixed_effect'] - pred['random_effect_mean']
+    codes = np.unique(groups[out], return_inverse=True)[1]
+    counts = np.bincount(codes, minlength=1)
+    residuals = residuals - (np.bincount(codes, residuals, minlength=1)
+                             / np.maximum(counts, 1))[codes]
+    dof = len(residuals) - np.count_nonzero(counts)
+    if dof <= 0:
+        return float(predictor.cov_pars[0])
+    return float(np.sum(residuals ** 2) / dof)
+
+
+def _train_member(i, resampling, seed, num_boost_round, columns, encoder, path):
+    """Trains the member i on a resampling of the shared training data and
+    stores it in path. The random effects are fitted on the groups of the
+    resampling (see resample), and the member then predicts the effect of
+    each country from the rows of its copies.
+
+    Returns
+    -------
+    seconds
+        Wall time of the training.
+    noise_variance
+        Variance of the observations around its forecasts (see _noise_variance)."""
+    start = time.perf_counter()
+    X, y, groups = _shared['X'], _shared['y'], _shared['groups']
+    rows, resampled_groups = resample(groups, resampling, np.random.default_rng([seed, i]))
+    with instrumentation.span('member', member=i):
+        predictor = models.GDPGrowthPredictor().train(
+            pd.DataFrame(X[rows], columns=columns), y[rows], resampled_groups, encoder,
+            num_boost_round=num_boost_round, cache=False)
+        predictor.groups = groups[rows]
+        # Predicts from the countries of the stored groups, as once loaded
+        predictor.gp_model = None
+        noise_variance = _noise_variance(predictor, X, y, groups, rows)
+        predictor.save(os.path.join(path, f'member_{i:03d}'))
+    return time.perf_counter() - start, noise_variance
+
+
+def workers_within(budget, nbytes, workers=None):
+    """Number of training workers whose estimated memory fits in budget.
+
+    Parameters
+    ----------
+    budget: Memory budget in MB, no limit if None.
+    nbytes: Size of the training matrix.
+    workers: Maximum number of workers. Per default: os.cpu_count().
+
+    Returns
+    -------
+    workers
+        At least 1."""
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if budget is not None:
+        workers = min(workers, int(budget * 2 ** 20 // max(WORKER_COPIES * nbytes, 1)))
+    return max(workers, 1)
+
+
+@instrumentation.traced('ensemble')
+def train(X_train, y_train, groups_train, database_path, encoder=None, n_members=None,
+          resampling=None, workers=None, memory_budget=None, seed=None):
+    """Trains an ensemble of models on resamplings of the training data and
+    stores it next to the model store, or loads it if it is stored already.
+    The members use the parameters and the number of boosting rounds of the
+    single model (see models.load_or_train), without cross-validation of
+    their own. The training data is copied once into shared memory and
+    the members are trained in a process pool, each worker reading it
+    without a copy per task.
+
+    Parameters
+    ----------
+    X_train: Train data
+    y_train: Response train data
+    groups_train: Group indices
+    database_path: Where database is stored.
+    encoder: encoding.CountryEncoder that produced groups_train
+    n_members: Number of models. Per default: config.ENSEMBLE_MEMBERS.
+    resampling: 'bootstrap' or 'country' (see resample).
+        Per default: config.ENSEMBLE_RESAMPLING.
+    workers: Maximum number of worker processes. Per default: os.cpu_count().
+        With a single worker, the members are trained in this process.
+    memory_budget: Memory budget in MB of the workers, which caps their
+        number (see workers_within). Per default: config.ENSEMBLE_MEMORY_BUDGET.
+    seed: Seed of the resamplings. Per default: config.ENSEMBLE_SEED.
+
+    Returns
+    -------
+    members
+        List of trained models.GDPGrowthPredictor."""
+    n_members = config.ENSEMBLE_MEMBERS if n_members is None else n_members
+    resampling = config.ENSEMBLE_RESAMPLING if resampling is None else resampling
+    seed = config.ENSEMBLE_SEED if seed is None else seed
+    if memory_budget is None:
+        memory_budget = config.ENSEMBLE_MEMORY_BUDGET
+    if resampling not in RESAMPLINGS:
+        raise ValueError(f"Unknown resampling {resampling}, expected one of "
+                         f"{', '.join(RESAMPLINGS)}")
+    model = models.load_or_train(X_train, y_train, groups_train, database_path, encoder)
+    key = ensemble_key(model.fingerprint, n_members, resampling, seed)
+    path = ensemble_path(key)
+    if os.path.isfile(os.path.join(path, META_FNAME)):
+        logging.info(f'Loading stored ensemble {key}')
+        return load(path)
+
+    X = np.ascontiguousarray(X_train, dtype=np.float64)
+    y = np.ascontiguousarray(np.ravel(y_train), dtype=np.float64)
+    groups = np.ascontiguousarray(groups_train)
+    columns = list(X_train.columns)
+    workers = min(workers_within(memory_budget, X.nbytes, workers), n_members)
+    logging.info(f'Training an ensemble of {n_members} models on {resampling} '
+                 f'resamplings with {workers} workers')
+    os.makedirs(config.ENSEMBLE_PATH, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=config.ENSEMBLE_PATH, prefix='.tmp_')
+    arguments = [(i, resampling, seed, model.num_boost_round, columns, encoder, tmp_dir)
+                 for i in range(n_members)]
+    try:
+        if workers <= 1:
+            _shared.update(X=X, y=y, groups=groups)
+            try:
+                outputs = [_train_member(*args) for args in arguments]
+            finally:
+                _shared.clear()
+        else:
+            blocks = []
+            specs = {}
+            for name, array in (('X', X), ('y', y), ('groups', groups)):
+                block, specs[name] = tuning.share_array(array)
+                blocks.append(block)
+            try:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                         initargs=(specs,)) as executor:
+                    outputs = list(executor.map(_train_member, *zip(*arguments)))
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+        meta = {
+            'model': model.fingerprint,
+            'members': n_members,
+            'resampling': resampling,
+            'seed': seed,
+            'num_boost_round': int(model.num_boost_round),
+            'member_seconds': [seconds for seconds, _ in outputs],
+            'noise_variances': [variance for _, variance in outputs],
+            'created': datetime.now().isoformat(timespec='seconds'),
+        }
+        with open(os.path.join(tmp_dir, META_FNAME), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_dir, path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    instrumentation.current().set(members=n_members, workers=workers)
+    return load(path)
+
+
+def load(path):
+    """Members of the ensemble stored in the directory path."""
+    with open(os.path.join(path, META_FNAME)) as f:
+        meta = json.load(f)
+    members = []
+    for i in range(meta['members']):
+        member = models.GDPGrowthPredictor.load(os.path.join(path, f'member_{i:03d}'))
+        # Members are not in the model store, their forecasts are not cached
+        member.fingerprint = None
+        member.noise_variance = meta['noise_variances'][i]
+        members.append(member)
+    return members
+
+
+def predictive_std(member, countries, encoder=None):
+    """Standard deviation of an observation around the forecast of a
+    member: the noise of the observations (see _noise_variance) and the
+    uncertainty of the random effect of the country given its training
+    rows (the prior variance of the random effects for a country without
+    any).
+
+    Parameters
+    ----------
+    member: models.GDPGrowthPredictor.
+    countries: Country of each forecast.
+    encoder: encoding.CountryEncoder of the countries, if the member has none.
+
+    Returns
+    -------
+    std
+        Array with the standard deviation of each forecast."""
+    sigma2, sigma2_group = (float(value) for value in member.cov_pars[:2])
+    noise_variance = getattr(member, 'noise_variance', sigma2)
+    encoder = member.encoder if member.encoder is not None else encoder
+    n_rows = np.zeros(len(countries))
+    if encoder is not None:
+        known, counts = np.unique(member.groups, return_counts=True)
+        groups = np.asarray(encoder.transform(countries))
+        position = np.clip(np.searchsorted(known, groups), 0, len(known) - 1)
+        n_rows = np.where(known[position] == groups, counts[position], 0)
+    group_variance = sigma2_group * sigma2 / (sigma2 + n_rows * sigma2_group)
+    return np.sqrt(noise_variance + group_variance)
+
+
+@instrumentation.traced('ensemble_forecast')
+def forecast(X, members, years, encoder=None, predicted_indicator=None, quantiles=None,
+             draws=None, seed=None):
+    """Forecast of every member (see forecasting.forecast), aggregated into
+    prediction intervals. Each member predicts all the countries and years
+    of the database with a single call, and each year after
+    config.DB_YEAR_MAX with one call. The spread of the members only
+    measures the uncertainty of the mean forecast: draws of the noise of an
+    observation (see predictive_std) are added to the forecast of each
+    member, and the intervals are the quantiles of all the draws. The noise
+    is drawn every year around the recursive chain of means, it is not
+    carried forward through the chain, so the intervals of the later years
+    are too narrow (see scenarios.simulate for paths).
+
+    Parameters
+    ----------
+    X: covariable-cleaned database, indexed by year.
+    members: Models of the ensemble (see train).
+    years: years of prediction.
+    encoder: encoding.CountryEncoder used for the training data.
+    predicted_indicator: Variable predicted by the models.
+    quantiles: Quantiles of the intervals.
+        Per default: config.ENSEMBLE_QUANTILES.
+    draws: Draws of the noise per member, 0 for quantiles of the member
+        forecasts alone. Per default: config.ENSEMBLE_DRAWS.
+    seed: Seed of the draws. Per default: config.ENSEMBLE_SEED.
+
+    Returns
+    -------
+    predictions
+        Dataframe with the columns Country, Year, y_pred (mean of the
+        members), model_std (standard deviation of the members), y_std
+        (standard deviation of the draws) and one column per quantile,
+        named q<quantile>."""
+    quantiles = config.ENSEMBLE_QUANTILES if quantiles is None else quantiles
+    draws = config.ENSEMBLE_DRAWS if draws is None else draws
+    seed = config.ENSEMBLE_SEED if seed is None else seed
+    outputs = [forecasting.forecast(X, member, years, encoder, predicted_indicator)
+               for member in members]
+    values = np.stack([output['y_pred'].to_numpy() for output in outputs])
+    predictions = outputs[0][['Country', 'Year']].copy()
+    predictions['y_pred'] = values.mean(axis=0)
+    predictions['model_std'] = values.std(axis=0, ddof=1) if len(members) > 1 else 0.
+    if draws > 0:
+        rng = np.random.default_rng(seed)
+        countries = predictions['Country'].to_numpy()
+        values = np.concatenate([
+            row + predictive_std(member, countries, encoder)
+            * rng.standard_normal((draws, len(row)))
+            for member, row in zip(members, values)])
+    predictions['y_std'] = values.std(axis=0, ddof=1) if len(values) > 1 else 0.
+    for q, row in zip(quantiles, np.quantile(values, quantiles, axis=0)):
+        predictions[f'q{q:g}'] = row
+    instrumentation.current().set(members=len(members), rows=len(predictions))
+    return predictions
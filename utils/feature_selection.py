@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from utils import config
+from utils import fingerprint
+
+SCHEMA_VERSION = 1
+SCORES_CACHE_PATH = os.path.join(config.CACHE_PATH, 'feature_scores.json')
+
+
+def indicator_path(path, indicator=None):
+    """File of an artifact of the selection of indicator: path for
+    config.PREDICTED_INDICATOR, path suffixed with the indicator otherwise."""
+    if indicator is None or indicator == config.PREDICTED_INDICATOR:
+        return path
+    stem, extension = os.path.splitext(path)
+    return f'{stem}_{indicator}{extension}'
+
+
+def _score_chunk(chunk, residuals):
+    """Mutual information of each column of chunk with the residuals.
+    Each column is scored on its own with a fixed random state, so its
+    score does not depend on the other columns of the chunk."""
+    from sklearn.feature_selection import mutual_info_regression
+    return [float(mutual_info_regression(chunk[:, [j]], residuals,
+                                         random_state=config.SELECTION_RANDOM_STATE)[0])
+            for j in range(chunk.shape[1])]
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(obj, path):
+    """Writes obj next to path and renames it, so readers never see a
+    half-written file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_fname = path + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_fname, path)
+
+
+def score_columns(covs, residuals, workers=None, chunk_size=None,
+                  cache_path=SCORES_CACHE_PATH):
+    """Mutual information of every column of covs with the residuals.
+    The score of each column is cached under the hash of its values and of
+    the residual vector, only the columns whose data changed are scored
+    again. They are scored in chunks across a process pool.
+
+    Parameters
+    ----------
+    covs: Dataframe of covariables, without NaN.
+    residuals: Residual vector of the linear model.
+    workers: Number of processes. Per default: config.SELECTION_WORKERS.
+    chunk_size: Number of columns per task.
+        Per default: config.SELECTION_CHUNK_SIZE.
+    cache_path: File of the cached scores.
+
+    Returns
+    -------
+    scores
+        Array with the score of each column."""
+    workers = config.SELECTION_WORKERS if workers is None else workers
+    chunk_size = config.SELECTION_CHUNK_SIZE if chunk_size is None else chunk_size
+    values = covs.to_numpy(dtype=np.float64)
+    residuals = np.ravel(np.asarray(residuals, dtype=np.float64))
+    residuals_hash = fingerprint.hash_values(residuals,
+                                             config.SELECTION_RANDOM_STATE)
+    keys = [fingerprint.hash_values(values[:, j], residuals_hash)
+            for j in range(values.shape[1])]
+    cache = _read_cache(cache_path)
+    scores = np.array([cache.get(key, np.nan) for key in keys])
+    missing = np.flatnonzero(np.isnan(scores))
+    logging.info(f'Scoring {len(missing)} of {len(keys)} columns, '
+                 f'{len(keys) - len(missing)} cached')
+    if len(missing):
+        chunks = [missing[i:i + chunk_size]
+                  for i in range(0, len(missing), chunk_size)]
+        if workers == 1 or len(chunks) == 1:
+            results = [_score_chunk(values[:, chunk], residuals) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_score_chunk,
+                                            [values[:, chunk] for chunk in chunks],
+                                            [residuals] * len(chunks)))
+        for chunk, chunk_scores in zip(chunks, results):
+            scores[chunk] = chunk_scores
+        # Keep the newest entries only
+        for key, score in zip(keys, scores):
+            cache.pop(key, None)
+            cache[key] = float(score)
+        cache = dict(list(cache.items())[-config.SELECTION_CACHE_SIZE:])
+        _write_json(cache, cache_path)
+    return scores
+
+
+def read_selection(path=None):
+    """Selection artifact written by write_selection, None if there is none."""
+    path = config.SELECTION_PATH if path is None else path
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_selection(names, scores, path=None, **metadata):
+    """Writes a new version of the selection artifact, replacing the
+    former one atomically.
+
+    Parameters
+    ----------
+    names: Names of the selected variables, in order of importance.
+    scores: Score of each selected variable.
+    path: File of the artifact. Per default: config.SELECTION_PATH.
+    metadata: Extra fields to record.
+
+    Returns
+    -------
+    selection
+        The written artifact."""
+    path = config.SELECTION_PATH if path is None else path
+    former = read_selection(path)
+    selection = {
+        'schema': SCHEMA_VERSION,
+        'version': 1 if former is None else former['version'] + 1,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'names': list(names),
+        'scores': [float(score) for score in scores],
+    }
+    selection.update(metadata)
+    _write_json(selection, path)
+    logging.info(f"Selection version {selection['version']} written to {path}")
+    return selection
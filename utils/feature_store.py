@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import fingerprint
+from utils import instrumentation
+from utils import panel
+from utils import query
+
+STORE_PATH = os.path.join(config.CACHE_PATH, 'feature_store')
+VALUES_FNAME = 'values.npy'
+INDEX_FNAME = 'index.json'
+
+
+def store_key(database_path, exclude_list):
+    """Key of the panel built from the database and the excluded zones.
+    It changes with the contents of the input tables of the database."""
+    return fingerprint.hash_values(fingerprint.database_digest(database_path),
+                                   list(exclude_list or []))
+
+
+def _write(path, values, countries, years, indicators, **metadata):
+    """Writes a panel to path atomically and removes the panels of former
+    versions of the database."""
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        np.save(os.path.join(tmp_dir, VALUES_FNAME), values)
+        index = {
+            'countries': list(countries),
+            'years': [int(year) for year in years],
+            'indicators': list(indicators),
+        }
+        index.update(metadata)
+        with open(os.path.join(tmp_dir, INDEX_FNAME), 'w') as f:
+            json.dump(index, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_dir, path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    # Panels of former versions of the database are not valid anymore
+    for name in os.listdir(parent):
+        if name != os.path.basename(path) and not name.startswith('.tmp_'):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def _read_index(path):
+    with open(os.path.join(path, INDEX_FNAME)) as f:
+        return json.load(f)
+
+
+def _stored_panel():
+    """Directory of the panel currently in the store, None if there is none."""
+    if not os.path.isdir(STORE_PATH):
+        return None
+    for name in os.listdir(STORE_PATH):
+        path = os.path.join(STORE_PATH, name)
+        if not name.startswith('.tmp_') and os.path.isfile(os.path.join(path, INDEX_FNAME)):
+            return path
+    return None
+
+
+def _countries_digest(database_path):
+    return fingerprint.database_digest(database_path, tables=('Countries',))
+
+
+@instrumentation.traced('feature_store_build')
+def build(database_path, exclude_list, path):
+    """Reads CountryIndicators as the wide (CountryCode, Year) x Indicator
+    panel (see query.read_wide) and writes it to path.
+    The values are written as one column-major float32 .npy file, so every
+    indicator is a contiguous block that can be memory-mapped on its own.
+    The row index and the indicator names are written to a JSON sidecar.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    path: Directory of the store."""
+    logging.info('Building feature store')
+    _, rows_digest, max_rowid = fingerprint.rowid_digests(database_path)
+    values, countries, years, indicators = query.read_wide(database_path, exclude_list,
+                                                           dtype=np.float32)
+    _write(path, values, countries, years, indicators, max_rowid=max_rowid,
+           rows_digest=rows_digest,
+           countries_digest=_countries_digest(database_path),
+           exclude_list=list(exclude_list or []))
+
+
+@instrumentation.traced('feature_store')
+def extend(database_path, exclude_list):
+    """Brings the stored panel up to date with the database.
+    When values were only appended to CountryIndicators since the panel was
+    built, as when a new year of data arrives, only the (CountryCode, Year)
+    rows of the appended values are read from the database and merged into
+    the panel. Otherwise the panel is built again from scratch (see build).
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+
+    Returns
+    -------
+    path: Directory of the up-to-date panel.
+    """
+    path = os.path.join(STORE_PATH, store_key(database_path, exclude_list))
+    if os.path.isfile(os.path.join(path, INDEX_FNAME)):
+        return path
+    former = _stored_panel()
+    index = None if former is None else _read_index(former)
+    if (index is None or 'max_rowid' not in index
+            or index['exclude_list'] != list(exclude_list or [])
+            or index['countries_digest'] != _countries_digest(database_path)):
+        build(database_path, exclude_list, path)
+        return path
+    former_digest, rows_digest, max_rowid = fingerprint.rowid_digests(
+        database_path, boundary=index['max_rowid'])
+    # Former values that changed or were deleted require a full build
+    if former_digest != index['rows_digest']:
+        logging.info('Values of the database changed, building the panel again')
+        build(database_path, exclude_list, path)
+        return path
+    added = query.read_keys(database_path, exclude_list, after_rowid=index['max_rowid'])
+    logging.info(f'Extending feature store with {len(added)} rows')
+    instrumentation.current().set(added_rows=len(added))
+    new_values, new_countries, new_years, new_indicators = query.read_wide(
+        database_path, exclude_list, dtype=np.float32, rows=added)
+    former_values = np.load(os.path.join(former, VALUES_FNAME), mmap_mode='r')
+    former_keys = pd.MultiIndex.from_arrays([index['countries'], index['years']])
+    # Former rows with appended values are replaced by their new version
+    kept = np.flatnonzero(~former_keys.isin(added))
+    indicators = sorted(set(index['indicators']) | set(new_indicators))
+    countries = np.concatenate([np.asarray(index['countries'], dtype=object)[kept],
+                                new_countries])
+    years = np.concatenate([np.asarray(index['years'], dtype=np.int64)[kept], new_years])
+    # Same (CountryCode, Year) order as a full build
+    order = np.lexsort((years, countries.astype(str)))
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    values = panel.allocate((len(order), len(indicators)), np.float32)
+    values[...] = np.nan
+    columns = pd.Index(indicators)
+    # Column by column, the former panel is never loaded as a whole
+    former_rows, new_rows = position[:len(kept)], position[len(kept):]
+    for j, col in enumerate(columns.get_indexer(index['indicators'])):
+        values[former_rows, col] = former_values[kept, j]
+    for j, col in enumerate(columns.get_indexer(new_indicators)):
+        values[new_rows, col] = new_values[:, j]
+    _write(path, values, countries[order], years[order], indicators,
+           max_rowid=max_rowid, rows_digest=rows_digest,
+           countries_digest=index['countries_digest'],
+           exclude_list=index['exclude_list'], extended_from=os.path.basename(former),
+           added=[[country, int(year)] for country, year in added])
+    return path
+
+
+def added_rows(database_path, exclude_list):
+    """(CountryCode, Year) rows added to the panel or updated by the last
+    call to extend, None if the panel was built from scratch."""
+    index = _read_index(extend(database_path, exclude_list))
+    if 'added' not in index:
+        return None
+    return pd.MultiIndex.from_arrays([[row[0] for row in index['added']],
+                                      [row[1] for row in index['added']]],
+                                     names=['CountryCode', 'Year'])
+
+
+def load(database_path, exclude_list, columns=None, budget=None, spill=None):
+    """Wide panel of the database in the compact layout of panel.Panel,
+    built on the first call and read from the store afterwards (see extend).
+    Only the requested indicators are read from the stored panel, which is
+    used as it is, without being loaded in memory, when the panel does not
+    fit in the memory budget.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    columns: Indicators to load, all of them if None. Indicators that are
+        not in the database are ignored.
+    budget: Memory budget in MB (see panel.allocate).
+    spill: Whether a panel over the budget is spilled to disk (see panel.allocate).
+
+    Returns
+    -------
+    panel: panel.Panel with every (CountryCode, Year) row of the database.
+    """
+    path = extend(database_path, exclude_list)
+    index = _read_index(path)
+    values = np.load(os.path.join(path, VALUES_FNAME), mmap_mode='r')
+    return panel.Panel.from_arrays(values, index['countries'], index['years'],
+                                   index['indicators'], columns=columns,
+                                   budget=budget, spill=spill)
+
+
+def load_panel(database_path, exclude_list, columns=None):
+    """Wide panel of the database as a dataframe (see load). Equivalent to
+    pivoting the output of read_database.get_data with aggfunc=np.sum, in
+    float32.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    columns: Indicators to load, all of them if None. Indicators that are
+        not in the database are ignored.
+
+    Returns
+    -------
+    wide: Dataframe with (CountryCode, Year) rows and one column per indicator.
+        Rows without any value in the loaded columns are dropped.
+    """
+    return load(database_path, exclude_list, columns).to_frame(drop_empty=columns is not None)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import feature_store
+from utils import fingerprint
+from utils import instrumentation
+
+KINDS = ('lag', 'diff', 'mean', 'std')
+
+
+def specs(predicted_indicator=None, indicators=None, lags=None, diffs=None, windows=None):
+    """Features generated for the model (see generate).
+
+    The predicted indicator gets the features lag<k> (its value k years
+    before), diff<k> (its change over k years), mean<w> and std<w> (its
+    mean and standard deviation over the last w years). The other
+    indicators get the same features, prefixed by their code, such as
+    SP.POP.TOTL_lag1.
+
+    Parameters
+    ----------
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+    indicators: Other indicators with features. Per default: config.FEATURE_INDICATORS.
+    lags: Lags in years. Per default: config.FEATURE_LAGS.
+    diffs: Differences in years. Per default: config.FEATURE_DIFFS.
+    windows: Rolling windows in years. Per default: config.FEATURE_WINDOWS.
+
+    Returns
+    -------
+    specs
+        List of (name, indicator, kind, size) of every feature."""
+    if predicted_indicator is None:
+        predicted_indicator = config.PREDICTED_INDICATOR
+    indicators = config.FEATURE_INDICATORS if indicators is None else indicators
+    lags = config.FEATURE_LAGS if lags is None else lags
+    diffs = config.FEATURE_DIFFS if diffs is None else diffs
+    windows = config.FEATURE_WINDOWS if windows is None else windows
+    sizes = ([('lag', k) for k in lags] + [('diff', k) for k in diffs]
+             + [(kind, w) for w in windows for kind in ('mean', 'std')])
+    result = []
+    others = [name for name in indicators
+              if name.replace('.', '_') != predicted_indicator.replace('.', '_')]
+    for indicator in [predicted_indicator] + others:
+        prefix = '' if indicator == predicted_indicator else indicator + '_'
+        result.extend((f'{prefix}{kind}{size}', indicator, kind, int(size))
+                      for kind, size in sizes)
+    return result
+
+
+def depth(feature_specs):
+    """Number of years of history the features depend on, current year
+    included."""
+    return 1 + max([size - 1 if kind in ('mean', 'std') else size
+                    for _, _, kind, size in feature_specs], default=0)
+
+
+def _shifted(grid, k):
+    """grid shifted k years forward along its last axis, NaN before its start."""
+    if k == 0:
+        return grid
+    out = np.full_like(grid, np.nan)
+    if k < grid.shape[-1]:
+        out[..., k:] = grid[..., :-k]
+    return out
+
+
+def _compute(grid, kind, size):
+    """Feature of every year of a (country, year) grid of an indicator."""
+    if kind == 'lag':
+        return _shifted(grid, size)
+    if kind == 'diff':
+        return grid - _shifted(grid, size)
+    # Rolling window ending at each year, NaN unless all its years have a value
+    window = np.stack([_shifted(grid, j) for j in range(size)], axis=-1)
+    if kind == 'mean':
+        return window.mean(axis=-1)
+    if kind == 'std':
+        return window.std(axis=-1, ddof=1) if size > 1 else np.zeros_like(grid)
+    raise ValueError(f"Unknown feature {kind}, expected one of {', '.join(KINDS)}")
+
+
+def _grid(codes, years, n_codes, year_min, n_years, values):
+    grid = np.full((n_codes, n_years), np.nan)
+    grid[codes, years - year_min] = values
+    return grid
+
+
+def compute(columns, country, year, feature_specs):
+    """Features of panel rows in a single vectorized pass.
+    Every indicator is scattered into a dense (country, year) grid, so that
+    lags and windows are shifts along the years of each country: the first
+    years of a country never see the values of another country, and a
+    missing year is missing in the lags instead of being skipped.
+
+    Parameters
+    ----------
+    columns: Dictionary with the values of each indicator at the rows.
+    country: Country of each row (codes or names).
+    year: Year of each row.
+    feature_specs: Features to compute (see specs).
+
+    Returns
+    -------
+    values
+        float32 array with one row per row of the panel and one column per
+        feature."""
+    codes, uniques = pd.factorize(np.asarray(country))
+    year = np.asarray(year, dtype=np.int64)
+    year_min = int(year.min()) if len(year) else 0
+    n_years = int(year.max()) - year_min + 1 if len(year) else 0
+    values = np.empty((len(codes), len(feature_specs)), dtype=np.float32)
+    grids = {}
+    for j, (_, indicator, kind, size) in enumerate(feature_specs):
+        if indicator not in grids:
+            grids[indicator] = _grid(codes, year, len(uniques), year_min, n_years,
+                                     np.asarray(columns[indicator], dtype=np.float64))
+        values[:, j] = _compute(grids[indicator], kind, size)[codes, year - year_min]
+    return values
+
+
+def generate(frame, feature_specs):
+    """Features of a wide frame indexed by (CountryCode, Year), such as the
+    output of feature_store.load_panel (see compute).
+
+    Returns
+    -------
+    features
+        Dataframe with the index of frame and one column per feature."""
+    indicators = {indicator for _, indicator, _, _ in feature_specs}
+    values = compute({name: frame[name].to_numpy() for name in indicators},
+                     frame.index.get_level_values(0), frame.index.get_level_values(1),
+                     feature_specs)
+    return pd.DataFrame(values, index=frame.index,
+                        columns=[name for name, _, _, _ in feature_specs])
+
+
+@instrumentation.traced('features')
+def load(database_path, exclude_list, predicted_indicator=None, feature_specs=None):
+    """Features of every row of the stored panel (see compute).
+    They are cached next to the panel in the feature store, keyed by their
+    specs, and computed again when the panel changes.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    predicted_indicator: Variable predicted (see specs).
+    feature_specs: Features to load. Per default, specs(predicted_indicator).
+
+    Returns
+    -------
+    features
+        Dataframe with (CountryCode, Year) rows and one column per feature."""
+    if feature_specs is None:
+        feature_specs = specs(predicted_indicator)
+    names = [name for name, _, _, _ in feature_specs]
+    key = fingerprint.hash_values([list(spec) for spec in feature_specs])[:16]
+    path = os.path.join(feature_store.extend(database_path, exclude_list),
+                        f'features_{key}.npy')
+    if os.path.isfile(path):
+        panel = feature_store.load(database_path, exclude_list, columns=[])
+        values = np.load(path)
+    else:
+        indicators = sorted({indicator for _, indicator, _, _ in feature_specs})
+        panel = feature_store.load(database_path, exclude_list, columns=indicators)
+        # Indicators missing from the database have no features
+        columns = {name: (panel.column(name) if name in panel.columns
+                          else np.full(panel.n_rows, np.nan, dtype=np.float32))
+                   for name in indicators}
+        values = compute(columns, panel.country, panel.year, feature_specs)
+        tmp_fname = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_fname, values)
+        os.replace(tmp_fname, path)
+        logging.info(f'Features {", ".join(names)} cached in {path}')
+    instrumentation.current().set(rows=len(values), columns=len(names))
+    return pd.DataFrame(values, index=panel.index(), columns=names)
+
+
+def indicators(feature_specs):
+    """Indicators with features, in the order of feature_specs: the
+    predicted indicator first (see specs)."""
+    return list(dict.fromkeys(indicator for _, indicator, _, _ in feature_specs))
+
+
+def indicator_columns(frame, feature_specs):
+    """Values of every indicator with features (see indicators) in the
+    columns of frame, named with '_' instead of '.', None for those that
+    are not in frame."""
+    columns = {name.replace('.', '_'): name for name in frame.columns}
+    return [frame[columns[indicator.replace('.', '_')]].to_numpy()
+            if indicator.replace('.', '_') in columns else None
+            for indicator in indicators(feature_specs)]
+
+
+def history(country, year, columns, at_year, n_years):
+    """Last n_years values of the indicators with features up to at_year,
+    of the rows of at_year, in the order of the rows. These are the start
+    of a recursive forecast (see advance).
+
+    Parameters
+    ----------
+    country: Country of each row.
+    year: Year of each row.
+    columns: Values of each indicator with features at the rows, in the
+        order of indicators (see indicator_columns), None if unknown.
+    at_year: Year the forecast starts from.
+    n_years: Years of history (see depth).
+
+    Returns
+    -------
+    history
+        Array of shape (row of at_year, indicator, year), the last year
+        being at_year."""
+    codes, uniques = pd.factorize(np.asarray(country))
+    year = np.asarray(year, dtype=np.int64)
+    first = at_year - n_years + 1
+    inside = (year >= first) & (year <= at_year)
+    rows = codes[year == at_year]
+    result = np.full((len(rows), len(columns), n_years), np.nan)
+    for i, values in enumerate(columns):
+        if values is not None:
+            grid = _grid(codes[inside], year[inside], len(uniques), first, n_years,
+                         np.asarray(values, dtype=np.float64)[inside])
+            result[:, i] = grid[rows]
+    return result
+
+
+def advance(values, columns, history, y_pred, predicted_indicator=None):
+    """Moves the input rows of a recursive forecast one year forward: the
+    prediction becomes the response variable and the features of every
+    indicator are computed again from its history. The other variables
+    are carried forward as they are in values, so a covariate changed by
+    the caller (see scenarios.simulate) moves its features too. The
+    features of an indicator that is not a column of values are left as
+    they are, its next value being unknown.
+
+    Parameters
+    ----------
+    values: Input rows of the model, updated in place.
+    columns: Names of the columns of values.
+    history: Indicators of the last years of each row (see history).
+    y_pred: Prediction of the next year of each row.
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    history
+        History of the next year."""
+    if predicted_indicator is None:
+        predicted_indicator = config.PREDICTED_INDICATOR
+    feature_specs = specs(predicted_indicator)
+    predicted_indicator = predicted_indicator.replace('.', '_')
+    names = [name.replace('.', '_') for name in indicators(feature_specs)]
+    columns = [name.replace('.', '_') for name in columns]
+    values[:, columns.index(predicted_indicator)] = y_pred
+    latest = np.empty(history.shape[:2])
+    for i, name in enumerate(names):
+        latest[:, i] = (values[:, columns.index(name)] if name in columns
+                        else history[:, i, -1])
+    history = np.concatenate([history[:, :, 1:], latest[:, :, np.newaxis]], axis=2)
+    for name, indicator, kind, size in feature_specs:
+        name, indicator = name.replace('.', '_'), indicator.replace('.', '_')
+        if name in columns and indicator in columns:
+            values[:, columns.index(name)] = _compute(history[:, names.index(indicator)],
+                                                      kind, size)[:, -1]
+    return history
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from utils import config
+
+_DIGESTS_FILE = os.path.join(config.CACHE_PATH, 'digests.json')
+
+# Tables the pipeline reads its inputs from.
+INPUT_TABLES = ('Countries', 'CountryIndicators')
+
+
+def _read_digests():
+    try:
+        with open(_DIGESTS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_digests(digests):
+    os.makedirs(config.CACHE_PATH, exist_ok=True)
+    tmp_fname = _DIGESTS_FILE + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp_fname, _DIGESTS_FILE)
+
+
+def _stamp(database_path, tables):
+    """Cheap stamp of the contents of the tables: the number of rows and
+    the last rowid of each table, and the size and modification time of
+    the database file and of its write-ahead log. In WAL mode, the commits
+    stay in the log while another connection is open, the database file
+    being left unchanged."""
+    conn = sqlite3.connect(database_path)
+    try:
+        stamp = [list(conn.execute(f'SELECT COUNT(*), MAX(rowid) FROM {table};').fetchone())
+                 for table in tables]
+    finally:
+        conn.close()
+    # After closing: the last connection to close checkpoints the log
+    for fname in (database_path, database_path + '-wal'):
+        try:
+            stat = os.stat(fname)
+            stamp.append([stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            stamp.append(None)
+    return stamp
+
+
+def _memoized(key, stamp, compute):
+    """Digest memoized in config.CACHE_PATH together with stamp, it is
+    only computed again when the stamp changes."""
+    digests = _read_digests()
+    cached = digests.get(key)
+    if cached is not None and cached['stamp'] == stamp:
+        return cached['digest']
+    digest = compute()
+    digests[key] = {'stamp': stamp, 'digest': digest}
+    _write_digests(digests)
+    return digest
+
+
+def database_digest(database_path, tables=INPUT_TABLES, chunksize=100000):
+    """SHA-256 of the contents of the input tables of the database.
+    Only the tables the pipeline reads from are hashed, so writing
+    predictions into the same database file does not change the digest.
+    The digest is memoized and only computed again when the stamp of the
+    tables changes (see _stamp).
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    tables: Tables to hash.
+    chunksize: Number of rows fetched at once.
+
+    Returns
+    -------
+    digest
+        Hexadecimal SHA-256 digest of the tables."""
+    database_path = os.path.abspath(database_path)
+
+    def compute():
+        sha = hashlib.sha256()
+        conn = sqlite3.connect(database_path)
+        try:
+            for table in tables:
+                sha.update(table.encode())
+                cursor = conn.execute(f'SELECT * FROM {table} ORDER BY rowid;')
+                rows = cursor.fetchmany(chunksize)
+                while rows:
+                    sha.update(repr(rows).encode())
+                    rows = cursor.fetchmany(chunksize)
+        finally:
+            conn.close()
+        return sha.hexdigest()
+
+    key = database_path + '::' + ','.join(tables)
+    return _memoized(key, _stamp(database_path, tables), compute)
+
+
+def rowid_digests(database_path, table='CountryIndicators', boundary=None,
+                  chunksize=100000):
+    """SHA-256 of the rows of table in rowid order, up to the rowid
+    boundary and in total, computed in a single pass. Rows appended to the
+    table do not change the digest up to the former last rowid, while any
+    change of the former rows does.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    table: Table to hash.
+    boundary: Last rowid of the first digest, None to skip it.
+    chunksize: Number of rows fetched at once.
+
+    Returns
+    -------
+    boundary_digest
+        Digest of the rows up to boundary, None if boundary is None.
+    digest
+        Digest of all the rows.
+    max_rowid
+        Last rowid of the table, 0 if it is empty."""
+    sha = hashlib.sha256(table.encode())
+    boundary_digest = None
+    max_rowid = 0
+    conn = sqlite3.connect(database_path)
+    try:
+        cursor = conn.execute(f'SELECT rowid, * FROM {table} ORDER BY rowid;')
+        rows = cursor.fetchmany(chunksize)
+        while rows:
+            if boundary is not None and boundary_digest is None and rows[-1][0] > boundary:
+                split = next(i for i, row in enumerate(rows) if row[0] > boundary)
+                if split:
+                    sha.update(repr(rows[:split]).encode())
+                boundary_digest = sha.hexdigest()
+                rows = rows[split:]
+            sha.update(repr(rows).encode())
+            max_rowid = rows[-1][0]
+            rows = cursor.fetchmany(chunksize)
+    finally:
+        conn.close()
+    if boundary is not None and boundary_digest is None:
+        boundary_digest = sha.hexdigest() if max_rowid == boundary else None
+    return boundary_digest, sha.hexdigest(), max_rowid
+
+
+def hash_values(*values):
+    """SHA-256 of an arbitrary sequence of values.
+    Numpy arrays and pandas objects are hashed through their raw bytes,
+    everything else through its (sorted) JSON representation.
+
+    Returns
+    -------
+    digest
+        Hexadecimal SHA-256 digest."""
+    sha = hashlib.sha256()
+    for value in values:
+        if hasattr(value, 'to_numpy'):
+            value = value.to_numpy()
+        if isinstance(value, np.ndarray):
+            if value.dtype == object:
+                value = value.astype(str)
+            value = np.ascontiguousarray(value)
+            sha.update(str((value.dtype.str, value.shape)).encode())
+            sha.update(value.tobytes())
+        else:
+            sha.update(json.dumps(value, sort_keys=True, default=str).encode())
+        sha.update(b'\x00')
+    return sha.hexdigest()
+
+
+def model_fingerprint(database_path, features, params, groups):
+    """Key of a trained model in the model store.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    features: Names of the columns the model is trained with.
+    params: Parameters of the booster, the GPModel and the cross-validation.
+    groups: Group indices of the random effects.
+
+    Returns
+    -------
+    fingerprint
+        Hexadecimal digest identifying the model."""
+    return hash_values(database_digest(database_path), list(features),
+                       params, np.asarray(groups))
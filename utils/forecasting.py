@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import features
+from utils import instrumentation
+from utils import prediction_cache
+from utils import io_aux_train as training
+from utils import io_aux_test as testing
+
+# Version of the steps of the chain, part of the key of the cached entries:
+# 2 keeps the history of every indicator with features (see features.history).
+CHAIN_VERSION = 2
+
+
+def parse_years(years):
+    """Parses the years of prediction given in the command line.
+
+    Parameters
+    ----------
+    years: Range such as '2011-2030', list such as '2011,2015' or a
+        combination of both ('2011-2013,2020').
+
+    Returns
+    -------
+    years
+        Sorted list of years without repetitions."""
+    parsed = set()
+    for part in str(years).split(','):
+        bounds = part.strip().split('-')
+        if len(bounds) == 1:
+            parsed.add(int(bounds[0]))
+        elif len(bounds) == 2:
+            first, last = int(bounds[0]), int(bounds[1])
+            if first > last:
+                raise ValueError(f"Invalid range of years {part}")
+            parsed.update(range(first, last + 1))
+        else:
+            raise ValueError(f"Invalid range of years {part}")
+    return sorted(parsed)
+
+
+def _prediction_frame(y_pred, countries, years):
+    return pd.DataFrame(data={'y_pred': y_pred, 'Country': countries,
+                              'Year': years})
+
+
+def _cache_keys(X, bst, cache, predicted_indicator):
+    """Cache of the forecast and the keys of the model and the data, None
+    without cache or for a model that is not stored (see
+    models.GDPGrowthPredictor.fingerprint)."""
+    model_key = getattr(bst, 'fingerprint', None)
+    if cache is False or model_key is None:
+        return None
+    cache = prediction_cache.default_cache() if cache is None else cache
+    if cache is None:
+        return None
+    return cache, model_key, cache.data_key(X, predicted_indicator, CHAIN_VERSION)
+
+
+@instrumentation.traced('forecast')
+def forecast(X, bst, years, encoder=None, predicted_indicator=None, cache=None):
+    """Predicts the response variable of all countries for several years
+    in one pass.
+    Years covered by the database are predicted from the data of the
+    previous year with a single call to the model. Years after
+    config.DB_YEAR_MAX are predicted recursively as in
+    io_aux_test.retrieve_test_data, but the chain is built only once:
+    the prediction of each year becomes the response variable of the input
+    data of the next year, and the lags and rolling features of the
+    response and of the covariates, which are carried forward, are moved
+    with it (see features.advance), so every
+    horizon costs one call to the model.
+    The predictions of every year and the steps of the chain are cached
+    (see prediction_cache.PredictionCache): cached years are not predicted
+    again, and the chain resumes from the latest cached step before the
+    first year that is not cached.
+
+    Parameters
+    ----------
+    X: covariable-cleaned database, indexed by year.
+    bst: Trained model (gpboost.Booster or models.GDPGrowthPredictor).
+    years: years of prediction.
+    encoder: encoding.CountryEncoder used for the training data
+        (see io_aux_train.handle_country_groups).
+    predicted_indicator: Variable predicted by the model.
+        Per default: config.PREDICTED_INDICATOR.
+    cache: prediction_cache.PredictionCache. Per default, the cache of the
+        process (see prediction_cache.default_cache). False for none. Only
+        the models of the model store, which have a fingerprint, are cached.
+
+    Returns
+    -------
+    predictions
+        Dataframe with the columns y_pred, Country and Year."""
+    years = sorted(set(int(year) for year in years))
+    if years[0] < config.DB_YEAR_MIN + 1:
+        raise ValueError(f"The year to predict has to be equal \
+        or greater than {(config.DB_YEAR_MIN + 1)}")
+    if predicted_indicator is None:
+        predicted_indicator = config.PREDICTED_INDICATOR
+    predicted_indicator = predicted_indicator.replace(".", "_")
+    cached = _cache_keys(X, bst, cache, predicted_indicator)
+    if cached is not None:
+        cache, model_key, data_key = cached
+    predictions = []
+
+    past_years = [year for year in years if year <= config.DB_YEAR_MAX]
+    past = []
+    if cached is not None:
+        for year in list(past_years):
+            entry = cache.get(cache.key(model_key, data_key, 'past', year))
+            if entry is not None:
+                past.append(_prediction_frame(entry['y_pred'], entry['countries'].astype(object),
+                                              year))
+                past_years.remove(year)
+    if past_years:
+        logging.info(f'Predicting {len(past_years)} years from the database')
+        X_past = X.loc[X.index.isin([year - 1 for year in past_years])]
+        countries = X_past['Country'].to_numpy()
+        X_past, group_past = training.handle_country_groups(X_past, encoder)
+        y_pred = testing.predict(X_past, bst, group_past)
+        past.append(_prediction_frame(y_pred, countries, X_past.index.to_numpy() + 1))
+        if cached is not None:
+            for year in past_years:
+                rows = X_past.index.to_numpy() == year - 1
+                cache.put(cache.key(model_key, data_key, 'past', year),
+                          y_pred=y_pred[rows], countries=countries[rows].astype(str))
+    if past:
+        # In the order of the rows of X, as when predicted at once
+        predictions.append(pd.concat(past, ignore_index=True).sort_values(
+            ['Country', 'Year'], kind='stable', ignore_index=True))
+
+    future_years = [year for year in years if year > config.DB_YEAR_MAX]
+    if future_years:
+        X_chain = X.loc[X.index == config.DB_YEAR_MAX]
+        countries = X_chain['Country'].to_numpy()
+        wanted = set(future_years)
+        chain = {}
+        first = config.DB_YEAR_MAX + 1
+        if cached is not None:
+            for year in future_years:
+                entry = cache.get(cache.key(model_key, data_key, 'chain', year))
+                if entry is None:
+                    break
+                chain[year] = entry['y_pred']
+            missing = [year for year in future_years if year not in chain]
+            if missing:
+                # Latest cached step before the first missing year
+                for year in range(missing[0] - 1, config.DB_YEAR_MAX, -1):
+                    entry = cache.get(cache.key(model_key, data_key, 'chain', year))
+                    if entry is not None:
+                        first = year + 1
+                        break
+        else:
+            missing = future_years
+        if missing:
+            logging.info(f'Predicting {first}-{missing[-1]} recursively')
+            X_chain, group_chain = training.handle_country_groups(X_chain, encoder)
+            columns = list(X_chain.columns)
+            if first > config.DB_YEAR_MAX + 1:
+                # The chain is carried as one array, updated in place at each step
+                values, history = entry['values'].copy(), entry['history']
+            else:
+                values = X_chain.to_numpy(dtype=np.float64)
+                feature_specs = features.specs(predicted_indicator)
+                history = features.history(X['Country'], X['Time'],
+                                           features.indicator_columns(X, feature_specs),
+                                           config.DB_YEAR_MAX, features.depth(feature_specs))
+            for year in range(first, missing[-1] + 1):
+                y_pred = testing.predict(values, bst, group_chain)
+                if year in wanted:
+                    chain[year] = y_pred
+                history = features.advance(values, columns, history, y_pred,
+                                           predicted_indicator)
+                if cached is not None:
+                    cache.put(cache.key(model_key, data_key, 'chain', year),
+                              y_pred=y_pred, values=values.copy(), history=history)
+        predictions.extend(_prediction_frame(chain[year], countries, year)
+                           for year in future_years)
+    if cached is not None:
+        cache.evict()
+    predictions = pd.concat(predictions, ignore_index=True)
+    instrumentation.current().set(rows=len(predictions), years=len(years))
+    return predictions
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import config
+
+
+def nan_ratio_mask(values, threshold):
+    """Columns whose ratio of NaN values is lower or equal than threshold."""
+    return np.isnan(values).sum(axis=0) / values.shape[0] <= threshold
+
+
+def group_fill(block, group_start, group_end):
+    """Forward fill and then backward fill every column of block within
+    each group, i.e. x.fillna(x.ffill().bfill()) per group, in a single
+    vectorized pass over the whole block.
+
+    Parameters
+    ----------
+    block: 2-D array whose rows are sorted by group.
+    group_start: Position of the first row of the group of each row.
+    group_end: Position of the last row of the group of each row.
+
+    Returns
+    -------
+    filled
+        Array of the same shape as block."""
+    n_rows = block.shape[0]
+    valid = ~np.isnan(block)
+    positions = np.arange(n_rows)[:, None]
+    # Last valid row at or before each row, first valid row at or after it
+    last = np.maximum.accumulate(np.where(valid, positions, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, positions, n_rows)[::-1],
+                                      axis=0)[::-1]
+    forward_ok = last >= group_start[:, None]
+    backward_ok = following <= group_end[:, None]
+    forward = np.take_along_axis(block, np.clip(last, 0, n_rows - 1), axis=0)
+    backward = np.take_along_axis(block, np.clip(following, 0, n_rows - 1), axis=0)
+    return np.where(valid, block,
+                    np.where(forward_ok, forward,
+                             np.where(backward_ok, backward, np.nan)))
+
+
+def impute(values, groups, threshold=0.3, chunk_size=None, workers=None):
+    """Rejects the columns whose NaN ratio exceeds threshold and imputes
+    the NaN values of the kept ones: forward and backward fill within each
+    group and, where a group has no value at all, the mean of the column.
+    The columns are processed in chunks of chunk_size, in parallel threads
+    if workers > 1.
+
+    Parameters
+    ----------
+    values: 2-D array, one column per variable.
+    groups: Group of each row.
+    threshold: Maximum ratio of NaN values of a kept column.
+    chunk_size: Number of columns processed at once.
+        Per default: config.IMPUTATION_CHUNK_SIZE.
+    workers: Number of threads. Per default: config.IMPUTATION_WORKERS.
+
+    Returns
+    -------
+    filled
+        Imputed values of the kept columns.
+    keep
+        Boolean mask of the kept columns.
+    timings
+        Seconds spent in each stage."""
+    chunk_size = config.IMPUTATION_CHUNK_SIZE if chunk_size is None else chunk_size
+    workers = config.IMPUTATION_WORKERS if workers is None else workers
+    values = np.asarray(values, dtype=np.float64)
+    timings = {}
+
+    start = time.perf_counter()
+    keep = nan_ratio_mask(values, threshold)
+    means = np.full(values.shape[1], np.nan)
+    has_values = (~np.isnan(values)).any(axis=0)
+    means[has_values] = np.nanmean(values[:, has_values], axis=0)
+    kept = values[:, keep]
+    means = means[keep]
+    timings['threshold'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Stable sort by group, keeping the order of the rows within a group
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    is_start = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    starts = np.flatnonzero(is_start)
+    ends = np.r_[starts[1:] - 1, len(sorted_groups) - 1]
+    group_id = np.cumsum(is_start) - 1
+    group_start, group_end = starts[group_id], ends[group_id]
+    sorted_kept = kept[order]
+    timings['sort'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filled = np.empty_like(sorted_kept)
+    chunks = [slice(i, i + chunk_size) for i in range(0, kept.shape[1], chunk_size)]
+
+    def fill_chunk(chunk):
+        block = group_fill(sorted_kept[:, chunk], group_start, group_end)
+        nan_rows, nan_cols = np.nonzero(np.isnan(block))
+        block[nan_rows, nan_cols] = means[chunk][nan_cols]
+        filled[:, chunk] = block
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(fill_chunk, chunks))
+    else:
+        for chunk in chunks:
+            fill_chunk(chunk)
+    timings['fill'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unsorted = np.empty_like(filled)
+    unsorted[order] = filled
+    timings['unsort'] = time.perf_counter() - start
+    logging.info('Imputation of {} columns ({} kept): {}'.format(
+        values.shape[1], int(keep.sum()),
+        ', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in timings.items())))
+    return unsorted, keep, timings
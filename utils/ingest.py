@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from utils import config
+from utils import instrumentation
+from utils import query
+from utils import results
+
+SCHEMA = '''
+CREATE TABLE Countries (CountryCode TEXT, ShortName TEXT, LongName TEXT, Region TEXT,
+                        IncomeGroup TEXT);
+CREATE TABLE Indicators (IndicatorName TEXT, IndicatorCode TEXT);
+CREATE TABLE CountryIndicators (CountryName TEXT, CountryCode TEXT, IndicatorName TEXT,
+                                IndicatorCode TEXT, Year INTEGER, Value REAL);
+'''
+
+# Settings of the connection loading the database. There is no journal:
+# the database is built in a temporary file, replaced only once complete.
+LOAD_PRAGMAS = (
+    'PRAGMA journal_mode=OFF;',
+    'PRAGMA synchronous=OFF;',
+    'PRAGMA locking_mode=EXCLUSIVE;',
+    'PRAGMA cache_size=-262144;',
+)
+
+VALUE_COLUMNS = ['CountryName', 'CountryCode', 'IndicatorName', 'IndicatorCode', 'Year',
+                 'Value']
+
+# Names of the columns of the country and series files of the WDI exports
+COUNTRY_COLUMNS = {'CountryCode': 'CountryCode', 'ShortName': 'ShortName',
+                   'LongName': 'LongName', 'Region': 'Region', 'IncomeGroup': 'IncomeGroup'}
+
+SERIES_COLUMNS = {'SeriesCode': 'IndicatorCode', 'IndicatorName': 'IndicatorName'}
+
+
+def _normalize(columns):
+    """Column names without spaces: 'Country Code' and 'CountryCode' are
+    the same column in the different WDI exports."""
+    return [str(name).replace(' ', '') for name in columns]
+
+
+def _read_chunks(path, chunksize):
+    """Streams the values of a WDI data file in long format.
+    Both layouts of the exports are read: one row per value (columns
+    CountryName, CountryCode, IndicatorName, IndicatorCode, Year, Value),
+    and one row per country and indicator with a column per year, as in
+    WDIData.csv. Missing values are skipped."""
+    chunks = pd.read_csv(path, chunksize=chunksize, encoding='utf-8-sig',
+                         dtype={'Country Code': str, 'CountryCode': str,
+                                'Indicator Code': str, 'IndicatorCode': str})
+    for chunk in chunks:
+        chunk.columns = _normalize(chunk.columns)
+        if 'Value' not in chunk.columns:
+            years = [name for name in chunk.columns if name.isdigit()]
+            chunk = chunk.melt(id_vars=VALUE_COLUMNS[:4], value_vars=years,
+                               var_name='Year', value_name='Value')
+        chunk = chunk.loc[chunk['Value'].notna(), VALUE_COLUMNS]
+        chunk['Year'] = chunk['Year'].astype('int64')
+        chunk['Value'] = chunk['Value'].astype('float64')
+        yield chunk
+
+
+def _read_table(path, columns):
+    """Columns of a WDI country or series file, renamed."""
+    table = pd.read_csv(path, encoding='utf-8-sig', dtype=str)
+    table.columns = _normalize(table.columns)
+    missing = [name for name in columns if name not in table.columns]
+    if missing:
+        raise ValueError(f"Columns {', '.join(missing)} not found in {path}")
+    table = table[list(columns)].rename(columns=columns)
+    return table.where(table.notna(), None)
+
+
+def _keep_results(conn, database_path, results_path):
+    """Copies the predictions of the former database, which would
+    otherwise be lost, into the results database (see config.RESULTS_PATH):
+    the new database if it is also the results one. The predictions
+    already in the results database are kept."""
+    former = sqlite3.connect(database_path)
+    try:
+        tables = [row[0] for row in former.execute(
+            "SELECT name FROM sqlite_master WHERE type='table';")]
+    finally:
+        former.close()
+    if results.TABLE not in tables:
+        return 0
+    # Brings the table of the former database to the current schema,
+    # without changing its journal mode
+    results.connect(database_path, wal=False).close()
+    if os.path.abspath(results_path) == os.path.abspath(database_path):
+        target = conn
+        target.executescript(results.SCHEMA)
+    else:
+        target = results.connect(results_path)
+    target.execute('ATTACH DATABASE ? AS former;', (database_path,))
+    try:
+        with target:
+            n_rows = target.execute(f'INSERT OR IGNORE INTO {results.TABLE} '
+                                    f'SELECT * FROM former.{results.TABLE};').rowcount
+    finally:
+        target.execute('DETACH DATABASE former;')
+        if target is not conn:
+            target.close()
+    return n_rows
+
+
+def _close_journal(database_path):
+    """Checkpoints the write-ahead log of a database in WAL mode and
+    switches it back to a rollback journal, so that no -wal or -shm file
+    is left to be read with the file that replaces it."""
+    conn = sqlite3.connect(database_path, timeout=config.RESULTS_TIMEOUT)
+    try:
+        if conn.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal':
+            conn.execute('PRAGMA journal_mode=DELETE;')
+    finally:
+        conn.close()
+
+
+@instrumentation.traced('ingest')
+def ingest(data_path, countries_path=None, series_path=None, database_path=None,
+           chunksize=None, transaction_rows=None, results_path=None):
+    """Builds the database from WDI CSV exports.
+    The data file is streamed in chunks of chunksize lines and inserted
+    with executemany, committing every transaction_rows values, so the
+    memory use does not depend on the size of the file. The indexes are
+    built once all the values are loaded. Repeated (CountryCode,
+    IndicatorCode, Year) values, which read_database.get_data would add up
+    in the wide panel, are removed, the last one in the file being kept.
+    The database is written to a temporary file that replaces
+    database_path once complete. The predictions the former one held are
+    moved to the results database.
+
+    Parameters
+    ----------
+    data_path: CSV file of the values (WDIData.csv or Indicators.csv).
+    countries_path: CSV file of the countries (WDICountry.csv or
+        Country.csv). Per default, the countries are taken from the data
+        file, without region and income group.
+    series_path: CSV file of the indicators (WDISeries.csv or Series.csv).
+        Per default, the indicators are taken from the data file.
+    database_path: Database to build. Per default: config.DATABASE_PATH.
+    chunksize: Lines read at once. Per default: config.INGEST_CHUNK_ROWS.
+    transaction_rows: Values inserted per transaction.
+        Per default: config.INGEST_TRANSACTION_ROWS.
+    results_path: Results database. Per default: config.RESULTS_PATH.
+
+    Returns
+    -------
+    summary
+        Dictionary with the number of values, duplicates, countries and
+        indicators, the time and the throughput of the ingestion."""
+    database_path = config.DATABASE_PATH if database_path is None else database_path
+    results_path = config.RESULTS_PATH if results_path is None else results_path
+    chunksize = config.INGEST_CHUNK_ROWS if chunksize is None else chunksize
+    if transaction_rows is None:
+        transaction_rows = config.INGEST_TRANSACTION_ROWS
+    tmp_fname = database_path + '.ingest'
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+    start = time.perf_counter()
+    size_mb = os.path.getsize(data_path) / 2 ** 20
+
+    conn = sqlite3.connect(tmp_fname, isolation_level=None)
+    try:
+        for pragma in LOAD_PRAGMAS:
+            conn.execute(pragma)
+        conn.executescript(SCHEMA)
+        countries, indicators = {}, {}
+        n_values = pending = 0
+        conn.execute('BEGIN;')
+        for chunk in _read_chunks(data_path, chunksize):
+            conn.executemany('INSERT INTO CountryIndicators VALUES (?, ?, ?, ?, ?, ?);',
+                             chunk.itertuples(index=False, name=None))
+            countries.update(zip(chunk['CountryCode'], chunk['CountryName']))
+            indicators.update(zip(chunk['IndicatorCode'], chunk['IndicatorName']))
+            n_values += len(chunk)
+            pending += len(chunk)
+            if pending >= transaction_rows:
+                conn.execute('COMMIT;')
+                conn.execute('BEGIN;')
+                pending = 0
+                logging.info(f'{n_values} values loaded, '
+                             f'{n_values / (time.perf_counter() - start):.0f} values/s')
+        conn.execute('COMMIT;')
+        load_seconds = time.perf_counter() - start
+
+        if countries_path is not None:
+            country_rows = _read_table(countries_path, COUNTRY_COLUMNS).itertuples(
+                index=False, name=None)
+        else:
+            country_rows = [(code, name, name, None, None) for code, name in countries.items()]
+        if series_path is not None:
+            indicator_rows = _read_table(series_path, SERIES_COLUMNS)[
+                ['IndicatorName', 'IndicatorCode']].itertuples(index=False, name=None)
+        else:
+            indicator_rows = [(name, code) for code, name in indicators.items()]
+        conn.execute('BEGIN;')
+        conn.executemany('INSERT INTO Countries VALUES (?, ?, ?, ?, ?);', country_rows)
+        conn.executemany('INSERT INTO Indicators VALUES (?, ?);', indicator_rows)
+        conn.execute('COMMIT;')
+
+        logging.info('Building the indexes')
+        query.ensure_indexes(conn)
+        # Uses the index just built to find the later value of each key
+        duplicates = conn.execute('''
+            DELETE FROM CountryIndicators WHERE EXISTS (
+                SELECT 1 FROM CountryIndicators AS later
+                WHERE later.IndicatorCode = CountryIndicators.IndicatorCode
+                  AND later.CountryCode = CountryIndicators.CountryCode
+                  AND later.Year = CountryIndicators.Year
+                  AND later.rowid > CountryIndicators.rowid);''').rowcount
+        if duplicates:
+            logging.warning(f'{duplicates} repeated (CountryCode, IndicatorCode, Year) '
+                            'values removed, the last one of each was kept')
+        conn.execute('ANALYZE;')
+        kept_results = 0
+        if os.path.isfile(database_path):
+            kept_results = _keep_results(conn, database_path, results_path)
+    finally:
+        conn.close()
+    if os.path.isfile(database_path):
+        _close_journal(database_path)
+    os.replace(tmp_fname, database_path)
+
+    seconds = time.perf_counter() - start
+    summary = {
+        'values': n_values - duplicates,
+        'duplicates': duplicates,
+        'countries': len(countries),
+        'indicators': len(indicators),
+        'predictions_kept': kept_results,
+        'file_mb': size_mb,
+        'load_s': load_seconds,
+        'seconds': seconds,
+        'values_per_s': n_values / load_seconds if load_seconds else 0.,
+        'mb_per_s': size_mb / load_seconds if load_seconds else 0.,
+    }
+    instrumentation.current().set(rows=n_values, values_per_s=round(summary['values_per_s']))
+    logging.info(f'Database {database_path} built: {summary}')
+    return summary
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from io import StringIO
+
+from utils import config
+
+LOG_FORMAT = "%(asctime)s - [%(levelname)s] - %(message)s"
+
+# Structured events, one JSON object per line (see setup_logging)
+events = logging.getLogger('gdp_growth.events')
+events.addHandler(logging.NullHandler())
+events.propagate = False
+
+_local = threading.local()
+_profiling = {'enabled': False, 'stages': []}
+
+
+def setup_logging(name='cli', log_path=None, level=logging.INFO):
+    """Logs to LOGS_PATH/<name>_<date>.log and writes the events of the
+    spans to LOGS_PATH/<name>_<date>.events.jsonl.
+    Called once by the entry point, the modules of utils never configure
+    logging themselves.
+
+    Parameters
+    ----------
+    name: Prefix of the files.
+    log_path: Directory of the files. Per default: config.LOGS_PATH.
+    level: Level of the log.
+
+    Returns
+    -------
+    log_fname
+        File of the log."""
+    log_path = config.LOGS_PATH if log_path is None else log_path
+    os.makedirs(log_path, exist_ok=True)
+    stem = os.path.join(log_path, datetime.now().strftime(f'{name}_%Y-%m-%d_%H:%M:%S'))
+    logging.basicConfig(filename=stem + '.log', format=LOG_FORMAT, level=level)
+    handler = logging.FileHandler(stem + '.events.jsonl')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    events.addHandler(handler)
+    events.setLevel(logging.INFO)
+    return stem + '.log'
+
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+class Span:
+    """Stage of the pipeline being measured. The sizes it processes (rows,
+    columns, boosting rounds...) are recorded with set."""
+
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.path = name if parent is None else f'{parent.path}/{name}'
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.attrs = dict(attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """Innermost open span of the thread, a detached one if there is none,
+    so that library code can always call current().set(...)."""
+    stack = _stack()
+    return stack[-1] if stack else Span('detached', None, {})
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Measures the enclosed stage: wall time, CPU time of the process and
+    peak RSS. Spans are nested per thread, the event of each one is written
+    as JSON when it ends, with its path from the outermost span.
+    In profile mode (see enable_profiling), the stages directly under the
+    outermost span are also run under cProfile and tracemalloc.
+
+    Parameters
+    ----------
+    name: Name of the stage.
+    attrs: Sizes or parameters of the stage to record."""
+    stack = _stack()
+    current_span = Span(name, stack[-1] if stack else None, attrs)
+    stack.append(current_span)
+    profiler = None
+    if _profiling['enabled'] and current_span.depth == 1:
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    status = 'ok'
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield current_span
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+            allocations = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+            _profiling['stages'].append((wall, current_span.path, profiler, allocations))
+        stack.pop()
+        event = {
+            'event': 'span',
+            'name': current_span.name,
+            'path': current_span.path,
+            'depth': current_span.depth,
+            'status': status,
+            'wall_s': round(wall, 6),
+            'cpu_s': round(cpu, 6),
+            'max_rss_mb': round(_max_rss_mb(), 1),
+        }
+        event.update(current_span.attrs)
+        events.info(json.dumps(event, default=str))
+        logging.info(f'{current_span.path}: {wall:.3f}s wall, {cpu:.3f}s cpu, '
+                     f"{event['max_rss_mb']}MB max rss"
+                     + ''.join(f', {key} {value}' for key, value in current_span.attrs.items()))
+
+
+def traced(name):
+    """Decorator running the function within a span (see span)."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable_profiling():
+    """Profiles the stages directly under the outermost span with cProfile
+    and traces their memory allocations, see write_profile."""
+    tracemalloc.start()
+    _profiling['enabled'] = True
+    _profiling['stages'] = []
+
+
+def write_profile(log_path=None, n_lines=40):
+    """Writes the cProfile statistics (.prof, readable with pstats or
+    snakeviz) and a text report with the most expensive functions and the
+    largest memory allocations of the slowest profiled stage.
+
+    Parameters
+    ----------
+    log_path: Directory of the reports. Per default: config.LOGS_PATH.
+    n_lines: Number of functions and allocations in the text report.
+
+    Returns
+    -------
+    report_fname
+        File of the text report, None if no stage was profiled."""
+    if not _profiling['stages']:
+        return None
+    log_path = config.LOGS_PATH if log_path is None else log_path
+    os.makedirs(log_path, exist_ok=True)
+    wall, path, profiler, allocations = max(_profiling['stages'], key=lambda stage: stage[0])
+    stem = os.path.join(log_path, datetime.now().strftime('profile_%Y-%m-%d_%H:%M:%S_')
+                        + path.replace('/', '.'))
+    profiler.dump_stats(stem + '.prof')
+    text = StringIO()
+    text.write(f'Slowest stage: {path} ({wall:.3f}s)\n\n')
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(n_lines)
+    text.write('\nLargest memory allocations of the stage:\n')
+    for stat in allocations[:n_lines]:
+        text.write(f'{stat}\n')
+    with open(stem + '.txt', 'w') as f:
+        f.write(text.getvalue())
+    logging.info(f'Profile of the slowest stage {path} written to {stem}.txt')
+    return stem + '.txt'
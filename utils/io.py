@@ -1,4 +1,5 @@
 # Standard library imports
+import logging
 import sqlite3
 import pandas as pd
 import numpy as np
@@ -7,37 +8,105 @@ import os
 # Related third party imports
 
 # Local application/library specific imports
+from utils import config
 from utils import read_database as rd
+from utils import feature_selection
+from utils import feature_store
+from utils import instrumentation
+from utils import io_aux_train as training
+from utils.encoding import CountryEncoder
+
+def selection_file(PREDICTED_INDICATOR):
+    """ Selection artifact of the variable to predict (see
+    feature_selection.indicator_path), or the legacy selected_variables.txt
+    of config.PREDICTED_INDICATOR if there is no artifact. None if there is
+    neither of them.
+    :param PREDICTED_INDICATOR: Variable we want to predict.
+
+    """
+    file = feature_selection.indicator_path(config.SELECTION_PATH, PREDICTED_INDICATOR)
+    if os.path.isfile(file):
+        return file
+    if (PREDICTED_INDICATOR == config.PREDICTED_INDICATOR
+            and os.path.isfile('./utils/selected_variables.txt')):
+        return './utils/selected_variables.txt'
+    return None
+
 
 def retrieve_clean_dataset(database_path, exclude_list, PREDICTED_INDICATOR):
     """ Retrieves most relevant variables from trainning.
+    The variables of the selection artifact of PREDICTED_INDICATOR are used
+    (see selection_file). If there is none, the selection is run first.
     :param database_path: OS path to database.
     :exclude_list: List of excluded countries or regions.
 
     """
-    
-    if os.path.isfile('./utils/selected_variables.txt'):
-        X = rd.get_select_data(database_path, exclude_list, PREDICTED_INDICATOR, file='./utils/selected_variables.txt')
-    else:
-        # Get values from all countries but those in exclude_list
-        long = rd.get_data(database_path, exclude_list)
-        # Reshape and prepare Dataframe
-        df, groups = rd.prepare_data(long, PREDICTED_INDICATOR)
-        # Fit Linear Model and get residuals
-        df1 = df.copy()
-        df1 = rd.linear_model(df1, PREDICTED_INDICATOR, groups)
-        # Reject Indicators whose NaN values exceed threshold
-        df_fewNA = rd.clean_data(df1)
-        # Select the top TOP values that better explain GDP Growth
-        selected_variables = rd.select_data(df_fewNA, 50)
-        # Convert countries to numeric values and extract the desired columns from dataframe
-        #return selected_variables
-        #io.retrieve_clean_dataset(config.DATABASE_PATH, config.exclude_list, config.PREDICTED_INDICATOR)
-        X = rd.get_select_data(database_path, exclude_list, PREDICTED_INDICATOR, file='./utils/selected_variables.txt')
+    file = selection_file(PREDICTED_INDICATOR)
+    if file is None:
+        select_variables(database_path, exclude_list, PREDICTED_INDICATOR)
+        file = selection_file(PREDICTED_INDICATOR)
+    X = rd.get_select_data(database_path, exclude_list, PREDICTED_INDICATOR, file=file)
     return X
     
+
+@instrumentation.traced('select_variables')
+def select_variables(database_path, exclude_list, PREDICTED_INDICATOR, workers=None):
+    """ Selects the most relevant variables and writes a new version of the
+    selection artifact. Only the variables whose data changed since the
+    last selection are scored again (see feature_selection.score_columns).
+    :param database_path: OS path to database.
+    :exclude_list: List of excluded countries or regions.
+    :workers: Number of processes scoring the variables.
+
+    """
+    # Wide panel of all countries but those in exclude_list
+    panel = feature_store.load(database_path, exclude_list)
+    # Prepare Dataframe and fit Linear Model to get residuals
+    encoder = CountryEncoder.from_database(database_path)
+    df1, groups = rd.panel_data(panel, PREDICTED_INDICATOR, encoder)
+    # Reject Indicators whose NaN values exceed threshold
+    df_fewNA = rd.clean_data(df1)
+    # Select the top TOP values that better explain GDP Growth
+    selected_variables = rd.select_data(df_fewNA, 50, workers=workers,
+                                        PREDICTED_INDICATOR=PREDICTED_INDICATOR)
+    return selected_variables
+    
     
     
+@instrumentation.traced('training_data')
+def retrieve_training_data(database_path, exclude_list, PREDICTED_INDICATOR, encoder=None):
+    """ Covariable-cleaned dataset, the training data derived from it and
+    the country encoder of the groups.
+    :param database_path: OS path to database.
+    :exclude_list: List of excluded countries or regions.
+    :encoder: Country encoder. Per default, the one of the database.
+
+    """
+    logging.info("Determining relevant covariables")
+    X = retrieve_clean_dataset(database_path=database_path, exclude_list=exclude_list,
+                               PREDICTED_INDICATOR=PREDICTED_INDICATOR)
+    X.columns = X.columns.str.replace(".","_")
+    X = X.reset_index(drop=True)
+    pred_ind = PREDICTED_INDICATOR.replace(".","_")
+    if encoder is None:
+        encoder = CountryEncoder.from_database(database_path)
+    (X_train, y_train, groups_train) = training.retrieve_training_dataset(X,
+    predicted_indicator=pred_ind, encoder=encoder)
+    instrumentation.current().set(rows=X_train.shape[0], columns=X_train.shape[1])
+    return X, X_train, y_train, groups_train, encoder
+
+
+def prediction_dataset(X):
+    """ Covariable-cleaned dataset indexed by year, as expected by
+    forecasting.forecast.
+    :param X: Covariable-cleaned dataset (see retrieve_training_data).
+
+    """
+    X = X.set_index("Time")
+    X["Time"] = X.index.get_level_values(0)
+    return X
+
+
 def retrieve_predict_dataset():   
     print("Not finished yet")
     pass
@@ -1,16 +1,10 @@
 #!/usr/bin/env python
 
 import logging
-import os
 
 from utils import io_aux_train as training
 from utils import config
-
-log_dir = os.path.join(os.path.normpath(os.getcwd() + os.sep),
-                       'logs')
-log_fname = os.path.join(log_dir, 'io.log')
-logging.basicConfig(filename=log_fname, level=logging.INFO,
-                    format='%(asctime)s - [%(levelname)s] - %(message)s')
+from utils import features
 
 def reduce_dataset(X, year):
     """Reduces the dataset X.
@@ -37,7 +31,7 @@ def reduce_dataset(X, year):
     red_X = X.drop(drop_list, axis=0)
     return red_X
 
-def expand_dataset(X, bst, groups, year):
+def expand_dataset(X, bst, groups, year, history=None):
     """Expands the input data for the model.
     Approximates/predicts the data of the year = (year_of_prediction - 1),
     in case year_of_prediction > config.DB_YEAR_MAX + 2.
@@ -48,6 +42,9 @@ def expand_dataset(X, bst, groups, year):
     bst: Trained Booster model.
     groups: group indices.
     year: year to predict.
+    history: Indicators with features of the last years of each row (see
+    features.history). With it, the lags and rolling features of the
+    response and of the covariates are moved forward too (see features.advance).
 
     Note that if, for example, we want to predict the GPD growth of 2012,
     but we only have available data until 2010 from the database, we would
@@ -61,12 +58,19 @@ def expand_dataset(X, bst, groups, year):
     Returns
     -------
     X
-     predicted data"""
+     predicted data
+    history
+     history of the next year, None without history"""
     y_pred = predict(X, bst, groups)
-    X[config.PREDICTED_INDICATOR.replace(".","_")] = y_pred
-    return X
-
-def retrieve_test_data(X, bst, year):
+    if history is None:
+        X[config.PREDICTED_INDICATOR.replace(".","_")] = y_pred
+        return X, None
+    values = X.to_numpy(dtype="float64")
+    history = features.advance(values, X.columns, history, y_pred)
+    X[X.columns] = values
+    return X, history
+
+def retrieve_test_data(X, bst, year, encoder=None):
     """Retrieve test data. If the year of prediction is greater than
     the database maximum, then it predicts/expands the input data
     for the model for the actual prediction.
@@ -75,6 +79,8 @@ def retrieve_test_data(X, bst, year):
     X: covariable-cleaned database
     bst: Trained Booster model.
     year: year of prediction
+    encoder: encoding.CountryEncoder used for the training data
+    (see io_aux_train.handle_country_groups)
 
     Returns
     -------
@@ -89,15 +95,19 @@ def retrieve_test_data(X, bst, year):
     elif year > 2011:
         first_expand_year = config.DB_YEAR_MAX + 1
         X_test = reduce_dataset(X, config.DB_YEAR_MAX + 1)
-        X_test, group_test = training.handle_country_groups(X_test)
+        feature_specs = features.specs()
+        history = features.history(X["Country"], X.index,
+                                   features.indicator_columns(X, feature_specs),
+                                   config.DB_YEAR_MAX, features.depth(feature_specs))
+        X_test, group_test = training.handle_country_groups(X_test, encoder)
         first_expand_year = config.DB_YEAR_MAX + 1
         expand_list = [first_expand_year + i
                        for i in range(year - first_expand_year)]
         for year in expand_list:
-            X_test = expand_dataset(X_test, bst, group_test, year)
+            X_test, history = expand_dataset(X_test, bst, group_test, year, history)
     else:
         X_test = reduce_dataset(X, year)
-        X_test, group_test = training.handle_country_groups(X_test)
+        X_test, group_test = training.handle_country_groups(X_test, encoder)
     return X_test, group_test
 
 def predict(X_test, bst, group_test):
@@ -1,19 +1,17 @@
 #!/usr/bin/env python
 
-import gpboost as gpb
 import numpy as np
 import pandas as pd
 import logging
+import json
 import os
 from utils import config
+from utils import feature_selection
+from utils import fingerprint
+from utils import instrumentation
+from utils.encoding import CountryEncoder
 
-log_dir = os.path.join(os.path.normpath(os.getcwd() + os.sep),                       
-                       'logs')
-log_fname = os.path.join(log_dir, 'io.log')
-logging.basicConfig(filename=log_fname, level=logging.INFO,
-                    format='%(asctime)s - [%(levelname)s] - %(message)s')
-
-def handle_country_groups(X):
+def handle_country_groups(X, encoder=None):
     """Generates a group index list with all the countries.
     This indices will be used by the model to know which entries of
     the database belong to the same group, in this case, which entries
@@ -23,6 +21,9 @@ def handle_country_groups(X):
     Parameters
     ----------
     X: Database
+    encoder: encoding.CountryEncoder mapping countries to group indices.
+    The same encoder must be used for the train and the test data.
+    Per default, an encoder of the countries of X.
 
     Returns
     -------
@@ -31,22 +32,48 @@ def handle_country_groups(X):
     groups
         List with the indices of each group
         """
-    groups = X[["Country"]].replace(pd.unique(X.Country),
-                                    list(range(0, len(pd.unique(X.Country)))))
-    groups = np.concatenate(groups.to_numpy())
-    #X_wo_countries = X.drop("Country", axis=1)
+    if encoder is None:
+        encoder = CountryEncoder(X["Country"])
+    groups = encoder.transform(X["Country"])
     X_wo_countries = X.drop("Country", axis=1)
     return X_wo_countries, groups
 
-def prepare_training_dataset(X, y):
-    """Deletes all rows that have the highest year index in X (here, 2010).
-    Delete all rows that have the lowest index in y (here, 1960).
-    This is done to prepare the model for predicting y_{t+1}.
+def next_year_labels(country, year, response):
+    """Response of the next year of the same country, for every row.
+    The rows are paired by their Country and Year values, whatever their
+    order, so a country with a missing year has no label before the gap.
+    Parameters
+    ----------
+    country: Country of each row
+    year: Year of each row
+    response: Response variable of each row
+
+    Returns
+    -------
+    label
+        float64 array with one value per row, NaN for the last year of a
+        country and for the rows whose next year has no response"""
+    country = np.asarray(country)
+    year = np.asarray(year, dtype=np.int64)
+    response = np.ravel(np.asarray(response, dtype=np.float64))
+    rows = pd.MultiIndex.from_arrays([country, year])
+    following = rows.get_indexer(pd.MultiIndex.from_arrays([country, year + 1]))
+    label = np.full(len(year), np.nan)
+    label[following >= 0] = response[following[following >= 0]]
+    return label
+
+def prepare_training_dataset(X, y, encoder=None):
+    """Pairs the row of every country and year with the response of the
+    next year of that country (see next_year_labels), to prepare the model
+    for predicting y_{t+1}. The last year of every country, and the rows
+    whose next year has no response, are dropped, so X_train and y_train
+    have the same rows.
     The country groups are handled here, too (see train.handle_country_groups).
     Parameters
     ----------
-    X: Database data
-    y: Response data
+    X: Database data, with the columns Country and Time
+    y: Response data, with the rows of X
+    encoder: encoding.CountryEncoder (see train.handle_country_groups)
 
     Returns
     -------
@@ -56,23 +83,106 @@ def prepare_training_dataset(X, y):
         Response train data
     groups_train
         Group indices"""
-    X = X.drop(config.DB_YEAR_MAX, axis=0)
-    y_train = y.drop(config.DB_YEAR_MIN, axis=0)
-    #X = X.drop(index = config.DB_YEAR_MIN - 1 , level=1)
-    #X = X.drop(index = config.DB_YEAR_MAX, level=1)
-    #y_train = y.drop(index = config.DB_YEAR_MIN, level=1)
-    #X = X[X.Time != config.DB_YEAR_MAX]
-    #y = y[y.Time != config.DB_YEAR_MIN]
-    X_train, groups_train = handle_country_groups(X)
+    label = next_year_labels(X['Country'], X['Time'], y)
+    keep = ~np.isnan(label)
+    X_train, groups_train = handle_country_groups(X[keep], encoder)
+    y_train = pd.DataFrame(label[keep], index=X_train.index, columns=list(y.columns))
     return X_train, y_train, groups_train
 
-def retrieve_training_dataset(X, predicted_indicator):
+def training_matrix(X):
+    """Contiguous float32 matrix of the train data, which gpboost reads
+    without converting or copying it.
+    Parameters
+    ----------
+    X: Train data (dataframe or array)
+
+    Returns
+    -------
+    matrix
+        C-contiguous float32 array"""
+    if isinstance(X, pd.DataFrame):
+        X = X.to_numpy(dtype=np.float32)
+    return np.ascontiguousarray(X, dtype=np.float32)
+
+def _evict_datasets(path, keep):
+    """Removes the least recently used binary datasets but keep of them.
+    Other processes may remove or replace them meanwhile."""
+    files = []
+    for name in os.listdir(path):
+        if not name.endswith('.bin'):
+            continue
+        try:
+            files.append((os.stat(os.path.join(path, name)).st_mtime_ns, name))
+        except FileNotFoundError:
+            continue
+    files.sort(reverse=True)
+    for _, name in files[keep:]:
+        try:
+            os.remove(os.path.join(path, name))
+        except FileNotFoundError:
+            pass
+
+@instrumentation.traced('dataset')
+def build_dataset(X_train, y_train, params=None, cache=True, feature_name=None):
+    """Constructed gpboost Dataset of the train data, to be shared by the
+    cross-validation and the training, so the features are binned once.
+    The binned Dataset is saved in binary form in
+    config.DATASET_CACHE_PATH, keyed by the fingerprint of the data and of
+    the parameters, and loaded from there by the following runs, which skip
+    the binning. The config.DATASET_CACHE_SIZE most recently used ones are
+    kept.
+    Parameters
+    ----------
+    X_train: Train data
+    y_train: Response train data
+    params: Parameters of the booster. Per default, the ones of
+    get_model_params.
+    cache: Whether to read and save the binary Dataset. False for the
+    training sets used once, such as the resamplings of an ensemble or the
+    origins of a backtest, which would only evict the others.
+    feature_name: Names of the columns. Per default, the columns of
+    X_train, which can also be the matrix of training_matrix, used without
+    copying it.
+
+    Returns
+    -------
+    data_train
+        Constructed gpboost.Dataset"""
+    import gpboost as gpb
+    params = get_model_params()[0] if params is None else params
+    data = training_matrix(X_train)
+    label = np.ascontiguousarray(np.ravel(y_train), dtype=np.float32)
+    if feature_name is None:
+        feature_name = list(X_train.columns) if hasattr(X_train, 'columns') else 'auto'
+    key = fingerprint.hash_values(data, label, feature_name, params)
+    fname = os.path.join(config.DATASET_CACHE_PATH, key + '.bin')
+    if cache and os.path.isfile(fname):
+        os.utime(fname)
+        instrumentation.current().set(rows=data.shape[0], cached=True)
+        data_train = gpb.Dataset(fname, params=params, silent=True).construct()
+        # The raw data is kept, gpboost predicts on it with the random effects
+        data_train.data = data
+        return data_train
+    data_train = gpb.Dataset(data, label, feature_name=feature_name, params=params,
+                             silent=True).construct()
+    if cache and config.DATASET_CACHE_SIZE > 0:
+        os.makedirs(config.DATASET_CACHE_PATH, exist_ok=True)
+        tmp_fname = f'{fname}.{os.getpid()}.tmp'
+        data_train.save_binary(tmp_fname)
+        os.replace(tmp_fname, fname)
+        _evict_datasets(config.DATASET_CACHE_PATH, config.DATASET_CACHE_SIZE)
+    instrumentation.current().set(rows=data.shape[0], cached=False)
+    return data_train
+
+def retrieve_training_dataset(X, predicted_indicator, encoder=None):
     """
     Transforms the raw dataset into a dataset that is suitable
     for training the model.
     Parameters
     ----------
     X: Covariable-cleaned database
+    predicted_indicator: Column of the response variable
+    encoder: encoding.CountryEncoder (see train.handle_country_groups)
 
     Returns
     -------
@@ -80,19 +190,64 @@ def retrieve_training_dataset(X, predicted_indicator):
         Train data
     y_train
         Response train data
-    data_train
-        Train data readable for the package gpbooster, contains the information
-        about X_train and y_train
     groups_train
         Group indices
         """
     logging.info('Retrieving training dataset')
     y = X[[predicted_indicator]]
-    X_train, y_train, groups_train = prepare_training_dataset(X, y)
-    data_train = gpb.Dataset(X_train, y_train)
-    return X_train, y_train, data_train, groups_train
+    # The gpboost Dataset is only built by the training (see build_dataset)
+    return prepare_training_dataset(X, y, encoder)
+
+def best_params_path(predicted_indicator=None):
+    """File of the best configuration of the tuning of predicted_indicator:
+    config.BEST_PARAMS_PATH for config.PREDICTED_INDICATOR, suffixed with
+    the indicator otherwise (see feature_selection.indicator_path)."""
+    return feature_selection.indicator_path(config.BEST_PARAMS_PATH, predicted_indicator)
+
+def get_model_params(predicted_indicator=None):
+    """Parameters of the booster and of the covariance optimizer of the
+    GPModel. The best configuration found by tuning.tune for
+    predicted_indicator is used if there is one (see best_params_path),
+    otherwise the defaults of config.
+    Parameters
+    ----------
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    params
+        Parameters of the booster
+    gp_optim_params
+        Parameters of the covariance optimizer of the GPModel"""
+    path = best_params_path(predicted_indicator)
+    if os.path.isfile(path):
+        with open(path) as f:
+            best = json.load(f)
+        return best['params'], best['gp_optim_params']
+    return dict(config.BOOSTER_PARAMS), dict(config.GP_OPTIM_PARAMS)
+
+def tuned_rounds(predicted_indicator=None):
+    """Number of boosting rounds found by tuning.tune for
+    predicted_indicator, with which the model is trained without
+    cross-validation (see models.GDPGrowthPredictor.train).
+    Parameters
+    ----------
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    num_boost_round
+        Number of boosting rounds, None without tuned configuration or if
+        it was stored without them"""
+    path = best_params_path(predicted_indicator)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        num_boost_round = json.load(f).get('num_boost_round')
+    return None if num_boost_round is None else int(num_boost_round)
 
-def get_booster_model(data_train, groups_train):
+@instrumentation.traced('cv')
+def get_booster_model(data_train, groups_train, predicted_indicator=None):
     """Gets model and define its parameters. For finding the optimal number
     of iterations, cross-validation is applied.
 
@@ -101,6 +256,8 @@ def get_booster_model(data_train, groups_train):
     data_train: Train data readable for the package gpbooster,
     should contain the information about X_train and y_train
     groups_train: Group indices
+    predicted_indicator: Variable predicted, whose parameters are used
+    (see get_model_params).
 
     Returns
     -------
@@ -112,23 +269,22 @@ def get_booster_model(data_train, groups_train):
         Optimal number of boosting rounds for the training, found with cross-
         validation
         """
+    import gpboost as gpb
     logging.info('Getting booster model')
+    params, gp_optim_params = get_model_params(predicted_indicator)
     gp_model = gpb.GPModel(group_data=groups_train)
-    gp_model.set_optim_params(params={"optimizer_cov": "fisher_scoring"})
-    params = {
-        'objective': 'regression_l2',
-        'learning_rate': 0.05,
-        'max_depth': 6,
-        'min_data_in_leaf': 5,
-        'verbose': 0
-    }
+    gp_model.set_optim_params(params=gp_optim_params)
     logging.info('Calculating optimal number of boost rounds \
         via cross-validation')
     cvbst = gpb.cv(params=params, train_set=data_train,
                    gp_model=gp_model, use_gp_model_for_validation=True,
-                   num_boost_round=300, early_stopping_rounds=5,
-                   nfold=3, verbose_eval=False, show_stdv=False, seed=1)
+                   num_boost_round=config.CV_PARAMS['num_boost_round'],
+                   early_stopping_rounds=config.CV_PARAMS['early_stopping_rounds'],
+                   nfold=config.CV_PARAMS['nfold'], verbose_eval=False,
+                   show_stdv=False, seed=config.CV_PARAMS['seed'])
     opt_num_boost_rounds = np.argmin(cvbst['l2-mean'])
+    instrumentation.current().set(rows=len(groups_train),
+                                  rounds=int(opt_num_boost_rounds))
     return gp_model, params, opt_num_boost_rounds
 
 def train(X):
@@ -157,8 +313,11 @@ def train(X):
         Optimal number of boosting rounds for the training, found with cross-
         validation
     """
+    import gpboost as gpb
     logging.info('Starting the train')
-    X_train, y_train, data_train, groups_train = retrieve_training_dataset(X)
+    X_train, y_train, groups_train = retrieve_training_dataset(
+        X, config.PREDICTED_INDICATOR.replace(".", "_"))
+    data_train = build_dataset(X_train, y_train)
     gp_model, params, opt_num_boost_rounds = get_booster_model(data_train,
                                                                groups_train)
     bst = gpb.train(params=params, train_set=data_train,
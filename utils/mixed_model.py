@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import logging
+
+import numpy as np
+
+from utils import config
+
+# Search interval of log(sigma2_group / sigma2_residual)
+_LOG_RATIO_BOUNDS = (-20.0, 10.0)
+
+
+def _group_sums(y, x, groups):
+    """Per group number of rows and sums of x, y, x*x, x*y and y*y."""
+    _, codes = np.unique(groups, return_inverse=True)
+    codes = codes.ravel()
+    sums = [np.bincount(codes, weights=w)
+            for w in (np.ones_like(y), x, y, x * x, x * y, y * y)]
+    return codes, sums
+
+
+def _gls(ratio, sums):
+    """GLS estimate of (intercept, slope) for the variance ratio
+    sigma2_group / sigma2_residual, with the quantities of the REML
+    criterion, all computed from the group sums."""
+    n, sx, sy, sxx, sxy, syy = sums
+    w = ratio / (1.0 + n * ratio)
+    a = np.array([[np.sum(n - w * n * n), np.sum(sx - w * n * sx)],
+                  [np.sum(sx - w * n * sx), np.sum(sxx - w * sx * sx)]])
+    b = np.array([np.sum(sy - w * n * sy), np.sum(sxy - w * sx * sy)])
+    beta = np.linalg.solve(a, b)
+    rss = np.sum(syy - w * sy * sy) - b @ beta
+    return beta, rss, a, w
+
+
+def _reml_criterion(log_ratio, sums, n_obs):
+    """-2 * profiled REML log-likelihood, up to a constant."""
+    ratio = np.exp(log_ratio)
+    beta, rss, a, w = _gls(ratio, sums)
+    p = len(beta)
+    return ((n_obs - p) * np.log(rss / (n_obs - p))
+            + np.sum(np.log1p(sums[0] * ratio))
+            + np.linalg.slogdet(a)[1])
+
+
+def fit_random_intercept(y, x, groups):
+    """REML fit of y ~ 1 + x with a random intercept per group.
+    Same model as statsmodels' mixedlm("y ~ x", groups=groups), but the
+    likelihood only depends on six sums per group, so it is profiled and
+    optimized over a single variance ratio with vectorized NumPy, with no
+    iteration over the rows.
+
+    Parameters
+    ----------
+    y: Response vector.
+    x: Covariable vector.
+    groups: Group of each row.
+
+    Returns
+    -------
+    fit
+        Dictionary with the fixed effects 'beta' (intercept, slope), the
+        variances 'sigma2_residual' and 'sigma2_group', the predicted
+        'random_effects' of each row and the conditional 'residuals'
+        (response minus fixed and random effects)."""
+    from scipy.optimize import minimize_scalar
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    codes, sums = _group_sums(y, x, groups)
+    n_obs = len(y)
+    opt = minimize_scalar(_reml_criterion, bounds=_LOG_RATIO_BOUNDS,
+                          args=(sums, n_obs), method='bounded',
+                          options={'xatol': 1e-10})
+    ratio = np.exp(opt.x)
+    # The variance of the groups can be 0
+    if _reml_criterion(_LOG_RATIO_BOUNDS[0], sums, n_obs) <= opt.fun:
+        ratio = 0.0
+    beta, rss, _, w = _gls(ratio, sums)
+    sigma2_residual = rss / (n_obs - len(beta))
+    fixed = beta[0] + beta[1] * x
+    # Best linear unbiased predictor of each group intercept
+    n, sx, sy = sums[:3]
+    random_effects = w * (sy - beta[0] * n - beta[1] * sx)
+    random_effects = random_effects[codes]
+    return {
+        'beta': beta,
+        'sigma2_residual': sigma2_residual,
+        'sigma2_group': ratio * sigma2_residual,
+        'random_effects': random_effects,
+        'residuals': y - fixed - random_effects,
+    }
+
+
+def statsmodels_residuals(df, predicted_indicator, groups):
+    """Residuals of the same model fitted by statsmodels (iterative REML)."""
+    import statsmodels.formula.api as smf
+    md = smf.mixedlm(f"{predicted_indicator} ~ lag1",
+                     df[[predicted_indicator, "lag1"]], groups=groups)
+    return np.asarray(md.fit().resid)
+
+
+def residuals(df, predicted_indicator, groups, backend=None):
+    """Residuals of predicted_indicator ~ lag1 with a random intercept per
+    country.
+
+    Parameters
+    ----------
+    df: Dataframe with the columns predicted_indicator and lag1.
+    predicted_indicator: Column of the response.
+    groups: Country group of each row.
+    backend: 'numpy' (closed-form profile, see fit_random_intercept),
+        'statsmodels', or 'verify' to fit both and raise an error if they
+        differ by more than config.RESIDUALS_TOLERANCE.
+        Per default: config.RESIDUALS_BACKEND.
+
+    Returns
+    -------
+    residuals
+        Array with the residual of each row."""
+    backend = config.RESIDUALS_BACKEND if backend is None else backend
+    if backend == 'statsmodels':
+        return statsmodels_residuals(df, predicted_indicator, groups)
+    fast = fit_random_intercept(df[predicted_indicator], df["lag1"],
+                                np.asarray(groups))['residuals']
+    if backend == 'verify':
+        reference = statsmodels_residuals(df, predicted_indicator, groups)
+        error = np.max(np.abs(fast - reference))
+        scale = np.max(np.abs(reference))
+        logging.info(f'Residuals of the closed-form fit differ by at most {error:.2e} '
+                     f'from statsmodels (max abs residual {scale:.2e})')
+        if error > config.RESIDUALS_TOLERANCE * max(scale, 1.0):
+            raise ValueError(f"Closed-form residuals differ from statsmodels by {error}")
+    elif backend != 'numpy':
+        raise ValueError(f"Unknown backend {backend}, use 'numpy', 'statsmodels' or 'verify'")
+    return fast
@@ -1,18 +1,467 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import features
+from utils import fingerprint
+from utils import instrumentation
+from utils import io_aux_train as training
+from utils.encoding import CountryEncoder
+
+BOOSTER_FNAME = 'booster.txt'
+META_FNAME = 'model.json'
+TRAIN_DATA_FNAME = 'train_data.npz'
+ENCODER_FNAME = 'countries.json'
+
+
+def model_path(key):
+    """OS path of the model stored under the fingerprint key."""
+    return os.path.join(config.MODELS_PATH, key)
+
 
 class GDPGrowthPredictor:
+    """Gradient tree boosting model with country random effects.
+
+    gpboost only writes the tree ensemble to disk, the random effects part
+    is lost. The predictor therefore keeps the covariance parameters of the
+    GPModel and the training data, which is all that is needed to recompute
+    the random effects after loading the booster from disk. The country
+    encoder of the training data is kept with the model, so the test data
+    is encoded with the same group ids. A stored model knows its
+    fingerprint, the name of its directory in the model store.
+    """
+
+    def __init__(self, params=None):
+        self.params = dict(config.BOOSTER_PARAMS if params is None else params)
+        self.bst = None
+        self.gp_model = None
+        self.num_boost_round = None
+        self.cov_pars = None
+        self.feature_names = None
+        self.X = None
+        self.y = None
+        self.groups = None
+        self.encoder = None
+        self.warm_started_from = None
+        self.predicted_indicator = None
+        self.fingerprint = None
+        self._random_effects = None
+
+    @instrumentation.traced('train')
+    def train(self, X, y, groups, encoder=None, num_boost_round=None,
+              predicted_indicator=None, cache=True, *args, **kwargs):
+        """Finds the optimal number of boosting rounds with cross-validation,
+        unless it is given or tuned, and trains the booster.
+
+        Parameters
+        ----------
+        X: Train data
+        y: Response train data
+        groups: Group indices
+        encoder: encoding.CountryEncoder that produced groups
+        num_boost_round: Number of boosting rounds. When given, the
+            cross-validation is skipped. Per default, the one found by
+            tuning.tune if any (see io_aux_train.tuned_rounds).
+        predicted_indicator: Variable predicted, whose tuned parameters are
+            used (see io_aux_train.get_model_params).
+            Per default: config.PREDICTED_INDICATOR.
+        cache: Whether to reuse and save the binned training data (see
+            io_aux_train.build_dataset), False for data trained on once."""
+        import gpboost as gpb
+        if predicted_indicator is None:
+            predicted_indicator = config.PREDICTED_INDICATOR
+        self.predicted_indicator = predicted_indicator
+        self.encoder = encoder
+        self.feature_names = list(X.columns)
+        # Converted once: the same matrix is binned and kept for the random effects
+        self.X = training.training_matrix(X)
+        self.y = np.ravel(np.asarray(y, dtype=np.float64))
+        self.groups = np.asarray(groups)
+        self.params, gp_optim_params = training.get_model_params(predicted_indicator)
+        if num_boost_round is None:
+            num_boost_round = training.tuned_rounds(predicted_indicator)
+        # Binned once, for the cross-validation and the training
+        data_train = training.build_dataset(self.X, y, self.params, cache,
+                                            self.feature_names)
+        if num_boost_round is None:
+            (self.gp_model, self.params,
+             self.num_boost_round) = training.get_booster_model(data_train,
+                                                                self.groups,
+                                                                predicted_indicator)
+        else:
+            self.gp_model = gpb.GPModel(group_data=self.groups)
+            self.gp_model.set_optim_params(params=gp_optim_params)
+            self.num_boost_round = num_boost_round
+        self.bst = gpb.train(params=self.params, train_set=data_train,
+                             gp_model=self.gp_model,
+                             num_boost_round=self.num_boost_round)
+        self.cov_pars = _flat_cov_pars(self.gp_model.get_cov_pars())
+        instrumentation.current().set(rows=len(self.y), columns=self.X.shape[1],
+                                      rounds=int(self.num_boost_round))
+        return self
 
-    def train(self, X, y, *args, **kwargs):
-        self.X = X
-        self.y = y
-        
-        pass
+    @instrumentation.traced('warm_start')
+    def update(self, X, y, groups, new_rows, num_boost_round):
+        """Continues boosting from the current booster instead of training
+        a new one. The added trees are fitted on the new rows only, to the
+        part of their response not explained by the current fixed and
+        random effects. The training data is then replaced by X and the
+        covariance parameters of the random effects are estimated again on
+        the residuals of the updated booster.
 
-    def predict(self, X, *args, **kwargs):
-        pass
+        Parameters
+        ----------
+        X: Train data, with the former and the new rows
+        y: Response train data
+        groups: Group indices
+        new_rows: Boolean mask of the new rows of X
+        num_boost_round: Number of boosting rounds to add"""
+        import gpboost as gpb
+        X = training.training_matrix(X)
+        y = np.ravel(np.asarray(y, dtype=np.float64))
+        groups = np.asarray(groups)
+        new_rows = np.asarray(new_rows, dtype=bool)
+        if num_boost_round > 0 and new_rows.any():
+            random_effect = self.predict(X[new_rows],
+                                         groups[new_rows])['random_effect_mean']
+            data_new = gpb.Dataset(X[new_rows], y[new_rows] - random_effect,
+                                   feature_name=self.feature_names,
+                                   free_raw_data=False)
+            self.bst = gpb.train(params=self.params, train_set=data_new,
+                                 num_boost_round=num_boost_round,
+                                 init_model=self.bst, verbose_eval=False)
+            self.num_boost_round += num_boost_round
+        self.X, self.y, self.groups = X, y, groups
+        gp_model = gpb.GPModel(group_data=groups)
+        gp_model.set_optim_params(
+            params=training.get_model_params(self.predicted_indicator)[1])
+        gp_model.fit(y=y - self.bst.predict(X))
+        self.cov_pars = _flat_cov_pars(gp_model.get_cov_pars())
+        self.gp_model = None
+        self._random_effects = None
+        instrumentation.current().set(rows=int(new_rows.sum()), rounds=int(num_boost_round))
+        return self
+
+    def predict(self, data, group_data_pred, *args, **kwargs):
+        """Same output as gpboost.Booster.predict with a GPModel, for both
+        a freshly trained and a loaded model.
+
+        Parameters
+        ----------
+        data: Input data for the model.
+        group_data_pred: Group indices of data.
+
+        Returns
+        -------
+        pred
+            Dictionary with the 'fixed_effect' and 'random_effect_mean'
+            vectors."""
+        if self.gp_model is not None:
+            return self.bst.predict(data=data, group_data_pred=group_data_pred)
+        fixed_effect = self.bst.predict(np.asarray(data, dtype=np.float64))
+        known, means = self._group_effects()
+        group_data_pred = np.ravel(np.asarray(group_data_pred))
+        position = np.clip(np.searchsorted(known, group_data_pred), 0, len(known) - 1)
+        # Groups without training data get the prior mean of the random effects
+        random_effect = np.where(known[position] == group_data_pred, means[position], 0.)
+        return {'fixed_effect': fixed_effect,
+                'random_effect_mean': random_effect}
+
+    def fixed_effect(self, data):
+        """Prediction of the tree ensemble alone, without the random
+        effects of the groups (see predict).
+
+        Parameters
+        ----------
+        data: Input data for the model."""
+        data = np.asarray(data, dtype=np.float64)
+        with warnings.catch_warnings():
+            # Without group data, a booster with a GPModel warns and only
+            # predicts the fixed effects
+            warnings.simplefilter('ignore')
+            return np.asarray(self.bst.predict(data), dtype=np.float64)
+
+    def _group_effects(self):
+        """Predicted random effect of every group of the training data.
+        They only depend on the model, so they are computed once and reused
+        by all the following predictions."""
+        import gpboost as gpb
+        if self._random_effects is None:
+            known = np.unique(self.groups)
+            residual = self.y - self.bst.predict(self.X)
+            gp_model = gpb.GPModel(group_data=self.groups)
+            means = gp_model.predict(y=residual, group_data_pred=known,
+                                     cov_pars=self.cov_pars)['mu']
+            self._random_effects = (known, np.asarray(means, dtype=np.float64))
+        return self._random_effects
 
     @staticmethod # Contains logic for the class, but it does not instantiate
     def load(filename):
-        pass
+        """Loads a predictor written by GDPGrowthPredictor.save.
+
+        Parameters
+        ----------
+        filename: Directory of the stored model.
+
+        Returns
+        -------
+        predictor
+            GDPGrowthPredictor ready to predict."""
+        import gpboost as gpb
+        with open(os.path.join(filename, META_FNAME)) as f:
+            meta = json.load(f)
+        predictor = GDPGrowthPredictor(meta['params'])
+        predictor.num_boost_round = meta['num_boost_round']
+        predictor.cov_pars = np.asarray(meta['cov_pars'], dtype=np.float64)
+        predictor.feature_names = meta['feature_names']
+        predictor.warm_started_from = meta.get('warm_started_from')
+        # The models stored before the indicator was saved all predict the default one
+        predictor.predicted_indicator = meta.get('indicator', config.PREDICTED_INDICATOR)
+        predictor.fingerprint = os.path.basename(os.path.normpath(filename))
+        predictor.bst = gpb.Booster(model_file=os.path.join(filename,
+                                                            BOOSTER_FNAME))
+        with np.load(os.path.join(filename, TRAIN_DATA_FNAME)) as train_data:
+            predictor.X = train_data['X']
+            predictor.y = train_data['y']
+            predictor.groups = train_data['groups']
+        encoder_fname = os.path.join(filename, ENCODER_FNAME)
+        if os.path.isfile(encoder_fname):
+            predictor.encoder = CountryEncoder.load(encoder_fname)
+        return predictor
 
     def save(self, filename):
-        pass
+        """Writes the booster, the covariance parameters of the random
+        effects and the training data into the directory filename.
+        The directory is written next to its final location and then
+        renamed, so readers never see a half-written model."""
+        parent = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+        try:
+            self.bst.save_model(os.path.join(tmp_dir, BOOSTER_FNAME))
+            np.savez(os.path.join(tmp_dir, TRAIN_DATA_FNAME),
+                     X=self.X, y=self.y, groups=self.groups)
+            if self.encoder is not None:
+                self.encoder.save(os.path.join(tmp_dir, ENCODER_FNAME))
+            meta = {
+                'params': self.params,
+                'num_boost_round': int(self.num_boost_round),
+                'cov_pars': self.cov_pars.tolist(),
+                'feature_names': self.feature_names,
+                'indicator': self.predicted_indicator,
+            }
+            if self.warm_started_from is not None:
+                meta['warm_started_from'] = self.warm_started_from
+            with open(os.path.join(tmp_dir, META_FNAME), 'w') as f:
+                json.dump(meta, f, indent=2)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            os.replace(tmp_dir, filename)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.fingerprint = os.path.basename(os.path.normpath(filename))
+
+
+def _flat_cov_pars(cov_pars):
+    """Covariance parameters without the standard deviations row."""
+    cov_pars = np.asarray(cov_pars, dtype=np.float64)
+    if cov_pars.ndim > 1:
+        cov_pars = cov_pars[0]
+    return cov_pars
+
+
+def training_fingerprint(database_path, X_train, y_train, groups_train,
+                         predicted_indicator=None):
+    """Fingerprint of the model of predicted_indicator trained on X_train
+    and y_train with the current configuration (see
+    fingerprint.model_fingerprint). Two indicators whose selections give
+    the same columns never share a model."""
+    if predicted_indicator is None:
+        predicted_indicator = config.PREDICTED_INDICATOR
+    booster_params, gp_optim_params = training.get_model_params(predicted_indicator)
+    params = {'booster': booster_params,
+              'gp_model': gp_optim_params,
+              'cv': config.CV_PARAMS,
+              'features': features.specs(predicted_indicator),
+              'indicator': predicted_indicator,
+              'response': fingerprint.hash_values(np.ravel(np.asarray(y_train)))}
+    rounds = training.tuned_rounds(predicted_indicator)
+    if rounds is not None:
+        params['rounds'] = rounds
+    return fingerprint.model_fingerprint(database_path, X_train.columns,
+                                         params, groups_train)
+
+
+@instrumentation.traced('model')
+def load_or_train(X_train, y_train, groups_train, database_path, encoder=None,
+                  predicted_indicator=None):
+    """Loads the model matching the inputs from the model store, or trains
+    and stores it if there is none.
+
+    Parameters
+    ----------
+    X_train: Train data
+    y_train: Response train data
+    groups_train: Group indices
+    database_path: Where database is stored.
+    encoder: encoding.CountryEncoder that produced groups_train
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    predictor
+        Trained GDPGrowthPredictor."""
+    key = training_fingerprint(database_path, X_train, y_train, groups_train,
+                               predicted_indicator)
+    path = model_path(key)
+    if os.path.isfile(os.path.join(path, META_FNAME)):
+        logging.info(f'Loading stored model {key}')
+        return GDPGrowthPredictor.load(path)
+    logging.info(f'No stored model {key}, training a new one')
+    predictor = GDPGrowthPredictor().train(X_train, y_train, groups_train,
+                                           encoder, predicted_indicator=predicted_indicator)
+    predictor.save(path)
+    return predictor
+
+
+def _indicator_of(meta_fname):
+    with open(meta_fname) as f:
+        return json.load(f).get('indicator', config.PREDICTED_INDICATOR)
+
+
+def latest_model_path(predicted_indicator=None):
+    """Directory of the most recently stored model of predicted_indicator
+    (per default: config.PREDICTED_INDICATOR), None if there is none."""
+    if predicted_indicator is None:
+        predicted_indicator = config.PREDICTED_INDICATOR
+    if not os.path.isdir(config.MODELS_PATH):
+        return None
+    metas = [os.path.join(config.MODELS_PATH, name, META_FNAME)
+             for name in os.listdir(config.MODELS_PATH)]
+    metas = [meta for meta in metas
+             if os.path.isfile(meta) and _indicator_of(meta) == predicted_indicator]
+    if not metas:
+        return None
+    return os.path.dirname(max(metas, key=os.path.getmtime))
+
+
+def _added_rounds(num_boost_round, new_rows):
+    """Boosting rounds added by a warm start, proportional to the share of
+    new rows in the training data, at least one if there is any."""
+    n_new = int(np.sum(new_rows))
+    rounds = math.ceil(num_boost_round * n_new / len(new_rows))
+    return max(rounds, 1) if n_new else rounds
+
+
+def _rmse(predictor, X, y, groups):
+    pred = predictor.predict(np.asarray(X, dtype=np.float64), groups)
+    y_pred = pred['fixed_effect'] + pred['random_effect_mean']
+    return float(np.sqrt(np.mean((np.ravel(np.asarray(y)) - y_pred) ** 2)))
+
+
+@instrumentation.traced('model')
+def update_or_train(X_train, y_train, groups_train, database_path, added,
+                    encoder=None, check=False, predicted_indicator=None):
+    """Brings the model up to date with new rows of the database.
+    The most recently stored model is warm-started with the new rows (see
+    GDPGrowthPredictor.update), adding a number of boosting rounds
+    proportional to the share of new rows in the training data. A full
+    training is done instead when there is no stored model to start from or
+    when the features or the countries changed.
+    The forecasts still start from config.DB_YEAR_MAX, which is set by
+    hand (2010): a year appended to the database is trained on, but it
+    does not become the origin of the forecasts until DB_YEAR_MAX is moved.
+
+    Parameters
+    ----------
+    X_train: Train data
+    y_train: Response train data
+    groups_train: Group indices
+    database_path: Where database is stored.
+    added: (CountryCode, Year) rows added to the database
+        (see feature_store.added_rows), None if unknown.
+    encoder: encoding.CountryEncoder that produced groups_train
+    check: Compare the warm start with a full training on the last year
+        of the new rows, held out from both: the stored model is
+        warm-started with the other new rows and a model is trained from
+        scratch, with as many boosting rounds, on the training data
+        without that year. If the error of the warm start on the held out
+        year is higher by more than config.UPDATE_TOLERANCE, a model is
+        trained from scratch on all the data instead of warm-starting.
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    predictor
+        Trained GDPGrowthPredictor, stored under the fingerprint of the
+        training data."""
+    key = training_fingerprint(database_path, X_train, y_train, groups_train,
+                               predicted_indicator)
+    path = model_path(key)
+    if os.path.isfile(os.path.join(path, META_FNAME)):
+        logging.info(f'Model {key} is up to date')
+        return GDPGrowthPredictor.load(path)
+    base = latest_model_path(predicted_indicator)
+    if added is None or base is None:
+        logging.info('No model or no new rows to start from')
+        return load_or_train(X_train, y_train, groups_train, database_path, encoder,
+                             predicted_indicator)
+    predictor = GDPGrowthPredictor.load(base)
+    if (predictor.feature_names != list(X_train.columns)
+            or (encoder is not None and predictor.encoder is not None
+                and predictor.encoder.countries != encoder.countries)):
+        logging.info('Features or countries changed, the model is trained again')
+        return load_or_train(X_train, y_train, groups_train, database_path, encoder,
+                             predicted_indicator)
+
+    if encoder is None:
+        encoder = predictor.encoder
+    groups_train = np.asarray(groups_train)
+    years = X_train['Time'].to_numpy()
+    added_groups = encoder.transform(added.get_level_values(0))
+    # A row is new if its year or the year of its label (see
+    # io_aux_train.prepare_training_dataset) was added
+    added_rows = pd.MultiIndex.from_arrays([added_groups, added.get_level_values(1)])
+    new_rows = (pd.MultiIndex.from_arrays([groups_train, years]).isin(added_rows)
+                | pd.MultiIndex.from_arrays([groups_train, years + 1]).isin(added_rows))
+    n_new = int(new_rows.sum())
+    y = np.ravel(np.asarray(y_train))
+
+    if check and n_new:
+        held_out = new_rows & (years == years[new_rows].max())
+        kept = ~held_out
+        warm = GDPGrowthPredictor.load(base)
+        warm.update(X_train[kept], y[kept], groups_train[kept], new_rows[kept],
+                    _added_rounds(warm.num_boost_round, new_rows[kept]))
+        full = GDPGrowthPredictor().train(X_train[kept], y[kept], groups_train[kept], encoder,
+                                          num_boost_round=warm.num_boost_round,
+                                          predicted_indicator=predicted_indicator, cache=False)
+        warm_error = _rmse(warm, X_train[held_out], y[held_out], groups_train[held_out])
+        full_error = _rmse(full, X_train[held_out], y[held_out], groups_train[held_out])
+        logging.info(f'RMSE on the held out year {years[held_out][0]}: warm start '
+                     f'{warm_error:.4f}, full training {full_error:.4f}')
+        if warm_error > full_error * (1 + config.UPDATE_TOLERANCE):
+            logging.warning('The warm start is worse than a full training, '
+                            'the model is trained again')
+            return load_or_train(X_train, y_train, groups_train, database_path, encoder,
+                                 predicted_indicator)
+
+    num_boost_round = _added_rounds(predictor.num_boost_round, new_rows)
+    logging.info(f'Warm-starting model {os.path.basename(base)} with {n_new} '
+                 f'new rows, {num_boost_round} boosting rounds')
+    predictor.update(X_train, y_train, groups_train, new_rows, num_boost_round)
+    predictor.encoder = encoder
+    predictor.warm_started_from = os.path.basename(base)
+    predictor.save(path)
+    return predictor
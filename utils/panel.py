@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+
+
+class MemoryBudgetError(MemoryError):
+    """A panel does not fit in the memory budget and spilling to disk is
+    disabled (see allocate)."""
+
+
+def _budget_bytes(budget):
+    budget = config.PANEL_MEMORY_BUDGET if budget is None else budget
+    return None if budget is None else int(budget * 2 ** 20)
+
+
+def allocate(shape, dtype=np.float32, budget=None, spill=None, reserved=0):
+    """Uninitialized column-major array, held in memory if it fits in the
+    memory budget. Otherwise it is memory-mapped to an anonymous temporary
+    file of config.PANEL_SPILL_PATH, or MemoryBudgetError is raised before
+    anything is allocated.
+
+    Parameters
+    ----------
+    shape: Shape of the array.
+    dtype: Data type of the array.
+    budget: Memory budget in MB, no limit if None.
+        Per default: config.PANEL_MEMORY_BUDGET.
+    spill: Whether an array over the budget is spilled to disk.
+        Per default: config.PANEL_SPILL.
+    reserved: Bytes of the budget already used by the caller.
+
+    Returns
+    -------
+    values
+        ndarray, or np.memmap if the array was spilled to disk."""
+    spill = config.PANEL_SPILL if spill is None else spill
+    limit = _budget_bytes(budget)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if limit is None or nbytes + reserved <= limit or nbytes == 0:
+        return np.empty(shape, dtype=dtype, order='F')
+    if not spill:
+        raise MemoryBudgetError(f'{(nbytes + reserved) / 2 ** 20:.1f}MB needed, over the '
+                                f'memory budget of {limit / 2 ** 20:.1f}MB')
+    logging.info(f'Spilling an array of {nbytes / 2 ** 20:.1f}MB to {config.PANEL_SPILL_PATH}')
+    os.makedirs(config.PANEL_SPILL_PATH, exist_ok=True)
+    # The file has no name and is removed with the last reference to the map
+    with tempfile.TemporaryFile(dir=config.PANEL_SPILL_PATH) as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape, order='F')
+
+
+class Panel:
+    """(CountryCode, Year) x indicator panel, in a compact layout.
+
+    The rows are identified by integer codes: the position of their country
+    in countries and their year. The indicators are float32. Those present
+    in enough rows are the columns of one column-major block (in memory or
+    memory-mapped, see allocate), so that every indicator is a contiguous
+    view. Those missing in more than config.PANEL_SPARSE_THRESHOLD of the
+    rows are stored sparse, as the positions and the values of their
+    non-missing rows.
+    """
+
+    def __init__(self, countries, country, year, columns, dense, dense_position,
+                 sparse=None):
+        self.countries = np.asarray(countries, dtype=object)
+        self.country = np.asarray(country, dtype=np.int32)
+        self.year = np.asarray(year, dtype=np.int16)
+        self.columns = list(columns)
+        self.dense = dense
+        self.dense_position = dense_position
+        self.sparse = {} if sparse is None else sparse
+
+    @classmethod
+    def from_arrays(cls, values, countries, years, names, columns=None,
+                    sparse_threshold=None, budget=None, spill=None):
+        """Panel of a wide array, such as the output of query.read_wide or
+        the values of a stored panel. The array is read column by column, a
+        memory-mapped array is never loaded as a whole.
+        When the panel does not fit in the memory budget, a memory-mapped
+        float32 array is used as it is instead of being copied.
+
+        Parameters
+        ----------
+        values: Array with one row per (CountryCode, Year) and one column
+            per indicator, NaN where there is no value.
+        countries: CountryCode of each row, the rows are sorted by country.
+        years: Year of each row.
+        names: IndicatorCode of each column of values.
+        columns: Indicators to keep, all of them if None. Indicators that
+            are not in names are ignored.
+        sparse_threshold: Share of missing rows over which an indicator is
+            stored sparse. Per default: config.PANEL_SPARSE_THRESHOLD.
+        budget: Memory budget in MB (see allocate).
+        spill: Whether a panel over the budget is spilled to disk (see allocate).
+
+        Returns
+        -------
+        panel
+            Panel with the kept indicators, in the order of names."""
+        sparse_threshold = (config.PANEL_SPARSE_THRESHOLD if sparse_threshold is None
+                            else sparse_threshold)
+        spill = config.PANEL_SPILL if spill is None else spill
+        names = list(names)
+        if columns is None:
+            positions = np.arange(len(names))
+        else:
+            wanted = set(columns)
+            positions = np.array([i for i, name in enumerate(names) if name in wanted],
+                                 dtype=np.intp)
+        kept = [names[i] for i in positions]
+        codes, countries = pd.factorize(np.asarray(countries, dtype=object))
+        n_rows = values.shape[0]
+        counts = np.array([np.count_nonzero(~np.isnan(values[:, i])) for i in positions],
+                          dtype=np.int64)
+        is_sparse = counts < (1 - sparse_threshold) * n_rows
+        # Positions (int32) and values (float32) of the sparse indicators
+        sparse_bytes = int(counts[is_sparse].sum()) * 8
+        dense_bytes = n_rows * int((~is_sparse).sum()) * 4
+        limit = _budget_bytes(budget)
+        if (limit is not None and sparse_bytes + dense_bytes > limit and spill
+                and isinstance(values, np.memmap) and values.dtype == np.float32):
+            # The file of the array is the spill file: nothing is copied
+            logging.info(f'Panel of {len(kept)} indicators over the memory budget, '
+                         'read from disk')
+            return cls(countries, codes, years, kept, values,
+                       {name: int(i) for name, i in zip(kept, positions)})
+
+        dense_columns = [name for name, flag in zip(kept, is_sparse) if not flag]
+        dense = allocate((n_rows, len(dense_columns)), np.float32, budget, spill,
+                         reserved=sparse_bytes)
+        sparse = {}
+        j = 0
+        for name, i, flag in zip(kept, positions, is_sparse):
+            column = values[:, i]
+            if flag:
+                rows = np.flatnonzero(~np.isnan(column)).astype(np.int32)
+                sparse[name] = (rows, np.asarray(column[rows], dtype=np.float32))
+            else:
+                dense[:, j] = column
+                j += 1
+        panel = cls(countries, codes, years, kept, dense,
+                    {name: j for j, name in enumerate(dense_columns)}, sparse)
+        logging.info(f'Panel of {n_rows} rows and {len(kept)} indicators '
+                     f'({len(sparse)} sparse): {panel.nbytes / 2 ** 20:.1f}MB')
+        return panel
+
+    @property
+    def n_rows(self):
+        return len(self.country)
+
+    @property
+    def nbytes(self):
+        """Bytes held in memory by the values, 0 for a memory-mapped block."""
+        dense = 0 if isinstance(self.dense, np.memmap) else self.dense.nbytes
+        return dense + sum(rows.nbytes + values.nbytes
+                           for rows, values in self.sparse.values())
+
+    def index(self, rows=None):
+        """(CountryCode, Year) MultiIndex of the rows, built from the
+        integer codes.
+
+        Parameters
+        ----------
+        rows: Positions of the rows, all of them if None."""
+        country = self.country if rows is None else self.country[rows]
+        year = self.year if rows is None else self.year[rows]
+        years, year_codes = np.unique(year, return_inverse=True)
+        return pd.MultiIndex(levels=[self.countries, years.astype(np.int64)],
+                             codes=[country, year_codes.ravel()],
+                             names=['CountryCode', 'Year'], verify_integrity=False)
+
+    def column(self, name, rows=None):
+        """Values of an indicator, a view of the block for a dense one.
+
+        Parameters
+        ----------
+        name: IndicatorCode.
+        rows: Positions of the rows, all of them if None."""
+        if name in self.sparse:
+            positions, values = self.sparse[name]
+            column = np.full(self.n_rows, np.nan, dtype=np.float32)
+            column[positions] = values
+        else:
+            column = self.dense[:, self.dense_position[name]]
+        return column if rows is None else column[rows]
+
+    def count(self, rows=None):
+        """Number of values of each indicator.
+
+        Parameters
+        ----------
+        rows: Positions of the rows, all of them if None.
+
+        Returns
+        -------
+        counts
+            Series indexed by IndicatorCode."""
+        if rows is not None:
+            mask = np.zeros(self.n_rows, dtype=bool)
+            mask[rows] = True
+        counts = []
+        for name in self.columns:
+            if name in self.sparse:
+                positions = self.sparse[name][0]
+                counts.append(len(positions) if rows is None
+                              else np.count_nonzero(mask[positions]))
+            else:
+                counts.append(np.count_nonzero(~np.isnan(self.column(name, rows))))
+        return pd.Series(counts, index=self.columns, dtype=np.int64)
+
+    def to_frame(self, columns=None, rows=None, drop_empty=False, budget=None, spill=None):
+        """Dataframe of the panel. When all the rows of a contiguous range
+        of dense indicators are requested, the frame is a view of the block.
+
+        Parameters
+        ----------
+        columns: Indicators, in the order of the frame. All of them if None.
+        rows: Positions of the rows, all of them if None.
+        drop_empty: Drop the rows without any value in columns.
+        budget: Memory budget in MB of the copied values (see allocate).
+        spill: Whether values over the budget are spilled (see allocate).
+
+        Returns
+        -------
+        wide: Dataframe with (CountryCode, Year) rows and one float32 column
+            per indicator.
+        """
+        columns = self.columns if columns is None else list(columns)
+        if drop_empty:
+            has_values = np.zeros(self.n_rows, dtype=bool)
+            for name in columns:
+                has_values |= ~np.isnan(self.column(name))
+            selected = np.flatnonzero(has_values)
+            rows = selected if rows is None else np.intersect1d(rows, selected)
+        positions = [self.dense_position.get(name) for name in columns]
+        if (rows is None and columns and None not in positions
+                and positions == list(range(positions[0], positions[0] + len(positions)))):
+            values = self.dense[:, positions[0]:positions[0] + len(positions)]
+        else:
+            n_rows = self.n_rows if rows is None else len(rows)
+            values = allocate((n_rows, len(columns)), np.float32, budget, spill)
+            for j, name in enumerate(columns):
+                values[:, j] = self.column(name, rows)
+        return pd.DataFrame(values, index=self.index(rows),
+                            columns=pd.Index(columns, name='IndicatorCode'), copy=False)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import config
+from utils import fingerprint
+
+ENTRY_SUFFIX = '.npz'
+
+_default = None
+
+
+class PredictionCache:
+    """Least recently used cache of the forecasts (see forecasting.forecast).
+
+    An entry holds the arrays of one year: the predictions of a year of the
+    database, or the step of a recursive forecast, with the predictions of
+    the year and the input rows and history of the next one, so that a later
+    horizon resumes from there. The entries are keyed by the fingerprint of
+    the model, a hash of the prediction data and the year, so a new model or
+    new data never reads the entries of the former ones, which are evicted
+    in time. They are kept in memory and written to a directory, shared by
+    the runs of the command line and the prediction service. Both are
+    bounded in size, the least recently used entries being evicted first.
+    """
+
+    def __init__(self, path=None, max_mb=None):
+        self.path = config.PREDICTION_CACHE_PATH if path is None else path
+        max_mb = config.PREDICTION_CACHE_MB if max_mb is None else max_mb
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_key, data_key, kind, year):
+        """Key of the entry of a year.
+
+        Parameters
+        ----------
+        model_key: Fingerprint of the model (see models.training_fingerprint).
+        data_key: Hash of the prediction data (see data_key).
+        kind: 'past' for a year of the database, 'chain' for a step of the
+            recursive forecast.
+        year: Year predicted."""
+        return f'{model_key[:24]}_{data_key[:24]}_{kind}_{int(year)}'
+
+    @staticmethod
+    def data_key(X, *extra):
+        """Hash of the prediction data X and of extra values, such as the
+        predicted indicator."""
+        return fingerprint.hash_values(list(X.columns), X.index,
+                                       *(X[name] for name in X.columns), *extra)
+
+    def _fname(self, key):
+        return os.path.join(self.path, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """Arrays of the entry, None if there is none."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key][0]
+        fname = self._fname(key)
+        try:
+            with np.load(fname) as data:
+                entry = {name: data[name] for name in data.files}
+            # Marks the entry as recently used for the eviction of the files
+            os.utime(fname)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key, **arrays):
+        """Stores the arrays of an entry."""
+        with self._lock:
+            self._remember(key, arrays)
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        tmp_fname = os.path.join(self.path, f'.tmp_{os.getpid()}_{key}{ENTRY_SUFFIX}')
+        np.savez(tmp_fname, **arrays)
+        os.replace(tmp_fname, self._fname(key))
+
+    def _remember(self, key, arrays):
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[1]
+        nbytes = sum(np.asarray(array).nbytes for array in arrays.values())
+        self._memory[key] = (arrays, nbytes)
+        self._memory_bytes += nbytes
+        while self._memory and self._memory_bytes > self.max_bytes:
+            self._memory_bytes -= self._memory.popitem(last=False)[1][1]
+
+    def evict(self):
+        """Removes the least recently used files until the directory fits
+        in the size limit.
+
+        Returns
+        -------
+        n_evicted
+            Number of removed entries."""
+        if not os.path.isdir(self.path):
+            return 0
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(ENTRY_SUFFIX) or name.startswith('.tmp_'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            n_evicted += 1
+        if n_evicted:
+            logging.info(f'Evicted {n_evicted} cached predictions')
+        return n_evicted
+
+    def clear(self):
+        """Removes all the entries."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith(ENTRY_SUFFIX):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        pass
+
+
+def default_cache():
+    """Cache of the process, in config.PREDICTION_CACHE_PATH.
+    None if config.PREDICTION_CACHE_MB is 0."""
+    global _default
+    if config.PREDICTION_CACHE_MB <= 0:
+        return None
+    if _default is None or _default.path != config.PREDICTION_CACHE_PATH:
+        _default = PredictionCache()
+    return _default
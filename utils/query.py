@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from utils import instrumentation
+from utils import panel
+
+INDEXES = {
+    'CountryIndicators_Indicator_Country_Year':
+        'CountryIndicators (IndicatorCode, CountryCode, Year)',
+}
+
+
+def ensure_indexes(conn):
+    """Creates the indexes the queries of this module rely on, if they do
+    not exist yet. Only run by the steps that write the database, cli.py
+    ingest and cli.py index, the readers only check them (see check_indexes).
+
+    Parameters
+    ----------
+    conn: Connection to the database."""
+    for name, definition in INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition};')
+    conn.commit()
+
+
+# Databases whose indexes were checked by this process
+_checked = set()
+
+
+def check_indexes(conn, database_path):
+    """Logs a warning, once per database, if the indexes the queries of this
+    module rely on are missing. The database is not written.
+
+    Parameters
+    ----------
+    conn: Connection to the database.
+    database_path: Where database is stored."""
+    if database_path in _checked:
+        return
+    _checked.add(database_path)
+    existing = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index';")}
+    missing = [name for name in INDEXES if name not in existing]
+    if missing:
+        logging.warning(f'The indexes {", ".join(missing)} of {database_path} are missing, '
+                        'the reads scan the whole table. Create them with: python cli.py index')
+
+
+def _filters(conn, exclude_list, indicators, rows=None):
+    """WHERE clause and bound parameters selecting the countries, the
+    indicators and the (CountryCode, Year) rows. The indicators and the rows
+    are bound through temporary tables, since the full lists are longer than
+    the host parameter limit of SQLite."""
+    clauses = []
+    params = []
+    if exclude_list:
+        placeholders = ','.join('?' * len(exclude_list))
+        clauses.append('CountryCode NOT IN (SELECT CountryCode FROM Countries '
+                       f'WHERE LongName IN ({placeholders}))')
+        params.extend(exclude_list)
+    if indicators is not None:
+        conn.execute('DROP TABLE IF EXISTS temp.SelectedIndicators;')
+        conn.execute('CREATE TEMP TABLE SelectedIndicators '
+                     '(IndicatorCode TEXT PRIMARY KEY);')
+        conn.executemany('INSERT OR IGNORE INTO temp.SelectedIndicators VALUES (?);',
+                         [(name,) for name in indicators])
+        clauses.append('IndicatorCode IN (SELECT IndicatorCode FROM temp.SelectedIndicators)')
+    if rows is not None:
+        conn.execute('DROP TABLE IF EXISTS temp.SelectedRows;')
+        conn.execute('CREATE TEMP TABLE SelectedRows '
+                     '(CountryCode TEXT, Year INTEGER, PRIMARY KEY (CountryCode, Year));')
+        conn.executemany('INSERT OR IGNORE INTO temp.SelectedRows VALUES (?, ?);',
+                         [(country, int(year)) for country, year in rows])
+        clauses.append('(CountryCode, Year) IN (SELECT CountryCode, Year FROM temp.SelectedRows)')
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    return where, params
+
+
+@instrumentation.traced('sql_read_long')
+def read_long(database_path, exclude_list=None, indicators=None):
+    """CountryIndicators in long format, filtered in SQL.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    indicators: Indicators to read, all of them if None.
+
+    Returns
+    -------
+    long: Dataframe with columns = CountryCode, IndicatorCode, Year, Value.
+    """
+    conn = sqlite3.connect(database_path)
+    try:
+        check_indexes(conn, database_path)
+        where, params = _filters(conn, exclude_list, indicators)
+        long = pd.read_sql('SELECT CountryCode, IndicatorCode, Year, Value '
+                           f'FROM CountryIndicators{where};', conn, params=params)
+        instrumentation.current().set(rows=len(long))
+        return long
+    finally:
+        conn.close()
+
+
+def read_keys(database_path, exclude_list=None, after_rowid=None):
+    """Distinct (CountryCode, Year) rows of CountryIndicators.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    after_rowid: Only the rows of the values inserted after this rowid,
+        all of them if None.
+
+    Returns
+    -------
+    keys: MultiIndex of the (CountryCode, Year) rows.
+    """
+    conn = sqlite3.connect(database_path)
+    try:
+        where, params = _filters(conn, exclude_list, None)
+        if after_rowid is not None:
+            where += (' AND' if where else ' WHERE') + ' rowid > ?'
+            params = params + [after_rowid]
+        keys = conn.execute('SELECT DISTINCT CountryCode, Year FROM CountryIndicators'
+                            f'{where};', params).fetchall()
+    finally:
+        conn.close()
+    return pd.MultiIndex.from_arrays([[key[0] for key in keys],
+                                      [key[1] for key in keys]],
+                                     names=['CountryCode', 'Year'])
+
+
+@instrumentation.traced('sql_read_wide')
+def read_wide(database_path, exclude_list=None, indicators=None,
+              dtype=np.float64, chunksize=100000, rows=None, budget=None):
+    """CountryIndicators in wide format, streamed in chunks straight into a
+    preallocated array. Equivalent to pivoting the output of read_long with
+    aggfunc=np.sum, without ever holding the long table in memory.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    indicators: Indicators to read, all of them if None.
+    dtype: Data type of the values.
+    chunksize: Number of rows fetched at once.
+    rows: (CountryCode, Year) rows to read, all of them if None.
+    budget: Memory budget in MB of the values (see panel.allocate).
+
+    Returns
+    -------
+    values: Column-major array with one row per (CountryCode, Year) and one
+        column per indicator, NaN where there is no value.
+    countries: CountryCode of each row.
+    years: Year of each row.
+    columns: IndicatorCode of each column.
+    """
+    conn = sqlite3.connect(database_path)
+    try:
+        check_indexes(conn, database_path)
+        where, params = _filters(conn, exclude_list, indicators, rows)
+        keys = conn.execute('SELECT DISTINCT CountryCode, Year FROM CountryIndicators'
+                            f'{where} ORDER BY CountryCode, Year;', params).fetchall()
+        columns = [row[0] for row in conn.execute(
+            f'SELECT DISTINCT IndicatorCode FROM CountryIndicators{where} '
+            'ORDER BY IndicatorCode;', params)]
+        countries = np.array([key[0] for key in keys], dtype=object)
+        years = np.array([key[1] for key in keys], dtype=np.int64)
+        country_index = pd.Index(pd.unique(countries))
+        column_index = pd.Index(columns)
+        # Dense (country, year) -> row lookup table
+        year_min = years.min() if len(years) else 0
+        year_span = int(years.max() - year_min + 1) if len(years) else 0
+        row_lookup = np.full((len(country_index), year_span), -1, dtype=np.int64)
+        row_lookup[country_index.get_indexer(countries), years - year_min] = np.arange(len(keys))
+
+        # Fails before reading any value if the panel is over the budget
+        values = panel.allocate((len(keys), len(columns)), dtype, budget)
+        values[...] = np.nan
+        cursor = conn.execute('SELECT CountryCode, Year, IndicatorCode, Value '
+                              f'FROM CountryIndicators{where};', params)
+        chunk = cursor.fetchmany(chunksize)
+        while chunk:
+            chunk_countries, chunk_years, chunk_indicators, chunk_values = zip(*chunk)
+            chunk_values = np.array(chunk_values, dtype=np.float64)
+            valid = ~np.isnan(chunk_values)
+            rows = row_lookup[country_index.get_indexer(list(chunk_countries)),
+                              np.asarray(chunk_years, dtype=np.int64) - year_min][valid]
+            cols = column_index.get_indexer(list(chunk_indicators))[valid]
+            # Repeated (CountryCode, Year, IndicatorCode) rows are added up,
+            # starting from 0 for the cells without a value yet
+            empty = np.isnan(values[rows, cols])
+            values[rows[empty], cols[empty]] = 0
+            np.add.at(values, (rows, cols), chunk_values[valid])
+            chunk = cursor.fetchmany(chunksize)
+        instrumentation.current().set(rows=len(keys), columns=len(columns))
+        return values, countries, years, columns
+    finally:
+        conn.close()
@@ -1,10 +1,16 @@
 import pandas as pd
 import numpy as np
 import sqlite3
-import statsmodels.formula.api as smf
-from sklearn.feature_selection import f_regression, mutual_info_regression
 import os.path   
 from utils import config
+from utils import feature_store
+from utils import features
+from utils import query
+from utils import imputation
+from utils import instrumentation
+from utils import feature_selection
+from utils import mixed_model
+from utils.encoding import CountryEncoder
 
 
 def get_data(database_path, exclude_list = None):
@@ -20,22 +26,18 @@ def get_data(database_path, exclude_list = None):
     long: All variables and its values in long format: columns = CountryCode,
         IndicatorCode, Year, Value.
     """
-    conn = sqlite3.connect(database_path)
-    country_names = pd.read_sql("""SELECT * FROM Countries;""", conn)
-    not_country = country_names.loc[country_names["LongName"].isin(exclude_list)]["CountryCode"]
-    long = pd.read_sql("""SELECT * FROM CountryIndicators;""", conn)
-    long = long.loc[~long["CountryCode"].isin(not_country)]
-    return long
+    return query.read_long(database_path, exclude_list)
 
 
-def prepare_data(long, PREDICTED_INDICATOR):
-    """Create a Multi-index Dataframe and prepare data for linear model. 
-        Long format to wide format.
+def prepare_data(df, PREDICTED_INDICATOR, encoder=None):
+    """Prepare data for linear model from the wide panel.
     
     Parameters
     ----------
-    long: output of read_database.get_data.
+    df: panel in wide format such as output of feature_store.load_panel.
     PREDICTED_INDICATOR: Variable we want to predict.
+    encoder: encoding.CountryEncoder. Per default, an encoder of the countries
+        of df.
     
     Returns
     -------
@@ -44,21 +46,23 @@ def prepare_data(long, PREDICTED_INDICATOR):
     Groups: variable with country-groups converted to numeric (many modelization 
         functions need it this way).
     """
-    df = long.pivot_table(index=['CountryCode','Year'], columns='IndicatorCode',
-                          values='Value',aggfunc=np.sum)
     # Create 3 more columns with Countries, Objective Indicator lag and year
     df['Country'] = df.index.get_level_values(0)
-    df['lag1'] = df[PREDICTED_INDICATOR].shift(1)
+    # Lag of the same country (see features.compute)
+    df['lag1'] = features.generate(df, features.specs(PREDICTED_INDICATOR, indicators=[],
+                                                      lags=[1], diffs=[], windows=[]))['lag1']
     df['Time'] = df.index.get_level_values(1)
     # Extract Rows where Predicted Indicator and its lag do not have values
     df = df.dropna(subset=[PREDICTED_INDICATOR,"lag1"])
     # Countries strings to numeric values
-    groups = df[["Country"]].replace(pd.unique(df.Country), 
-            list(range(0,len(pd.unique(df.Country)))))
-    groups = pd.to_numeric(groups.Country)
+    if encoder is None:
+        encoder = CountryEncoder(df["Country"])
+    groups = pd.Series(encoder.transform(df["Country"]), index=df.index,
+                       name="Country")
     return df, groups
 
-def linear_model(df1, PREDICTED_INDICATOR, groups):
+@instrumentation.traced('residuals')
+def linear_model(df1, PREDICTED_INDICATOR, groups, backend = None):
     """Linear model Y~Yt-1 controlling by country in order to get its residuals.
     
     Parameters
@@ -66,6 +70,7 @@ def linear_model(df1, PREDICTED_INDICATOR, groups):
     df1: dataframe in wide format such as output of read_database.prepare_data.
     PREDICTED_INDICATOR: Variable we want to predict.
     Groups: variable with country-groups converted to numeric.
+    backend: How the model is fitted (see mixed_model.residuals).
    
     Returns
     -------
@@ -77,42 +82,89 @@ def linear_model(df1, PREDICTED_INDICATOR, groups):
     df1.columns = df1.columns.str.replace(".", "_")
     predicted_indicator = PREDICTED_INDICATOR.replace(".", "_")
     # Mixed linear model with group as random effect.
-    df1_sub = df1[[predicted_indicator,"Country","lag1"]]
-    string = f"{predicted_indicator} ~ lag1"
-    md = smf.mixedlm(string, df1_sub, groups=groups)
-    mod = md.fit()
-    df1['residuals'] = mod.resid
+    df1['residuals'] = mixed_model.residuals(df1, predicted_indicator, groups,
+                                             backend)
     df1['Country'] = groups
     return df1
 
-def clean_data(df, threshold = 0.3):
+def panel_data(panel, PREDICTED_INDICATOR, encoder=None, threshold=0.3, last_year=None):
+    """prepare_data and linear_model on a panel.Panel, without copying the
+    whole panel: the model is fitted on the response alone, then only the
+    indicators that clean_data can keep (those whose NaN ratio on the rows
+    of the model does not exceed threshold) are copied, at these rows only.
+
+    Parameters
+    ----------
+    panel: panel.Panel such as output of feature_store.load.
+    PREDICTED_INDICATOR: Variable we want to predict.
+    encoder: encoding.CountryEncoder (see read_database.prepare_data).
+    threshold: Maximum ratio of NaN values of a kept Indicator (see
+        read_database.clean_data).
+    last_year: Last year of the rows, such as the origin of a backtest.
+        Per default, all the years.
+
+    Returns
+    -------
+    df1: Same as the output of read_database.linear_model, without the
+        Indicators that read_database.clean_data would reject.
+    Groups: variable with country-groups converted to numeric.
+    """
+    df, groups = prepare_data(panel.to_frame([PREDICTED_INDICATOR]), PREDICTED_INDICATOR,
+                              encoder)
+    if last_year is not None:
+        df, groups = df[df['Time'] <= last_year], groups[df['Time'] <= last_year]
+    df = linear_model(df, PREDICTED_INDICATOR, groups)
+    rows = panel.index().get_indexer(df.index)
+    counts = panel.count(rows)
+    kept = counts.index[(len(rows) - counts) / len(rows) <= threshold]
+    covs = panel.to_frame(kept, rows)
+    covs.index = df.index
+    covs.columns = covs.columns.str.replace(".", "_")
+    predicted_indicator = PREDICTED_INDICATOR.replace(".", "_")
+    df1 = pd.concat([covs, df.drop(predicted_indicator, axis=1)], axis=1)
+    return df1, groups
+
+@instrumentation.traced('clean_data')
+def clean_data(df, threshold = 0.3, chunk_size = None, workers = None):
     """ Reject Indicators whose NaN values exceed threshold, NaN imputation of
-        the kept variables.
+        the kept variables (see imputation.impute).
     
     Parameters
     ----------
     df. Output of read_database.linear_model (preferred) or read_database.prepare_data.
+    threshold: Maximum ratio of NaN values of a kept Indicator.
+    chunk_size: Number of Indicators imputed at once.
+    workers: Number of threads of the imputation.
    
     Returns
     -------
     df_fewNA: Dataframe with main variables, without NaN.
     """
     # Filter/impute vars with NA
-    df_fewNA = df[df.columns[(df.isnull().sum(axis=0)/df.shape[0]<=threshold)]]
-    country2 = df_fewNA['Country']
-    df_fewNA = df_fewNA.groupby(country2).transform(lambda x: x.fillna(x.ffill().bfill()))
-    df_fewNA = df_fewNA.fillna(df.mean())
+    country2 = df['Country']
+    # Indicators over the threshold are rejected before the conversion to
+    # float64, only the other ones are copied
+    ratio = (len(df) - df.count()) / len(df)
+    columns = ratio.index[(ratio <= threshold) & (ratio.index != "Country")]
+    values, keep, timings = imputation.impute(df[columns].to_numpy(dtype=np.float64),
+                                              country2.to_numpy(), threshold, chunk_size,
+                                              workers)
+    df_fewNA = pd.DataFrame(values, index=df.index, columns=columns[keep])
     df_fewNA["Country"] = country2
+    instrumentation.current().set(rows=df_fewNA.shape[0], columns=df_fewNA.shape[1])
     return df_fewNA
 
-def select_data(df_fewNA, num_features = 50):
-    """ Write selected_variables.txt with the name of all important features, 
-        determined with mutual information algorithm.
+def rank_variables(df_fewNA, num_features = 50, workers = None, PREDICTED_INDICATOR = None):
+    """ Most important features, determined with mutual information algorithm
+        (see feature_selection).
     
     Parameters
     ----------
     df_fewNA: Output of read_database.clean_data.
     num_features: Maximum number of important variables to output.
+    workers: Number of processes scoring the variables.
+    PREDICTED_INDICATOR: Variable we want to predict. Per default:
+        config.PREDICTED_INDICATOR.
    
     Returns
     -------
@@ -120,23 +172,55 @@ def select_data(df_fewNA, num_features = 50):
         and its weight importance.
     """
     # Feature selection
-    covs = df_fewNA.drop(["NY_GDP_MKTP_KD_ZG","residuals"], 1)
+    if PREDICTED_INDICATOR is None:
+        PREDICTED_INDICATOR = config.PREDICTED_INDICATOR
+    covs = df_fewNA.drop([PREDICTED_INDICATOR.replace(".", "_"), "residuals"], axis=1)
     Y = df_fewNA[['residuals']]
-    info = mutual_info_regression(covs, np.ravel(Y))
+    info = feature_selection.score_columns(
+        covs, np.ravel(Y), workers=workers,
+        cache_path=feature_selection.indicator_path(feature_selection.SCORES_CACHE_PATH,
+                                                    PREDICTED_INDICATOR))
     df_varimp =pd.DataFrame(data={'name': covs.columns, 'varimp': info})
     # Keep top50
-    selected_variables = df_varimp.sort_values(by="varimp",ascending=False)[0:49]
+    selected_variables = df_varimp.sort_values(by="varimp",ascending=False)[0:num_features - 1]
     selected_variables['name'] = selected_variables['name'].str.replace('_','.')
-    selected_variables['name'].to_csv(path_or_buf='./utils/selected_variables.txt',
-                                      header=True,index=None, sep='\t', mode='a')
+    return selected_variables
+
+@instrumentation.traced('select_data')
+def select_data(df_fewNA, num_features = 50, workers = None, PREDICTED_INDICATOR = None):
+    """ Write a new version of the selection artifact with the name of all
+        important features (see read_database.rank_variables).
+    
+    Parameters
+    ----------
+    df_fewNA: Output of read_database.clean_data.
+    num_features: Maximum number of important variables to output.
+    workers: Number of processes scoring the variables.
+    PREDICTED_INDICATOR: Variable we want to predict. Per default:
+        config.PREDICTED_INDICATOR.
+   
+    Returns
+    -------
+    selected_variables: Dataframe with the name of all important features 
+        and its weight importance.
+    """
+    if PREDICTED_INDICATOR is None:
+        PREDICTED_INDICATOR = config.PREDICTED_INDICATOR
+    selected_variables = rank_variables(df_fewNA, num_features, workers, PREDICTED_INDICATOR)
+    feature_selection.write_selection(
+        selected_variables['name'], selected_variables['varimp'],
+        path=feature_selection.indicator_path(config.SELECTION_PATH, PREDICTED_INDICATOR),
+        num_features=num_features, indicator=PREDICTED_INDICATOR)
     return selected_variables
 
 
 def get_select_data(database_path,exclude_list, PREDICTED_INDICATOR, 
                     file='./utils/selected_variables.txt'):
     """ 
-    Read tbe important variables from selected_variables.txt 
-    (created by read_database.select_data and extract them from the SQL.
+    Read tbe important variables from the selection artifact
+    (created by read_database.select_data) and extract them from the feature store,
+    with the lag and rolling features of config (see features.specs) and
+    the indicators they are computed from.
     
     Parameters
     ----------
@@ -150,29 +234,57 @@ def get_select_data(database_path,exclude_list, PREDICTED_INDICATOR,
     vars2: input for the predictive model.
     """
     if os.path.isfile(file):
-        selected_variables= pd.read_csv(file)   
-        conn = sqlite3.connect(database_path)
-        selected_variables = selected_variables['name'].append(pd.Series("NY.GDP.MKTP.KD.ZG"),
-                                                               ignore_index=True).tolist()
-        queryString = 'SELECT * FROM CountryIndicators WHERE IndicatorCode IN (\'{}\');'.format('\',\''.join([_ for _ in selected_variables]))
-        vars1 = pd.read_sql(queryString, con=conn)
-        # LongName to CountryName
-        country_names = pd.read_sql("""SELECT LongName,CountryCode FROM Countries;""", conn)
-        not_country = country_names.loc[country_names["LongName"].isin(exclude_list)]["CountryCode"]
-        vars1= vars1.loc[~vars1["CountryCode"].isin(not_country)]
-        vars2 = vars1.pivot_table(index=['CountryCode','Year'], columns='IndicatorCode',
-                                  values='Value',aggfunc=np.sum)
-        vars2['Country'] = vars2.index.get_level_values(0)
-        vars2['Time'] = vars2.index.get_level_values(1)
-        vars2['lag1'] = vars2[PREDICTED_INDICATOR].shift(1)
-        return vars2
-
-
-
-
+        return select_columns(database_path, exclude_list, PREDICTED_INDICATOR,
+                              read_selected_variables(file))
 
 
+def select_columns(database_path, exclude_list, PREDICTED_INDICATOR, selected_variables):
+    """ 
+    Extract the variables from the feature store, with the response, the
+    lag and rolling features of config (see features.specs) and the
+    indicators they are computed from.
+    
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    PREDICTED_INDICATOR: Variable we want to predict.
+    selected_variables: Names of the variables.
+    
+    Returns
+    -------
+    vars2: input for the predictive model.
+    """
+    selected_variables = list(selected_variables)
+    # The indicators with features are moved forward with them in the
+    # recursive forecasts (see features.advance)
+    feature_indicators = features.indicators(features.specs(PREDICTED_INDICATOR))
+    selected_variables.extend(name for name in [PREDICTED_INDICATOR] + feature_indicators
+                              if name not in selected_variables)
+    vars2 = feature_store.load_panel(database_path, exclude_list,
+                                     columns=selected_variables)
+    vars2['Country'] = vars2.index.get_level_values(0)
+    vars2['Time'] = vars2.index.get_level_values(1)
+    generated = features.load(database_path, exclude_list, PREDICTED_INDICATOR)
+    for name in generated.columns:
+        vars2[name] = generated[name].reindex(vars2.index)
+    return vars2
 
 
+def read_selected_variables(file='./utils/selected_variables.txt'):
+    """Names of the selected variables, without repetitions.
 
+    Parameters
+    ----------
+    file: Selection artifact (.json) written by read_database.select_data,
+        or legacy selected_variables.txt.
 
+    Returns
+    -------
+    names: List with the names of the variables.
+    """
+    if file.endswith('.json'):
+        return feature_selection.read_selection(file)['names']
+    names = pd.read_csv(file)['name']
+    names = names.loc[names != 'name']
+    return pd.unique(names).tolist()
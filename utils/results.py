@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import sqlite3
+import uuid
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+
+import pandas as pd
+
+from utils import config
+from utils import instrumentation
+
+TABLE = 'EstimatedGDPGrowth'
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {TABLE} (
+    model_version TEXT NOT NULL,
+    Indicator TEXT NOT NULL,
+    Country TEXT NOT NULL,
+    Year INTEGER NOT NULL,
+    y_pred REAL,
+    run_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (model_version, Indicator, Country, Year)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS {TABLE}_Year_Country ON {TABLE} (Year, Country);
+'''
+
+UPSERT = f'''
+INSERT INTO {TABLE} (model_version, Indicator, Country, Year, y_pred, run_id, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (model_version, Indicator, Country, Year) DO UPDATE SET
+    y_pred = excluded.y_pred,
+    run_id = excluded.run_id,
+    created_at = excluded.created_at;
+'''
+
+# Version given to the predictions written before the table had one
+LEGACY_VERSION = 'legacy'
+
+COLUMNS = ['model_version', 'Indicator', 'Country', 'Year', 'y_pred', 'run_id', 'created_at']
+
+
+def connect(path=None, wal=None):
+    """Connection to the results database in WAL mode: readers see the
+    last committed state and never block the writer, nor the other way
+    round.
+
+    Parameters
+    ----------
+    path: Results database. Per default: config.RESULTS_PATH.
+    wal: Whether to switch the database to WAL mode, which is persistent.
+        Per default, unless path is the input database config.DATABASE_PATH,
+        whose journal mode is left alone.
+
+    Returns
+    -------
+    conn
+        Connection with the results table created."""
+    path = config.RESULTS_PATH if path is None else path
+    if wal is None:
+        wal = os.path.abspath(path) != os.path.abspath(config.DATABASE_PATH)
+    conn = sqlite3.connect(path, timeout=config.RESULTS_TIMEOUT)
+    if wal:
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+    _migrate(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def connect_read_only(path=None):
+    """Read-only connection to the results database: nothing is created,
+    migrated or switched to WAL mode, so reading never writes the database.
+
+    Parameters
+    ----------
+    path: Results database. Per default: config.RESULTS_PATH.
+
+    Returns
+    -------
+    conn
+        Connection, None if there is no database."""
+    path = config.RESULTS_PATH if path is None else path
+    if not os.path.isfile(path):
+        return None
+    return sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True,
+                           timeout=config.RESULTS_TIMEOUT)
+
+
+def _current_columns(columns):
+    """Columns of the current schema selected from a table with the former
+    columns, see _migrate."""
+    if 'model_version' in columns:
+        version, run_id, created_at = 'model_version', 'run_id', 'created_at'
+    else:
+        created_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        version, run_id, created_at = (f"'{LEGACY_VERSION}'", f"'{LEGACY_VERSION}'",
+                                       f"'{created_at}'")
+    return (f"{version} AS model_version, '{config.PREDICTED_INDICATOR}' AS Indicator, "
+            f"Country, CAST(Year AS INTEGER) AS Year, y_pred, {run_id} AS run_id, "
+            f"{created_at} AS created_at")
+
+
+def _migrate(conn):
+    """Moves the predictions of a former schema of the table to the current
+    one: the table (y_pred, Country, Year) replaced at every run, or the
+    versioned table without indicator. Their indicator is
+    config.PREDICTED_INDICATOR, the only one predicted then."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({TABLE});')]
+    if not columns or 'Indicator' in columns:
+        return
+    logging.info(f'Migrating table {TABLE} to the current schema')
+    # One script, so the migration is done as a single transaction. The
+    # index moves with the renamed table and is dropped to be created again.
+    conn.executescript(f'''
+        BEGIN;
+        ALTER TABLE {TABLE} RENAME TO {TABLE}_legacy;
+        DROP INDEX IF EXISTS {TABLE}_Year_Country;
+        {SCHEMA}
+        INSERT OR REPLACE INTO {TABLE} ({', '.join(COLUMNS)})
+        SELECT {_current_columns(columns)} FROM {TABLE}_legacy;
+        DROP TABLE {TABLE}_legacy;
+        COMMIT;
+    ''')
+
+
+@instrumentation.traced('write_results')
+def write_predictions(predictions, model_version, path=None, run_id=None,
+                      chunksize=10000, indicator=None):
+    """Inserts the predictions or updates the former predictions of the
+    same model version, country and year, in a single transaction.
+
+    Parameters
+    ----------
+    predictions: Dataframe with the columns y_pred, Country and Year, such
+        as the output of forecasting.forecast.
+    model_version: Version of the model, e.g. its key in the model store.
+    path: Results database. Per default: config.RESULTS_PATH.
+    run_id: Identifier of the run. Per default, a new random one.
+    chunksize: Number of rows sent to the database at once.
+    indicator: Indicator predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    run_id
+        Identifier of the run the predictions were written with."""
+    run_id = uuid.uuid4().hex if run_id is None else run_id
+    indicator = config.PREDICTED_INDICATOR if indicator is None else indicator
+    created_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    rows = list(zip([model_version] * len(predictions),
+                    [indicator] * len(predictions),
+                    predictions['Country'].astype(str),
+                    predictions['Year'].astype(int).tolist(),
+                    predictions['y_pred'].astype(float).tolist(),
+                    [run_id] * len(predictions),
+                    [created_at] * len(predictions)))
+    conn = connect(path)
+    try:
+        with conn:
+            for start in range(0, len(rows), chunksize):
+                conn.executemany(UPSERT, rows[start:start + chunksize])
+    finally:
+        conn.close()
+    instrumentation.current().set(rows=len(rows))
+    logging.info(f'{len(rows)} predictions of {indicator} by model {model_version} written, '
+                 f'run {run_id}')
+    return run_id
+
+
+def read_predictions(path=None, model_version=None, first_year=None,
+                     last_year=None, countries=None, indicator=None):
+    """Stored predictions, filtered in SQL on the indexed columns. The
+    database is opened read-only (see connect_read_only), the predictions
+    of a former schema of the table are read as if migrated.
+
+    Parameters
+    ----------
+    path: Results database. Per default: config.RESULTS_PATH.
+    model_version: Version of the model, all of them if None.
+    first_year: First year to read, no lower bound if None.
+    last_year: Last year to read, no upper bound if None.
+    countries: Country codes to read, all of them if None.
+    indicator: Indicator to read, all of them if None.
+
+    Returns
+    -------
+    predictions
+        Dataframe with the columns model_version, Indicator, Country, Year,
+        y_pred, run_id and created_at."""
+    clauses = []
+    params = []
+    if model_version is not None:
+        clauses.append('model_version = ?')
+        params.append(model_version)
+    if indicator is not None:
+        clauses.append('Indicator = ?')
+        params.append(indicator)
+    if first_year is not None:
+        clauses.append('Year >= ?')
+        params.append(int(first_year))
+    if last_year is not None:
+        clauses.append('Year <= ?')
+        params.append(int(last_year))
+    if countries is not None:
+        countries = list(countries)
+        clauses.append(f"Country IN ({','.join('?' * len(countries))})")
+        params.extend(countries)
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    conn = connect_read_only(path)
+    if conn is None:
+        return pd.DataFrame(columns=COLUMNS)
+    try:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({TABLE});')]
+        if not columns:
+            return pd.DataFrame(columns=COLUMNS)
+        source = (TABLE if 'Indicator' in columns
+                  else f'(SELECT {_current_columns(columns)} FROM {TABLE})')
+        return pd.read_sql(f'SELECT {", ".join(COLUMNS)} FROM {source}{where} '
+                           'ORDER BY model_version, Indicator, Country, Year;', conn,
+                           params=params)
+    finally:
+        conn.close()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+from utils import config
+from utils import features
+from utils import instrumentation
+from utils import io_aux_train as training
+
+COVARIATE_KINDS = ('fixed', 'random_walk', 'shock')
+
+RESIDUAL_KINDS = ('none', 'normal', 'bootstrap')
+
+
+def read_spec(path=None):
+    """Perturbation spec of the scenarios.
+
+    A spec is a dictionary such as
+        {"covariates": {"default": {"kind": "random_walk", "scale": 1.0},
+                        "SP_POP_65UP_TO_ZS": {"kind": "fixed"},
+                        "EN_URB_LCTY": {"kind": "shock", "sigma": 0.5}},
+         "residuals": {"kind": "bootstrap"}}
+    Each covariate (with the column names of the model) follows its own
+    entry, or the default one:
+        fixed: carried forward unchanged, as in forecasting.forecast.
+        random_walk: a normal step of standard deviation sigma every year.
+        shock: a normal deviation of standard deviation sigma from the last
+            observed value, drawn again every year.
+    Without sigma, it is scale times the standard deviation of the yearly
+    changes of the covariate within countries in the data.
+    The residuals added to each predicted response are:
+        none: no residual, every path is the deterministic forecast of its
+            covariates.
+        normal: normal of standard deviation sigma, per default scale times
+            the standard deviation of the error term of the model.
+        bootstrap: resampled from the residuals of the training data.
+
+    Parameters
+    ----------
+    path: JSON file of the spec. Per default: config.SCENARIO_SPEC.
+
+    Returns
+    -------
+    spec
+        Dictionary with the keys 'covariates' and 'residuals'."""
+    if path is None:
+        spec = config.SCENARIO_SPEC
+    else:
+        with open(path) as f:
+            spec = json.load(f)
+    covariates = dict(spec.get('covariates', {}))
+    covariates.setdefault('default', {'kind': 'fixed'})
+    residuals = dict(spec.get('residuals', {'kind': 'none'}))
+    for name, entry in covariates.items():
+        if entry.get('kind') not in COVARIATE_KINDS:
+            raise ValueError(f"Invalid kind {entry.get('kind')} of the covariate {name}, "
+                             f"expected one of {', '.join(COVARIATE_KINDS)}")
+    if residuals.get('kind') not in RESIDUAL_KINDS:
+        raise ValueError(f"Invalid kind {residuals.get('kind')} of the residuals, "
+                         f"expected one of {', '.join(RESIDUAL_KINDS)}")
+    return {'covariates': covariates, 'residuals': residuals}
+
+
+def _covariate_steps(X, columns, spec, fixed_columns):
+    """Kind (index in COVARIATE_KINDS) and standard deviation of the
+    perturbation of every column of the model."""
+    history = X.reset_index(drop=True).sort_values(['Country', 'Time'], kind='stable')
+    changes = history.groupby('Country')[list(columns)].diff()
+    kinds = np.zeros(len(columns), dtype=np.int64)
+    sigmas = np.zeros(len(columns))
+    for j, name in enumerate(columns):
+        if name in fixed_columns:
+            continue
+        entry = spec['covariates'].get(name, spec['covariates']['default'])
+        kinds[j] = COVARIATE_KINDS.index(entry['kind'])
+        if 'sigma' in entry:
+            sigmas[j] = float(entry['sigma'])
+        elif kinds[j]:
+            sigma = np.nanstd(changes[name].to_numpy(dtype=np.float64))
+            sigmas[j] = entry.get('scale', 1.0) * (0. if np.isnan(sigma) else sigma)
+    return kinds, sigmas
+
+
+def _training_residuals(model):
+    """Residuals of the training data of a models.GDPGrowthPredictor."""
+    pred = model.predict(model.X, model.groups)
+    return model.y - pred['fixed_effect'] - pred['random_effect_mean']
+
+
+def _quantile_name(q):
+    return f'q{q:g}'
+
+
+@instrumentation.traced('scenarios')
+def simulate(X, model, years, encoder=None, spec=None, n_scenarios=None, seed=0,
+             quantiles=None, predicted_indicator=None, batch_rows=None, return_paths=False):
+    """Monte Carlo forecast of all countries for years after
+    config.DB_YEAR_MAX, under perturbations of the covariates and of the
+    residuals (see read_spec).
+
+    The paths start from the data of config.DB_YEAR_MAX and are simulated
+    all at once: the rows of every scenario and country are stacked into a
+    single array, so every year of a batch of scenarios costs one call to
+    the tree ensemble, the random effect of each country being computed
+    once. As in forecasting.forecast, the prediction of each year becomes
+    the response variable of the input data of the next year, and the lags
+    and rolling features of the response and of the perturbed covariates
+    are computed again (see features.advance). With fixed
+    covariates and no residuals, every path is that forecast.
+
+    Parameters
+    ----------
+    X: covariable-cleaned database, indexed by year (see io.prediction_dataset).
+    model: Trained models.GDPGrowthPredictor.
+    years: Years of prediction, after config.DB_YEAR_MAX.
+    encoder: encoding.CountryEncoder used for the training data.
+    spec: Perturbation spec (see read_spec). Per default: config.SCENARIO_SPEC.
+    n_scenarios: Number of paths per country. Per default: config.SCENARIO_COUNT.
+    seed: Seed of the random generator.
+    quantiles: Quantiles reported. Per default: config.SCENARIO_QUANTILES.
+    predicted_indicator: Variable predicted by the model.
+        Per default: config.PREDICTED_INDICATOR.
+    batch_rows: Maximum number of rows predicted at once.
+        Per default: config.SCENARIO_BATCH_ROWS.
+    return_paths: Also return the simulated paths.
+
+    Returns
+    -------
+    summary
+        Dataframe with the columns Country, Year, mean, std and one column
+        per quantile, named q<quantile> (e.g. q0.05).
+    paths
+        Only with return_paths, float32 array of the simulated responses,
+        of shape (scenario, country, year)."""
+    spec = read_spec() if spec is None else spec
+    n_scenarios = config.SCENARIO_COUNT if n_scenarios is None else n_scenarios
+    quantiles = config.SCENARIO_QUANTILES if quantiles is None else quantiles
+    batch_rows = config.SCENARIO_BATCH_ROWS if batch_rows is None else batch_rows
+    if predicted_indicator is None:
+        predicted_indicator = config.PREDICTED_INDICATOR
+    predicted_indicator = predicted_indicator.replace(".", "_")
+    years = sorted(set(int(year) for year in years))
+    if not years or years[0] <= config.DB_YEAR_MAX:
+        raise ValueError(f"The years of the scenarios have to be greater "
+                         f"than {config.DB_YEAR_MAX}")
+
+    start = X.loc[X.index == config.DB_YEAR_MAX]
+    countries = start['Country'].to_numpy()
+    feature_specs = features.specs(predicted_indicator)
+    start_history = features.history(X['Country'], X['Time'],
+                                     features.indicator_columns(X, feature_specs),
+                                     config.DB_YEAR_MAX, features.depth(feature_specs))
+    start, groups = training.handle_country_groups(start, encoder)
+    columns = list(start.columns)
+    base = start.to_numpy(dtype=np.float64)
+    n_countries, n_columns = base.shape
+    # The response is simulated and the features follow their indicators,
+    # the time is kept as in forecast
+    kinds, sigmas = _covariate_steps(X, columns, spec,
+                                     {predicted_indicator, 'Time'}
+                                     | {name.replace('.', '_')
+                                        for name, _, _, _ in feature_specs})
+    walk = np.flatnonzero((kinds == COVARIATE_KINDS.index('random_walk')) & (sigmas > 0))
+    shock = np.flatnonzero((kinds == COVARIATE_KINDS.index('shock')) & (sigmas > 0))
+
+    residuals = spec['residuals']
+    if residuals['kind'] == 'bootstrap':
+        pool = _training_residuals(model)
+    elif residuals['kind'] == 'normal':
+        sigma = residuals.get('sigma', residuals.get('scale', 1.0)
+                              * np.sqrt(model.cov_pars[0]))
+    random_effect = model.predict(base, groups)['random_effect_mean']
+
+    rng = np.random.default_rng(seed)
+    wanted = {year: k for k, year in enumerate(years)}
+    paths = np.empty((n_scenarios, n_countries, len(years)), dtype=np.float32)
+    batch = max(1, batch_rows // n_countries)
+    logging.info(f'Simulating {n_scenarios} scenarios of {n_countries} countries until '
+                 f'{years[-1]}, {len(walk)} random walk and {len(shock)} shocked covariates')
+    for first in range(0, n_scenarios, batch):
+        n_batch = min(batch, n_scenarios - first)
+        # Row s * n_countries + c is the country c in the scenario s
+        values = np.tile(base, (n_batch, 1))
+        effects = np.tile(random_effect, n_batch)
+        history = np.tile(start_history, (n_batch, 1, 1))
+        n_rows = len(values)
+        for year in range(config.DB_YEAR_MAX + 1, years[-1] + 1):
+            y_pred = model.fixed_effect(values) + effects
+            if residuals['kind'] == 'bootstrap':
+                y_pred += rng.choice(pool, n_rows)
+            elif residuals['kind'] == 'normal':
+                y_pred += rng.standard_normal(n_rows) * sigma
+            if year < years[-1]:
+                # Covariates of the year predicted, which is not observed, the
+                # input of the next one with their features (see features.advance)
+                if len(walk):
+                    values[:, walk] += rng.standard_normal((n_rows, len(walk))) * sigmas[walk]
+                if len(shock):
+                    values[:, shock] = (np.tile(base[:, shock], (n_batch, 1))
+                                        + rng.standard_normal((n_rows, len(shock)))
+                                        * sigmas[shock])
+            history = features.advance(values, columns, history, y_pred,
+                                       predicted_indicator)
+            if year in wanted:
+                paths[first:first + n_batch, :, wanted[year]] = y_pred.reshape(n_batch,
+                                                                               n_countries)
+
+    summary = pd.DataFrame({
+        'Country': np.repeat(countries, len(years)),
+        'Year': np.tile(years, n_countries),
+        'mean': paths.mean(axis=0, dtype=np.float64).ravel(),
+        'std': paths.std(axis=0, dtype=np.float64).ravel(),
+    })
+    for q, values in zip(quantiles, np.quantile(paths, quantiles, axis=0)):
+        summary[_quantile_name(q)] = values.ravel()
+    instrumentation.current().set(scenarios=n_scenarios, rows=len(summary),
+                                  years=len(years))
+    if return_paths:
+        return summary, paths
+    return summary
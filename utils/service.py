@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from utils import config
+from utils import forecasting
+from utils import io
+from utils import models
+
+
+def load_state(database_path=None):
+    """Everything the service needs to answer queries: the prediction data
+    of every country, the model trained on the database (see
+    models.load_or_train) and the country encoder.
+
+    Parameters
+    ----------
+    database_path: Where database is stored. Per default: config.DATABASE_PATH.
+
+    Returns
+    -------
+    state
+        Dictionary with the keys 'X', 'model', 'encoder' and 'model_path'."""
+    database_path = config.DATABASE_PATH if database_path is None else database_path
+    X, X_train, y_train, groups_train, encoder = io.retrieve_training_data(
+        database_path, config.exclude_list, config.PREDICTED_INDICATOR)
+    model = models.load_or_train(X_train, y_train, groups_train, database_path, encoder)
+    return {
+        'X': io.prediction_dataset(X),
+        'model': model,
+        'encoder': encoder,
+        'model_path': models.model_path(model.fingerprint),
+    }
+
+
+class _Query:
+    """Pending query of the batcher, answered through result or error."""
+
+    def __init__(self, years, countries):
+        self.years = years
+        self.countries = countries
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PredictionService:
+    """Keeps the model and the prediction data in memory and answers
+    forecast queries.
+
+    Queries are not predicted one by one: a single batcher thread collects
+    the queries arriving within config.SERVE_BATCH_WINDOW seconds and
+    forecasts the union of their years for all countries in one pass (see
+    forecasting.forecast), so concurrent queries share the calls to the
+    model. A new state (model and data) is loaded on the side and swapped
+    in between two batches, queries are never dropped during a reload.
+    """
+
+    def __init__(self, loader=load_state, batch_window=None, max_batch=None):
+        self.loader = loader
+        self.batch_window = config.SERVE_BATCH_WINDOW if batch_window is None else batch_window
+        self.max_batch = config.SERVE_MAX_BATCH if max_batch is None else max_batch
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._state = loader()
+        self._queue = queue.Queue()
+        self._batcher = threading.Thread(target=self._run, daemon=True)
+        self._batcher.start()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def predict(self, years, countries=None):
+        """Forecast of countries for years.
+
+        Parameters
+        ----------
+        years: Years of prediction.
+        countries: Country codes, all countries if None.
+
+        Returns
+        -------
+        predictions
+            Dataframe with the columns y_pred, Country and Year."""
+        years = sorted(set(int(year) for year in years))
+        if not years or years[0] < config.DB_YEAR_MIN + 1:
+            raise ValueError(f"The year to predict has to be equal "
+                             f"or greater than {config.DB_YEAR_MIN + 1}")
+        if countries is not None:
+            countries = list(countries)
+            # Raises a ValueError for unknown countries
+            self.state['encoder'].transform(countries)
+        pending = _Query(years, countries)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            state = self.state
+            try:
+                years = sorted(set(year for pending in batch for year in pending.years))
+                predictions = forecasting.forecast(state['X'], state['model'], years,
+                                                   state['encoder'])
+                for pending in batch:
+                    rows = predictions['Year'].isin(pending.years)
+                    if pending.countries is not None:
+                        rows &= predictions['Country'].isin(pending.countries)
+                    pending.result = predictions.loc[rows].reset_index(drop=True)
+            except Exception as e:
+                logging.exception('Prediction of a batch failed')
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
+            logging.info(f'Answered {len(batch)} queries in one batch')
+
+    def reload(self):
+        """Loads the current model and data and swaps them in."""
+        with self._reload_lock:
+            logging.info('Reloading the model')
+            state = self.loader()
+            with self._lock:
+                self._state = state
+            logging.info(f"Serving model {state['model_path']}")
+
+    def watch(self, interval=None):
+        """Reloads the service in a background thread whenever a model is
+        stored in config.MODELS_PATH after the one being served, e.g. by
+        cli.py update.
+
+        Parameters
+        ----------
+        interval: Seconds between two checks.
+            Per default: config.SERVE_RELOAD_INTERVAL."""
+        interval = config.SERVE_RELOAD_INTERVAL if interval is None else interval
+
+        def stamp():
+            path = models.latest_model_path()
+            return None if path is None else os.path.getmtime(
+                os.path.join(path, models.META_FNAME))
+
+        def loop():
+            served = stamp()
+            while True:
+                time.sleep(interval)
+                latest = stamp()
+                if latest != served:
+                    try:
+                        self.reload()
+                        served = latest
+                    except Exception:
+                        logging.exception('Reloading the model failed, '
+                                          'the former one is still served')
+
+        threading.Thread(target=loop, daemon=True).start()
+
+
+class _Server(ThreadingHTTPServer):
+    # Bursts of concurrent queries wait in the listen backlog instead of
+    # being refused while a batch is being predicted
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def _handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path == '/health':
+                self._send(200, {'model': os.path.basename(service.state['model_path'])})
+                return
+            if url.path != '/predict':
+                self._send(404, {'error': f'Unknown path {url.path}'})
+                return
+            try:
+                years = params.get('years', params.get('year'))
+                if years is None:
+                    raise ValueError('Missing parameter year or years')
+                years = forecasting.parse_years(','.join(years))
+                countries = None
+                if 'country' in params:
+                    countries = ','.join(params['country']).split(',')
+                predictions = service.predict(years, countries)
+            except ValueError as e:
+                self._send(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+                return
+            self._send(200, {
+                'model': os.path.basename(service.state['model_path']),
+                'predictions': [{'Country': country, 'Year': int(year),
+                                 'y_pred': float(y_pred)}
+                                for y_pred, country, year in predictions.itertuples(index=False)],
+            })
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/reload':
+                self._send(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                service.reload()
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+                return
+            self._send(200, {'model': os.path.basename(service.state['model_path'])})
+
+        def log_message(self, format, *args):
+            logging.info('%s - %s', self.address_string(), format % args)
+
+    return Handler
+
+
+def serve(host=None, port=None, service=None):
+    """Answers forecast queries over HTTP until interrupted.
+
+    GET /predict?country=ARG,BRA&years=2011-2015
+        Forecast of the given countries (all of them without country) for
+        the given years (year or years, as in forecasting.parse_years).
+    POST /reload
+        Loads the current model and data.
+    GET /health
+        Model being served.
+
+    Parameters
+    ----------
+    host: Host name. Per default: config.SERVE_HOST.
+    port: Port. Per default: config.SERVE_PORT.
+    service: PredictionService. Per default, a new one that reloads itself
+        when a new model is stored."""
+    host = config.SERVE_HOST if host is None else host
+    port = config.SERVE_PORT if port is None else port
+    if service is None:
+        service = PredictionService()
+        service.watch()
+    server = _Server((host, port), _handler(service))
+    logging.info(f'Serving predictions on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
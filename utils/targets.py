@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from utils import config
+from utils import feature_store
+from utils import forecasting
+from utils import instrumentation
+from utils import io
+from utils import models
+from utils import read_database as rd
+from utils import results
+from utils.encoding import CountryEncoder
+
+
+def parse_targets(targets=None):
+    """Parses the indicators to predict given in the command line.
+
+    Parameters
+    ----------
+    targets: Comma-separated indicator codes, such as
+        'NY.GDP.MKTP.KD.ZG,NY.GDP.PCAP.KD.ZG'.
+        Per default: config.PREDICTED_INDICATORS.
+
+    Returns
+    -------
+    targets
+        List of indicator codes without repetitions."""
+    if targets is None:
+        return list(config.PREDICTED_INDICATORS)
+    parsed = [target.strip() for target in str(targets).split(',') if target.strip()]
+    if not parsed:
+        raise ValueError(f"Invalid list of indicators {targets}")
+    return list(dict.fromkeys(parsed))
+
+
+@instrumentation.traced('clean_targets')
+def clean_targets(database_path, exclude_list, targets, encoder=None):
+    """Cleaned dataset of every target (see read_database.panel_data and
+    read_database.clean_data), all of them from a single load of the panel.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    targets: Indicators to predict.
+    encoder: encoding.CountryEncoder. Per default, the one of the database.
+
+    Returns
+    -------
+    cleaned
+        Dictionary with the output of read_database.clean_data of each target."""
+    encoder = CountryEncoder.from_database(database_path) if encoder is None else encoder
+    panel = feature_store.load(database_path, exclude_list)
+    cleaned = {}
+    for target in targets:
+        df1, _ = rd.panel_data(panel, target, encoder)
+        cleaned[target] = rd.clean_data(df1)
+    return cleaned
+
+
+@instrumentation.traced('select_variables')
+def select(database_path, exclude_list, targets, workers=None):
+    """Selects the most relevant variables of every target and writes their
+    selection artifacts (see read_database.select_data).
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    targets: Indicators to predict.
+    workers: Number of processes scoring the variables.
+
+    Returns
+    -------
+    selected
+        Dictionary with the selected variables of each target."""
+    cleaned = clean_targets(database_path, exclude_list, targets)
+    return {target: rd.select_data(cleaned.pop(target), 50, workers=workers,
+                                   PREDICTED_INDICATOR=target)
+            for target in targets}
+
+
+def _fit_target(database_path, exclude_list, target, df_fewNA, years, encoder,
+                selection_workers):
+    """Selection (when df_fewNA is given), training or loading of the model
+    and forecast of one target. Run by the workers of predict."""
+    with instrumentation.span('target', indicator=target):
+        if df_fewNA is not None:
+            rd.select_data(df_fewNA, 50, workers=selection_workers,
+                           PREDICTED_INDICATOR=target)
+        X, X_train, y_train, groups_train, encoder = io.retrieve_training_data(
+            database_path, exclude_list, target, encoder)
+        model = models.load_or_train(X_train, y_train, groups_train, database_path, encoder,
+                                     target)
+        predictions = forecasting.forecast(io.prediction_dataset(X), model, years, encoder,
+                                           target)
+        return predictions, model.fingerprint
+
+
+@instrumentation.traced('targets')
+def predict(database_path, exclude_list, targets, years, workers=None, results_path=None):
+    """Forecasts several indicators in one run.
+    The feature store is brought up to date and the country encoder is
+    built once for all targets. The targets without selection artifact are
+    cleaned from a single load of the panel (see clean_targets). The
+    selection, training and forecast of each target then run in a process
+    pool, one target per task, and the predictions are written to the
+    results table tagged by indicator, under a single run id.
+
+    Parameters
+    ----------
+    database_path: Where database is stored.
+    exclude_list: Zones that are not a country.
+    targets: Indicators to predict.
+    years: Years of prediction.
+    workers: Number of worker processes. Per default, one per target up to
+        the number of cores. With a single worker, the targets are run in
+        this process.
+    results_path: Results database (see results.write_predictions).
+
+    Returns
+    -------
+    predictions
+        Dataframe with the columns y_pred, Country, Year and Indicator."""
+    if workers is None:
+        workers = min(len(targets), os.cpu_count() or 1)
+    workers = min(workers, len(targets))
+    # Built before the workers read it, so that none of them builds it
+    feature_store.extend(database_path, exclude_list)
+    encoder = CountryEncoder.from_database(database_path)
+    pending = [target for target in targets if io.selection_file(target) is None]
+    cleaned = clean_targets(database_path, exclude_list, pending, encoder) if pending else {}
+    logging.info(f'Predicting {len(targets)} indicators with {workers} workers, '
+                 f'{len(pending)} of them without selection')
+
+    outputs, failed = {}, []
+    if workers <= 1:
+        for target in targets:
+            outputs[target] = _fit_target(database_path, exclude_list, target,
+                                          cleaned.pop(target, None), years, encoder, None)
+    else:
+        # The workers score the variables in a single process, the targets
+        # already occupy the cores
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {target: executor.submit(_fit_target, database_path, exclude_list,
+                                                target, cleaned.pop(target, None), years,
+                                                encoder, 1)
+                       for target in targets}
+            for target, future in futures.items():
+                try:
+                    outputs[target] = future.result()
+                except Exception:
+                    logging.exception(f'Prediction of {target} failed')
+                    failed.append(target)
+
+    run_id = uuid.uuid4().hex
+    predictions = []
+    for target, (target_predictions, model_version) in outputs.items():
+        results.write_predictions(target_predictions, model_version, results_path, run_id,
+                                  indicator=target)
+        predictions.append(target_predictions.assign(Indicator=target))
+    if failed:
+        raise RuntimeError(f"Prediction of {', '.join(failed)} failed, "
+                           f"the other indicators were written in run {run_id}")
+    return pd.concat(predictions, ignore_index=True)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils import config
+from utils import instrumentation
+from utils import io_aux_train as training
+
+# Shared training data, attached once per worker (see _init_worker)
+_shared = {}
+
+
+def candidates(search='grid', n_candidates=20, space=None, seed=1):
+    """Configurations to evaluate.
+
+    Parameters
+    ----------
+    search: 'grid' for every combination of space, 'random' for
+        n_candidates combinations drawn without repetition.
+    n_candidates: Number of configurations of the random search.
+    space: Dictionary with the values of each parameter.
+        Per default: config.TUNING_SPACE.
+    seed: Seed of the random search.
+
+    Returns
+    -------
+    candidates
+        List of dictionaries with one value per parameter."""
+    space = config.TUNING_SPACE if space is None else space
+    names = sorted(space)
+    grid = [dict(zip(names, values))
+            for values in itertools.product(*(space[name] for name in names))]
+    if search == 'grid':
+        return grid
+    if search == 'random':
+        rng = np.random.RandomState(seed)
+        chosen = rng.choice(len(grid), size=min(n_candidates, len(grid)),
+                            replace=False)
+        return [grid[i] for i in chosen]
+    raise ValueError(f"Unknown search {search}, use 'grid' or 'random'")
+
+
+def make_folds(num_data, nfold=3, seed=1):
+    """Random (train_idx, test_idx) splits, shared by all the candidates."""
+    randidx = np.random.RandomState(seed).permutation(num_data)
+    test_ids = np.array_split(randidx, nfold)
+    return [(np.sort(np.concatenate(test_ids[:k] + test_ids[k + 1:])),
+             np.sort(test_ids[k])) for k in range(nfold)]
+
+
+def share_array(array):
+    """Copies array into a new shared memory block."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _init_worker(specs):
+    """Attaches the worker to the shared training data."""
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared[key + '_block'] = block
+        _shared[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _split_params(candidate):
+    params = dict(config.BOOSTER_PARAMS)
+    gp_optim_params = dict(config.GP_OPTIM_PARAMS)
+    for name, value in candidate.items():
+        if name == 'optimizer_cov':
+            gp_optim_params[name] = value
+        else:
+            params[name] = value
+    return params, gp_optim_params
+
+
+def _evaluate(candidate, fold, num_threads):
+    """Validation error of candidate on one fold, with early stopping.
+
+    Returns
+    -------
+    l2
+        Lowest validation l2 error.
+    num_boost_round
+        Number of boosting rounds of the lowest error."""
+    import gpboost as gpb
+    params, gp_optim_params = _split_params(candidate)
+    params['num_threads'] = num_threads
+    X, y, groups = _shared['X'], _shared['y'], _shared['groups']
+    gp_model = gpb.GPModel(group_data=groups)
+    gp_model.set_optim_params(params=gp_optim_params)
+    cvbst = gpb.cv(params=params, train_set=gpb.Dataset(X, y),
+                   gp_model=gp_model, use_gp_model_for_validation=True,
+                   folds=[fold],
+                   num_boost_round=config.CV_PARAMS['num_boost_round'],
+                   early_stopping_rounds=config.CV_PARAMS['early_stopping_rounds'],
+                   verbose_eval=False, show_stdv=False)
+    l2 = np.asarray(cvbst['l2-mean'])
+    return float(l2.min()), int(np.argmin(l2))
+
+
+@instrumentation.traced('tune')
+def tune(X_train, y_train, groups_train, search='grid', n_candidates=20,
+         workers=None, num_threads=1, keep=0.5, nfold=None, seed=None,
+         predicted_indicator=None):
+    """Hyperparameter search with cross-validation across a process pool.
+    The training data is copied once into shared memory, the workers map it
+    without pickling it per task. The folds work as successive halving
+    rungs: every candidate is evaluated on the first fold, and only the best
+    fraction keep of them goes on to the next fold, so losing candidates
+    are stopped early. The best configuration is written to the file of
+    predicted_indicator (see io_aux_train.best_params_path), where
+    io_aux_train.get_model_params reads it.
+
+    Parameters
+    ----------
+    X_train: Train data
+    y_train: Response train data
+    groups_train: Group indices
+    search: 'grid' or 'random' (see tuning.candidates).
+    n_candidates: Number of configurations of the random search.
+    workers: Number of worker processes. Per default: os.cpu_count().
+    num_threads: Threads used by gpboost in each worker.
+    keep: Fraction of candidates kept after each fold.
+    nfold: Number of folds. Per default: config.CV_PARAMS['nfold'].
+    seed: Seed of the folds and the random search.
+        Per default: config.CV_PARAMS['seed'].
+    predicted_indicator: Variable predicted. Per default: config.PREDICTED_INDICATOR.
+
+    Returns
+    -------
+    best
+        Dictionary with the best parameters, its cross-validation error
+        and number of boosting rounds."""
+    nfold = config.CV_PARAMS['nfold'] if nfold is None else nfold
+    seed = config.CV_PARAMS['seed'] if seed is None else seed
+    pool = candidates(search, n_candidates, seed=seed)
+    X = np.ascontiguousarray(X_train, dtype=np.float64)
+    y = np.ascontiguousarray(np.ravel(y_train), dtype=np.float64)
+    groups = np.ascontiguousarray(groups_train)
+    if groups.dtype == object:
+        groups = groups.astype(str)
+    folds = make_folds(len(y), nfold, seed)
+    logging.info(f'Tuning {len(pool)} candidates on {nfold} folds')
+
+    blocks = []
+    specs = {}
+    for key, array in (('X', X), ('y', y), ('groups', groups)):
+        block, specs[key] = share_array(array)
+        blocks.append(block)
+    scores = {i: [] for i in range(len(pool))}
+    rounds = {i: [] for i in range(len(pool))}
+    alive = list(range(len(pool)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(specs,)) as executor:
+            for k, fold in enumerate(folds):
+                results = executor.map(_evaluate, [pool[i] for i in alive],
+                                       itertools.repeat(fold),
+                                       itertools.repeat(num_threads))
+                for i, (l2, num_boost_round) in zip(alive, results):
+                    scores[i].append(l2)
+                    rounds[i].append(num_boost_round)
+                alive.sort(key=lambda i: np.mean(scores[i]))
+                if k < len(folds) - 1:
+                    alive = alive[:max(1, int(np.ceil(len(alive) * keep)))]
+                logging.info(f'Fold {k + 1}/{nfold}: {len(alive)} candidates left, '
+                             f'best l2 {np.mean(scores[alive[0]]):.4f}')
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    i = alive[0]
+    params, gp_optim_params = _split_params(pool[i])
+    best = {
+        'params': params,
+        'gp_optim_params': gp_optim_params,
+        'l2': float(np.mean(scores[i])),
+        'num_boost_round': int(np.median(rounds[i])),
+        'search': search,
+        'candidates': len(pool),
+        'features': list(getattr(X_train, 'columns', [])),
+        'indicator': predicted_indicator or config.PREDICTED_INDICATOR,
+        'created': datetime.now().isoformat(timespec='seconds'),
+    }
+    save_best_params(best, training.best_params_path(predicted_indicator))
+    return best
+
+
+def save_best_params(best, path=None):
+    """Writes the best configuration, replacing the former one atomically."""
+    path = config.BEST_PARAMS_PATH if path is None else path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_fname = path + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(best, f, indent=2)
+    os.replace(tmp_fname, path)